@@ -0,0 +1,104 @@
+import socket
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows: no way to read the send queue
+    fcntl = termios = None
+
+# Quality ladder, best first: each level is (JPEG quality, resolution scale)
+DEFAULT_LADDER = [
+    (95, 1.0),
+    (80, 1.0),
+    (65, 0.75),
+    (50, 0.5),
+    (40, 0.35),
+]
+
+
+def parse_ladder(text):
+    """Parse a ladder given as "quality:scale,quality:scale,...", best level first."""
+    ladder = []
+    for level in text.split(","):
+        quality, _, scale = level.partition(":")
+        ladder.append((int(quality), float(scale or 1.0)))
+    return ladder
+
+
+def send_buffer_occupancy(sock):
+    """
+    Bytes written to the socket that the peer has not yet acknowledged, as a fraction
+    of the send buffer. Returns None where the platform cannot report it.
+    """
+    if fcntl is None:
+        return None
+    try:
+        queued = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0")
+        send_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except (OSError, AttributeError):
+        return None
+    return int.from_bytes(queued, "little") / send_buffer if send_buffer else None
+
+
+class AdaptiveController:
+    """
+    Chooses a ladder level for one session from how quickly its socket drains.
+    Steps down quickly when sends block or the send buffer fills, and
+    steps back up only after a sustained run of easy sends.
+    """
+
+    # A send taking this share of the frame interval (or this much buffer occupancy) is congested
+    CONGESTED_SEND = 0.5
+    CONGESTED_BUFFER = 0.5
+    # Below these a send counts as having headroom
+    CLEAR_SEND = 0.1
+    CLEAR_BUFFER = 0.1
+    # Consecutive frames needed before changing level
+    STEP_DOWN_AFTER = 5
+    STEP_UP_AFTER = 90
+
+    def __init__(self, ladder, frame_interval, level=0):
+        self.ladder = ladder
+        self.frame_interval = frame_interval
+        self.level = level
+        self.congested_frames = 0
+        self.clear_frames = 0
+
+    @property
+    def quality(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def scale(self):
+        return self.ladder[self.level][1]
+
+    def set_level(self, level):
+        self.level = level
+        self.congested_frames = 0
+        self.clear_frames = 0
+
+    def record_send(self, duration, buffer_occupancy=None):
+        """
+        Record how long a frame took to send and how full the send buffer was afterwards.
+        Returns the new level if it should change, otherwise None.
+        """
+        load = duration / self.frame_interval
+        occupancy = buffer_occupancy or 0.0
+
+        if load > self.CONGESTED_SEND or occupancy > self.CONGESTED_BUFFER:
+            self.congested_frames += 1
+            self.clear_frames = 0
+        elif load < self.CLEAR_SEND and occupancy < self.CLEAR_BUFFER:
+            self.clear_frames += 1
+            self.congested_frames = 0
+        else:
+            self.congested_frames = 0
+            self.clear_frames = 0
+
+        if self.congested_frames >= self.STEP_DOWN_AFTER and self.level < len(self.ladder) - 1:
+            self.set_level(self.level + 1)
+            return self.level
+        if self.clear_frames >= self.STEP_UP_AFTER and self.level > 0:
+            self.set_level(self.level - 1)
+            return self.level
+        return None
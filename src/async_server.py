@@ -0,0 +1,598 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from adaptive import AdaptiveController, send_buffer_occupancy
+from framestore import open_stored
+from hub import AsyncSubscription, EncodedFrame, HubRegistry, run_hub_async
+from pacing import DEFAULT_FPS, FramePacer, new_session_stats
+from preview import PreviewScheduler, preview_buffers
+from protocol import MAX_CLIENT_PAYLOAD, MSG_CONTROL, decode_json, is_title, read_message_async
+import server
+
+log = logging.getLogger(__name__)
+
+
+async def current_catalog(executor=None):
+    """The catalog snapshot, only going to the executor when the metadata file is due a check."""
+    snapshot = server.catalog.cached(server.METADATA_FILE)
+    if snapshot is None:
+        # The file may need to be read (or generated) from disk
+        snapshot = await asyncio.get_running_loop().run_in_executor(executor, server.catalog.current,
+                                                                    server.METADATA_FILE)
+    return snapshot
+
+
+async def receive_control_signal(reader, writer, shared_state, wakeup, preview_wakeup, pending=()):
+    """
+    Reads control signals from the client without blocking the event loop, after any
+    already read elsewhere (pending). Updates the shared state and wakes the streaming task,
+    or the preview task for preview signals.
+    """
+    pending = list(pending)
+    while True:
+        try:
+            message = pending.pop(0) if pending else await read_message_async(reader, MAX_CLIENT_PAYLOAD)
+            if message is None:
+                break
+
+            msg_type, payload = message
+            if msg_type != MSG_CONTROL:
+                log.warning("unexpected_message type=%s", msg_type)
+                continue
+
+            control_signal = decode_json(payload)
+            action = control_signal.get("action")
+            video_name = control_signal.get("video")
+
+            shared_state["stats"]["control_messages"] += 1
+            log.debug("control action=%s video=%s signal=%s", action, video_name, control_signal)
+            if action == "stats":
+                # Written in one go, so it cannot split a frame on the single-threaded loop
+                writer.write(server.stats_message(shared_state))
+                continue
+
+            if action == "thumbnail":
+                message = await asyncio.get_running_loop().run_in_executor(
+                    None, server.thumbnail_message, video_name
+                )
+                if message is not None:
+                    writer.write(message)
+                continue
+
+            if action == "catalog":
+                message = server.catalog_page_message(control_signal, await current_catalog())
+                if message is not None:
+                    writer.write(message)
+                continue
+
+            if action in ("start", "seek") and (action == "start" or video_name is not None) \
+                    and not is_title(video_name):
+                log.warning("invalid_video action=%s video=%r", action, video_name)
+                continue
+
+            if action == "transport":
+                shared_state["datagram"] = server.open_transport(control_signal, writer.get_extra_info("peername")[0],
+                                                                 shared_state)
+                continue
+
+            if action == "preview":
+                request = server.preview_request(control_signal)
+                if request is not None:
+                    shared_state["preview"] = request
+                    preview_wakeup.set()
+                continue
+
+            if action == "viewport":
+                viewport = server.parse_viewport(control_signal)
+                if viewport is not None:
+                    shared_state["viewport"] = viewport
+
+            elif action == "start":
+                shared_state["video_name"] = video_name
+                shared_state["control_flags"]["stop"] = False
+                shared_state["seek"] = server.start_position(control_signal)
+                shared_state["started_at"] = time.monotonic()
+                shared_state["delta"] = bool(control_signal.get("delta"))
+
+            elif action == "stop":
+                shared_state["control_flags"]["stop"] = True
+                shared_state["video_name"] = None
+                shared_state["seek"] = None
+
+            elif action == "seek":
+                seek = server.parse_seek(control_signal)
+                if seek is not None:
+                    shared_state["seek"] = seek
+
+            elif action == "pause":
+                shared_state["control_flags"]["pause"] = True
+
+            elif action == "resume":
+                shared_state["control_flags"]["pause"] = False
+
+            wakeup.set()
+
+        except Exception as e:
+            log.error("control_error error=%r", e)
+            break
+
+
+async def wait_for_change(wakeup):
+    """Sleep until the control task or a hub signals that something changed."""
+    wakeup.clear()
+    await wakeup.wait()
+
+
+def is_stopped(shared_state, video_name):
+    return shared_state["control_flags"]["stop"] or shared_state["video_name"] != video_name
+
+
+def write_buffer_occupancy(writer):
+    """How backed up the connection is: the fuller of the transport's buffer and the kernel's."""
+    transport = writer.transport
+    occupancy = transport.get_write_buffer_size() / max(transport.get_write_buffer_limits()[1], 1)
+    kernel_occupancy = send_buffer_occupancy(writer.get_extra_info("socket"))
+    return max(occupancy, kernel_occupancy or 0.0)
+
+
+async def send_frame(writer, shared_state, frame, level, controller):
+    """
+    Write a frame message, wait for it to drain and feed the timing to the controller.
+    In UDP mode it is sent as datagrams instead, which never wait.
+    Returns the controller's new level (or None) and the size of the message.
+    """
+    datagram = server.frame_transport(shared_state, frame)
+    send_start = time.monotonic()
+    # Hand over the encoder's buffers (or the mapped store slice) as is; nothing is joined first
+    views = [memoryview(buffer).cast("B") for buffer in server.frame_buffers(shared_state, frame, level)]
+    if datagram is not None:
+        datagram.send(views)
+        occupancy = send_buffer_occupancy(datagram.sock)
+    else:
+        writer.writelines(views)
+        await writer.drain()
+        occupancy = write_buffer_occupancy(writer)
+    send_time = time.monotonic() - send_start
+    shared_state["timings"].observe("send", send_time)
+    return controller.record_send(send_time, occupancy), sum(view.nbytes for view in views)
+
+
+async def subscribe_at_level(hubs, executor, video_path, level, shared_state, wakeup, start_frame=0,
+                             timeline=HubRegistry.SHARED_TIMELINE):
+    """
+    Subscribe to the hub for a ladder level; opening a capture can take a while, so keep it off the loop.
+    If the task is cancelled meanwhile, the subscription is still attached once the executor is done,
+    so it is taken back then rather than left keeping the hub running for nobody.
+    """
+    quality, scale = server.QUALITY_LADDER[level]
+    loop = asyncio.get_running_loop()
+    subscription = AsyncSubscription(loop, wakeup, shared_state["stats"])
+    future = loop.run_in_executor(
+        executor, hubs.subscribe, video_path, quality, scale, subscription, start_frame, shared_state["viewport"],
+        timeline, shared_state["delta"]
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        subscription = await future
+        if subscription is not None:
+            hubs.unsubscribe(subscription)
+        raise
+
+
+async def stream_from_hub(writer, shared_state, wakeup, hubs, executor, video_name, video_path, controller):
+    """Streams frames from the broadcast hub shared with every client watching the same video."""
+    loop = asyncio.get_running_loop()
+
+    seek = server.take_seek(shared_state)
+    start_frame, timeline = await loop.run_in_executor(executor, server.start_target, hubs, seek, video_name,
+                                                       video_path)
+    subscription = await subscribe_at_level(hubs, executor, video_path, controller.level, shared_state, wakeup,
+                                            start_frame, timeline)
+    if subscription is None:
+        log.error("video_open_failed path=%s", video_path)
+        shared_state["video_name"] = None
+        return
+
+    log.info("stream_started video=%s source=hub frame=%d", video_name, start_frame)
+    controller.frame_interval = subscription.hub.frame_interval
+    pending_seek = None
+    if seek is not None:
+        shared_state["stats"]["seeks"] += 1
+        writer.write(server.seeked_message(seek, start_frame, 1 / subscription.hub.frame_interval,
+                                           shared_state["sequence"]))
+        pending_seek = seek
+    position = start_frame  # Index of the next frame the client is due
+
+    try:
+        while True:
+            if is_stopped(shared_state, video_name):
+                log.info("stream_stopped video=%s", video_name)
+                break
+
+            seek = server.take_seek(shared_state)
+            if seek is not None:
+                # Restart from the target in a new hub; frames the old one had queued are dropped with it
+                fps = 1 / subscription.hub.frame_interval
+                target = await loop.run_in_executor(executor, server.seek_target, seek, fps, video_path)
+                new_subscription = await subscribe_at_level(
+                    hubs, executor, video_path, controller.level, shared_state, wakeup, target, hubs.new_timeline()
+                )
+                if new_subscription is None:
+                    continue
+                hubs.unsubscribe(subscription)
+                subscription = new_subscription
+                shared_state["stats"]["seeks"] += 1
+                writer.write(server.seeked_message(seek, target, fps, shared_state["sequence"]))
+                pending_seek = seek
+                position = target
+                log.info("stream_seeked video=%s frame=%d", video_name, target)
+                continue
+
+            if shared_state["control_flags"]["pause"]:
+                if not subscription.paused:
+                    log.info("stream_paused video=%s", video_name)
+                    subscription.paused = True
+                await wait_for_change(wakeup)
+                continue
+            if subscription.paused and subscription.next_index() != position:
+                # Other viewers kept the hub playing; carry on from where this client paused instead
+                new_subscription = await subscribe_at_level(hubs, executor, video_path, controller.level, shared_state,
+                                                            wakeup, position, subscription.hub.timeline)
+                if new_subscription is not None:
+                    hubs.unsubscribe(subscription)
+                    subscription = new_subscription
+                    log.info("stream_resumed video=%s frame=%d", video_name, position)
+                    continue
+            subscription.paused = False
+
+            if not subscription.ready():
+                await wait_for_change(wakeup)
+                continue
+
+            frame = subscription.take()
+            if frame is None:
+                log.info("stream_ended video=%s", video_name)
+                break
+
+            level = controller.level
+            new_level, size = await send_frame(writer, shared_state, frame, level, controller)
+            server.record_frame_sent(shared_state["stats"], subscription.hub.pacer, frame.index, size)
+            server.record_first_frame(shared_state, video_name)
+            position = frame.index + 1
+            if pending_seek is not None:
+                server.record_seek_latency(shared_state["stats"], pending_seek)
+                pending_seek = None
+
+            resized = subscription.hub.viewport != shared_state["viewport"]
+            if new_level is not None or resized:
+                # Carry on from the same point of the video in the hub for the new level or size
+                new_subscription = await subscribe_at_level(
+                    hubs, executor, video_path, controller.level, shared_state, wakeup, subscription.hub.position,
+                    subscription.hub.timeline
+                )
+                if new_subscription is None:
+                    controller.set_level(level)
+                    continue
+                hubs.unsubscribe(subscription)
+                subscription = new_subscription
+                if new_level is not None:
+                    log.info("stream_level video=%s level=%d quality=%s scale=%s", video_name, new_level,
+                             *server.QUALITY_LADDER[new_level])
+                if resized:
+                    log.info("stream_viewport video=%s viewport=%s", video_name, subscription.hub.viewport)
+    finally:
+        hubs.unsubscribe(subscription)
+
+
+async def stream_from_store(writer, shared_state, wakeup, executor, video_name, video_path, stored, controller):
+    """
+    Streams a pre-encoded video from its memory-mapped frame store at the source frame rate,
+    switching between stored variants as the adaptive controller asks. Seeks land on the exact frame.
+    """
+    log.info("stream_started video=%s source=store", video_name)
+    loop = asyncio.get_running_loop()
+    stats = shared_state["stats"]
+    variants = {controller.level: stored}
+    pacer = FramePacer(stored.fps)
+    controller.frame_interval = pacer.frame_interval
+    pending_seek = None
+
+    try:
+        index = 0
+        while index < stored.frame_count:
+            paused = False
+            while (shared_state["control_flags"]["pause"] and shared_state["seek"] is None
+                   and not is_stopped(shared_state, video_name)):
+                if not paused:
+                    log.info("stream_paused video=%s", video_name)
+                    paused = True
+                await wait_for_change(wakeup)
+
+            if is_stopped(shared_state, video_name):
+                log.info("stream_stopped video=%s", video_name)
+                return
+
+            seek = server.take_seek(shared_state)
+            if seek is not None:
+                index = min(server.seek_target(seek, stored.fps), stored.frame_count)
+                pacer.reset(index)
+                stats["seeks"] += 1
+                writer.write(server.seeked_message(seek, index, stored.fps, shared_state["sequence"]))
+                pending_seek = seek
+                log.info("stream_seeked video=%s frame=%d", video_name, index)
+                continue
+
+            if paused:
+                pacer.reset(index)
+
+            # Skip frames that have already missed their deadline, then wait for this one's
+            behind = pacer.frames_behind(index)
+            if behind:
+                stats["frames_dropped"] += min(behind, stored.frame_count - index)
+                index += behind
+                continue
+            sleep_start = time.monotonic()
+            await asyncio.sleep(max(pacer.delay(index), 0))
+            shared_state["timings"].observe("pacing_sleep", time.monotonic() - sleep_start)
+
+            level = controller.level
+            variant = variants[level]
+            frame = EncodedFrame(variant.frame(index), index, index / variant.fps, variant.quality,
+                                 variant.width, variant.height)
+            new_level, size = await send_frame(writer, shared_state, frame, level, controller)
+            server.record_frame_sent(stats, pacer, index, size)
+            server.record_first_frame(shared_state, video_name)
+            if pending_seek is not None:
+                server.record_seek_latency(stats, pending_seek)
+                pending_seek = None
+
+            if new_level is not None and new_level not in variants:
+                quality, scale = server.QUALITY_LADDER[new_level]
+                variant = await loop.run_in_executor(
+                    executor, open_stored, video_path, quality, scale, server.FRAME_STORE_DIR
+                )
+                if variant is not None and variant.frame_count == stored.frame_count:
+                    variants[new_level] = variant
+                else:
+                    # Only levels that have been pre-encoded can be served from the store
+                    if variant is not None:
+                        variant.close()
+                    controller.set_level(level)
+
+            index += 1
+
+        log.info("stream_ended video=%s", video_name)
+    finally:
+        for variant in variants.values():
+            variant.close()
+
+
+async def finish_in_executor(executor, function, *args):
+    """
+    Run a blocking call on the executor and wait for it to finish even if the task is
+    cancelled meanwhile, so whatever runs after the cancellation does not race it.
+    """
+    future = asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await future
+        raise
+
+
+async def stream_previews(writer, shared_state, preview_wakeup, hubs, executor):
+    """
+    Sends the live previews the client has asked for on the event loop.
+    Mirrors server.stream_previews: a round at a time, at most one frame per preview stream.
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = PreviewScheduler(hubs, lambda: AsyncSubscription(loop, preview_wakeup), server.VIDEO_DIR)
+    stats = shared_state["stats"]
+    try:
+        while True:
+            while shared_state["preview"] is None and not scheduler.ready():
+                await wait_for_change(preview_wakeup)
+
+            request, shared_state["preview"] = shared_state["preview"], None
+            if request is not None:
+                # Subscribing may open captures
+                await finish_in_executor(executor, scheduler.update, *request)
+                continue
+
+            frames, ended = scheduler.take_round()
+            for stream_id, frame in frames:
+                views = [memoryview(buffer).cast("B") for buffer in preview_buffers(stream_id, frame)]
+                writer.writelines(views)
+                stats["preview_frames_sent"] += 1
+                stats["bytes_sent"] += sum(view.nbytes for view in views)
+            await writer.drain()
+            if ended:
+                await finish_in_executor(executor, scheduler.restart, ended)
+
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.error("preview_error error=%r", e)
+    finally:
+        scheduler.close()
+        log.debug("preview_task_terminated")
+
+
+async def stream_video(writer, shared_state, wakeup, hubs, executor):
+    """
+    Streams the requested video to one client on the event loop.
+    Mirrors server.stream_video, with awaited waits and non-blocking writes.
+    """
+    loop = asyncio.get_running_loop()
+    controller = AdaptiveController(server.QUALITY_LADDER, 1 / DEFAULT_FPS)
+    try:
+        while True:
+            # Wait for a video to be assigned or the stop flag to reset
+            while shared_state["video_name"] is None or shared_state["control_flags"]["stop"]:
+                await wait_for_change(wakeup)
+
+            video_name = shared_state["video_name"]
+            video_path = os.path.join(server.VIDEO_DIR, video_name + '.mp4')
+
+            if not os.path.exists(video_path):
+                log.error("video_not_found video=%s", video_name)
+                shared_state["video_name"] = None
+                continue
+
+            quality, scale = server.QUALITY_LADDER[controller.level]
+            stored = await loop.run_in_executor(
+                executor, open_stored, video_path, quality, scale, server.FRAME_STORE_DIR
+            )
+            if stored is None:
+                await stream_from_hub(writer, shared_state, wakeup, hubs, executor, video_name, video_path,
+                                      controller)
+            else:
+                await stream_from_store(writer, shared_state, wakeup, executor, video_name, video_path,
+                                        stored, controller)
+
+            stats = shared_state["stats"]
+            log.info("session_frames video=%s sent=%d late=%d dropped=%d bytes=%d", video_name,
+                     stats["frames_sent"], stats["frames_late"], stats["frames_dropped"], stats["bytes_sent"])
+
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.error("stream_error error=%r", e)
+    finally:
+        log.debug("stream_task_terminated")
+
+
+async def handle_client(reader, writer, hubs, executor, pending=None):
+    """
+    Serves one client connection: metadata first, then control and streaming tasks.
+    A connection handed over with the control messages read from it so far (pending)
+    has had its metadata already.
+    """
+    addr = writer.get_extra_info("peername")
+    print(f"Connected to {addr}")
+    stats = new_session_stats()
+
+    try:
+        if pending is None:
+            snapshot = await current_catalog(executor)
+            writer.write(snapshot.message(server.CATALOG_COMPRESSION))
+            await writer.drain()
+            print("Metadata sent to client!")
+            pending = ()
+
+        shared_state = {
+            "video_name": None,
+            "viewport": None,
+            "seek": None,
+            "started_at": None,
+            "delta": False,
+            "preview": None,
+            "datagram": None,
+            "control_flags": {
+                "pause": False,
+                "stop": True
+            },
+            "stats": stats,
+            "timings": server.server_metrics.open_session(stats),
+            "sequence": 0
+        }
+        wakeup = asyncio.Event()
+        preview_wakeup = asyncio.Event()  # Preview frames arrive often; they need not wake the stream task
+
+        stream_task = asyncio.create_task(stream_video(writer, shared_state, wakeup, hubs, executor))
+        preview_task = asyncio.create_task(stream_previews(writer, shared_state, preview_wakeup, hubs, executor))
+        await receive_control_signal(reader, writer, shared_state, wakeup, preview_wakeup, pending)
+
+        # Control stream ended: the client has gone
+        shared_state["control_flags"]["stop"] = True
+        wakeup.set()
+        stream_task.cancel()
+        preview_task.cancel()
+        await asyncio.gather(stream_task, preview_task, return_exceptions=True)
+        if shared_state["datagram"] is not None:
+            shared_state["datagram"].close()
+    except Exception as e:
+        print(f"Error handling client {addr}: {e}")
+    finally:
+        server.server_metrics.close_session(stats)
+        writer.close()
+        print("Client connection closed.")
+
+
+def start_engine(workers):
+    """
+    The bounded executor for blocking work and the hub registry, with hubs driven on the running loop
+    and encoding on a pool of the same size.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode")
+
+    def start_hub(hub):
+        # Hubs may be created on executor threads; their driver belongs on the loop
+        loop.call_soon_threadsafe(loop.create_task, run_hub_async(hub, executor))
+
+    return executor, HubRegistry(start_hub=start_hub, timings=server.server_metrics.timings, encode_threads=workers)
+
+
+async def serve(host, port, workers):
+    """Run the asyncio engine: every socket on one loop, decode/encode on a bounded executor."""
+    executor, hubs = start_engine(workers)
+
+    async_server = await asyncio.start_server(
+        lambda r, w: handle_client(r, w, hubs, executor), host, port, backlog=1024
+    )
+    print(f"Server listening on port {port} (asyncio engine, {workers} encode workers)...")
+    async with async_server:
+        await async_server.serve_forever()
+
+
+def start_server(host='0.0.0.0', port=5000, workers=None):
+    """Start the asyncio server engine."""
+    asyncio.run(serve(host, port, workers or server.ENCODE_WORKERS))
+
+
+async def serve_handed_off(receive_connection, workers, on_closed=None):
+    """
+    Run the asyncio engine on connections accepted by another process. receive_connection
+    blocks until the next (socket, pending control messages) arrives; on_closed is called
+    as each one ends.
+    """
+    loop = asyncio.get_running_loop()
+    executor, hubs = start_engine(workers)
+
+    async def serve_connection(sock, pending):
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            await handle_client(reader, writer, hubs, executor, pending)
+        finally:
+            if on_closed is not None:
+                on_closed()
+
+    # Received on a daemon thread rather than the loop's executor, whose shutdown would wait on it forever
+    connections = asyncio.Queue()
+
+    def receive():
+        while True:
+            try:
+                connection = receive_connection()
+            except Exception as e:
+                connection = e
+            loop.call_soon_threadsafe(connections.put_nowait, connection)
+            if isinstance(connection, Exception):
+                return
+
+    threading.Thread(target=receive, daemon=True).start()
+
+    tasks = set()  # The loop only keeps weak references to tasks
+    while True:
+        connection = await connections.get()
+        if isinstance(connection, Exception):
+            raise connection
+        sock, pending = connection
+        task = loop.create_task(serve_connection(sock, pending))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
@@ -0,0 +1,128 @@
+import argparse
+import json
+import socket
+import threading
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from protocol import (MESSAGE_HEADER, BufferPool, MessageReader, decode_frame, decode_header, encode_frame_header,
+                      recv_exactly, send_buffers)
+
+
+def make_jpeg(width, height, quality=95):
+    """A synthetic frame with enough detail to give a realistically sized JPEG."""
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    frame = np.dstack([np.tile(gradient, (height, 1))] * 3)
+    noise = np.random.default_rng(0).integers(0, 48, frame.shape, dtype=np.uint8)
+    _, buffer = cv2.imencode('.jpg', frame + noise, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer
+
+
+def send_old(sock, buffer, index):
+    """The original server path: copy out of NumPy, then two sendall calls."""
+    frame_data = buffer.tobytes()
+    sock.sendall(encode_frame_header(index, index / 30, 0, 95, 0, 0, len(frame_data)))
+    sock.sendall(frame_data)
+
+
+def send_new(sock, buffer, index):
+    """Header and NumPy buffer together in one sendmsg call."""
+    send_buffers(sock, (encode_frame_header(index, index / 30, 0, 95, 0, 0, len(buffer)), buffer))
+
+
+def receive_old(sock):
+    """The original client path: grow the frame with bytes += packet."""
+    header = recv_exactly(sock, MESSAGE_HEADER.size)
+    _, frame_size = decode_header(header)
+    frame_data = b''
+    while len(frame_data) < frame_size:
+        frame_data += sock.recv(frame_size - len(frame_data))
+    decode_frame(frame_data)
+
+
+class PooledReceiver:
+    """The new client path: recv_into straight into pooled, reusable buffers."""
+
+    def __init__(self):
+        self.pool = BufferPool()
+        self.readers = {}
+
+    def __call__(self, sock):
+        reader = self.readers.get(sock)
+        if reader is None:
+            reader = self.readers[sock] = MessageReader(sock, self.pool)
+        _, payload = reader.read()
+        _, jpeg = decode_frame(payload)
+        jpeg.release()
+        self.pool.release(payload)
+
+
+def run(send, receive, buffer, frames, trace):
+    """Push frames through a socket pair. Returns frames/s, MB/s and peak bytes allocated per frame."""
+    sender, receiver = socket.socketpair()
+
+    def send_all():
+        for index in range(frames):
+            send(sender, buffer, index)
+
+    peaks = []
+    thread = threading.Thread(target=send_all)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(frames):
+        if trace:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        receive(receiver)
+        if trace:
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    thread.join()
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    receiver.close()
+    result = {
+        "frames_per_second": frames / elapsed,
+        "megabytes_per_second": frames * len(buffer) / elapsed / 1e6,
+    }
+    if trace:
+        result["peak_bytes_allocated_per_frame"] = sorted(peaks)[len(peaks) // 2]
+    return result
+
+
+def benchmark(width, height, frames):
+    buffer = make_jpeg(width, height)
+    results = {"frame_bytes": len(buffer), "width": width, "height": height}
+    for name, send, receive in (
+        ("before", send_old, receive_old),
+        ("after", send_new, PooledReceiver()),
+    ):
+        # Time without tracing, then measure allocations in a second, traced run
+        result = run(send, receive, buffer, frames, trace=False)
+        tracemalloc.start()
+        traced = run(send, receive, buffer, max(frames // 10, 10), trace=True)
+        tracemalloc.stop()
+        result["peak_bytes_allocated_per_frame"] = traced["peak_bytes_allocated_per_frame"]
+        results[name] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the frame send/receive path")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = benchmark(args.width, args.height, args.frames)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{args.width}x{args.height} JPEG, {results['frame_bytes']} bytes per frame")
+        for name in ("before", "after"):
+            result = results[name]
+            print(f"{name:>7}: {result['frames_per_second']:8.1f} frames/s  "
+                  f"{result['megabytes_per_second']:8.1f} MB/s  "
+                  f"{result['peak_bytes_allocated_per_frame']:>10} bytes allocated per frame (peak)")
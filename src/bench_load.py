@@ -0,0 +1,507 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+from datagram import Reassembler, new_reception_stats, open_receiver
+from ingest import ingest_catalog
+from protocol import (MSG_CATALOG, MSG_CONTROL, MSG_FRAME, MSG_STATS, MSG_TILES, BufferPool,
+                      MessageReader, ProtocolError, decode_header, decode_json, decompress, encode_json, read_message)
+from workers import PLACEMENTS
+
+try:
+    import resource
+except ImportError:  # Windows: the server's CPU time is not reported
+    resource = None
+
+# Bumped whenever the layout of the results changes, so runs are only compared like for like
+RESULTS_VERSION = 2
+
+SCENARIOS = ("play", "pause-resume", "stop-start")
+
+
+def make_videos(video_dir, count, seconds, width, height, fps):
+    """Write synthetic test videos (a moving bar and a frame counter over a gradient)."""
+    os.makedirs(video_dir, exist_ok=True)
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    names = []
+    for number in range(count):
+        name = f"bench_{number:02d}"
+        writer = cv2.VideoWriter(os.path.join(video_dir, name + ".mp4"), cv2.VideoWriter_fourcc(*"mp4v"),
+                                 fps, (width, height))
+        for index in range(int(seconds * fps)):
+            frame = cv2.merge([gradient, np.roll(gradient, index * 4, axis=1), np.full_like(gradient, number * 20)])
+            x = index * 8 % width
+            frame[:, x:x + 16] = 255
+            cv2.putText(frame, f"{name} {index}", (20, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+            writer.write(frame)
+        writer.release()
+        names.append(name)
+    return names
+
+
+def run_server(engine, port, workers, video_dir, data_dir, processes=1, placement="least-connections", loss=0.0,
+               loss_burst=1.0):
+    """Server process: serve the test videos, keeping its thumbnails and indexes out of the real catalog."""
+    # Keep the server's per-connection logging out of the results
+    sys.stdout = open(os.devnull, 'w')
+    import server
+    server.UDP_LOSS = loss
+    server.UDP_LOSS_BURST = loss_burst
+    server.VIDEO_DIR = video_dir
+    server.METADATA_FILE = os.path.join(video_dir, "metadata.json")
+    server.INDEX_FILE = os.path.join(video_dir, "index.json")
+    server.THUMBNAIL_DIR = os.path.join(data_dir, "thumbnails")
+    server.KEYFRAME_DIR = os.path.join(data_dir, "keyframes")
+    server.FRAME_STORE_DIR = os.path.join(data_dir, "framestore")
+    server.generate_metadata()  # Already ingested, so this only reads the index
+
+    if processes != 1:
+        import workers as worker_pool
+        # Exit cleanly when stopped, so the worker processes are reaped and their CPU time is counted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        worker_pool.start_server(port=port, processes=processes, engine=engine, engine_workers=workers,
+                                 placement=placement, log_level="WARNING")
+    elif engine == "asyncio":
+        import async_server
+        async_server.start_server(port=port, workers=workers)
+    else:
+        server.start_server(port=port)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, server_process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not server_process.is_alive():
+            raise RuntimeError("The server exited before it started listening")
+        try:
+            # Take the catalog like a real client: a connection dropped mid-handshake upsets the threaded engine
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+                read_message(sock)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Server did not start listening on port {port}")
+
+
+class VirtualClient:
+    """
+    A headless client speaking the wire protocol. A reader thread timestamps every
+    message while the scenario thread sends control signals. With udp, frames arrive
+    as datagrams on a reader thread of their own.
+    """
+
+    def __init__(self, port, video, delta=False, udp=False):
+        self.video = video
+        self.delta = delta
+        # A timeout for the handshake only, so a server that stops accepting fails the client instead of hanging it
+        connecting_at = time.monotonic()
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+        self.lock = threading.Condition()
+        self.frames = 0
+        self.bytes = 0
+        self.last_frame_at = None
+        self.arrivals = []  # When each frame arrived
+        self.stats_replies = 0
+        self.server_stats = None
+
+        reader = MessageReader(self.sock)
+        message = reader.read()
+        if message is not None:
+            message = decompress(*message)
+        if message is None or message[0] != MSG_CATALOG:
+            raise ProtocolError("Expected the video catalog from the server")
+        self.connect_latency = time.monotonic() - connecting_at  # Until the catalog is in
+        self.sock.settimeout(None)
+        self.pool = BufferPool()
+        self.reader = threading.Thread(target=self.receive, args=(MessageReader(self.sock, self.pool),),
+                                       daemon=True)
+        self.reader.start()
+
+        self.reassembler = None
+        if udp:
+            self.datagram_socket = open_receiver("127.0.0.1")
+            self.reassembler = Reassembler()
+            threading.Thread(target=self.receive_datagrams, daemon=True).start()
+            self.send("transport", mode="udp", port=self.datagram_socket.getsockname()[1])
+
+    def receive(self, reader):
+        while True:
+            try:
+                message = reader.read()
+            except OSError:
+                message = None
+            if message is None:
+                break
+            msg_type, payload = message
+            with self.lock:
+                if msg_type in (MSG_FRAME, MSG_TILES):
+                    self.count_frame(len(payload))
+                elif msg_type == MSG_STATS:
+                    self.stats_replies += 1
+                    self.server_stats = decode_json(payload)
+                self.lock.notify_all()
+            self.pool.release(payload)
+        with self.lock:
+            self.lock.notify_all()
+
+    def receive_datagrams(self):
+        buffer = bytearray(65536)
+        while True:
+            try:
+                length = self.datagram_socket.recv_into(buffer)
+            except OSError:
+                break
+            with self.lock:
+                for message in self.reassembler.add(memoryview(buffer)[:length]):
+                    self.count_frame(decode_header(message)[1])
+                    self.lock.notify_all()
+
+    def count_frame(self, size):
+        """Count a frame received. Call with the lock held."""
+        self.frames += 1
+        self.bytes += size
+        self.last_frame_at = time.monotonic()
+        self.arrivals.append(self.last_frame_at)
+
+    def send(self, action, **fields):
+        self.sock.sendall(encode_json(MSG_CONTROL, {"action": action, "video": self.video, **fields}))
+
+    def wait_for_frame(self, after, timeout=10):
+        """Seconds from `after` until the first frame that arrived after it, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.last_frame_at is None or self.last_frame_at < after:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            return self.last_frame_at - after
+
+    def control_round_trip(self, timeout=10):
+        """Seconds for a stats control signal to be answered: the control path's latency under load."""
+        with self.lock:
+            expected = self.stats_replies + 1
+        sent_at = time.monotonic()
+        self.send("stats")
+        deadline = sent_at + timeout
+        with self.lock:
+            while self.stats_replies < expected:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+        return time.monotonic() - sent_at
+
+    def counters(self):
+        with self.lock:
+            return self.frames, self.bytes
+
+    def frame_gaps(self, since):
+        """Seconds between consecutive frames that arrived since the given time: long ones are stalls."""
+        with self.lock:
+            arrivals = [arrival for arrival in self.arrivals if arrival >= since]
+        return [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.reassembler is not None:
+            self.datagram_socket.close()
+
+
+def play(client, seconds, result, probe_interval=1.0):
+    """Receive for a while, probing the control path now and then. Returns the frames and bytes received."""
+    frames_before, bytes_before = client.counters()
+    started = time.monotonic()
+    end = started + seconds
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(probe_interval, remaining))
+        if end - time.monotonic() > 0:
+            latency = client.control_round_trip()
+            if latency is not None:
+                result["control_latencies"].append(latency)
+    frames_after, bytes_after = client.counters()
+    result["frame_gaps"].extend(client.frame_gaps(started))
+    result["playing_seconds"] += seconds
+    result["frames"] += frames_after - frames_before
+    result["bytes"] += bytes_after - bytes_before
+
+
+def start(client, result):
+    started_at = time.monotonic()
+    client.send("start", delta=client.delta)
+    ttff = client.wait_for_frame(started_at)
+    result["time_to_first_frame"].append(ttff)
+    return ttff is not None
+
+
+def run_scenario(scenario, port, video, duration, delta, result, udp=False):
+    """One virtual client's session. Fills in result; errors are recorded rather than raised."""
+    try:
+        client = VirtualClient(port, video, delta, udp)
+    except (OSError, ProtocolError) as e:
+        result["error"] = str(e)
+        return
+    result["connect_latency"] = client.connect_latency
+
+    try:
+        if not start(client, result):
+            result["error"] = "no frames after start"
+            return
+
+        if scenario == "play":
+            play(client, duration, result)
+
+        elif scenario == "pause-resume":
+            play(client, duration / 3, result)
+            client.send("pause")
+            time.sleep(duration / 6)
+            resumed_at = time.monotonic()
+            client.send("resume")
+            result["resume_latency"] = client.wait_for_frame(resumed_at)
+            play(client, duration / 2, result)
+
+        elif scenario == "stop-start":
+            play(client, duration / 2, result)
+            client.send("stop")
+            time.sleep(0.2)
+            if start(client, result):
+                play(client, duration / 2, result)
+
+        client.control_round_trip()  # Fresh stats, with the server-wide counters and stage timings
+        client.send("stop")
+        result["server_stats"] = dict(client.server_stats or {})
+        if client.reassembler is not None:
+            result["datagrams"] = dict(client.reassembler.stats)
+    except OSError as e:
+        result["error"] = str(e)
+    finally:
+        client.close()
+
+
+def children_cpu_seconds():
+    """User and system CPU time of the child processes waited for so far."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def summarize(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+        "max": values[-1],
+    }
+
+
+def benchmark(clients, engine="threaded", workers=None, scenario="play", duration=10.0, videos=4,
+              width=640, height=360, fps=30, delta=False, port=None, processes=1, placement="least-connections",
+              transport="tcp", loss=0.0, loss_burst=1.0):
+    """Start a server process, run the virtual clients against it and return the results."""
+    workers = workers or os.cpu_count() or 4
+    port = port or free_port()
+    with tempfile.TemporaryDirectory(prefix="bench_load_") as data_dir:
+        video_dir = os.path.join(data_dir, "videos")
+        # Long enough that no stream ends before its scenario does
+        names = make_videos(video_dir, videos, duration + 5, width, height, fps)
+        # Ingest up front, so its worker processes are not counted as the server's CPU time
+        with contextlib.redirect_stdout(sys.stderr):
+            ingest_catalog(video_dir, os.path.join(data_dir, "thumbnails"), os.path.join(video_dir, "metadata.json"),
+                           os.path.join(video_dir, "index.json"), keyframe_dir=os.path.join(data_dir, "keyframes"))
+
+        server_process = multiprocessing.Process(target=run_server,
+                                                 args=(engine, port, workers, video_dir, data_dir, processes,
+                                                       placement, loss, loss_burst))
+        usage_before = children_cpu_seconds()
+        server_process.start()
+        try:
+            wait_for_port(port, server_process)
+        except (TimeoutError, RuntimeError):
+            server_process.terminate()
+            raise
+
+        scenarios = SCENARIOS if scenario == "mixed" else (scenario,)
+        streams = []
+        threads = []
+        started = time.monotonic()
+        for number in range(clients):
+            result = {
+                "client": number,
+                "scenario": scenarios[number % len(scenarios)],
+                "video": names[number % len(names)],
+                "frames": 0,
+                "bytes": 0,
+                "playing_seconds": 0.0,
+                "time_to_first_frame": [],
+                "control_latencies": [],
+                "frame_gaps": [],
+                "resume_latency": None,
+                "connect_latency": None,
+                "error": None,
+            }
+            streams.append(result)
+            thread = threading.Thread(target=run_scenario,
+                                      args=(result["scenario"], port, result["video"], duration, delta, result,
+                                            transport == "udp"))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.monotonic() - started
+
+        # The server's CPU time is only reported for children that have been waited for
+        server_process.terminate()
+        server_process.join()
+        usage_after = children_cpu_seconds()
+
+    server_cpu = usage_after - usage_before if resource else None
+    # Every stats reply carries the server-wide metrics; keep the most recent
+    server_metrics = None
+    for result in streams:
+        server = result.get("server_stats", {}).pop("server", None)
+        if server and (server_metrics is None
+                       or server["counters"]["frames_sent"] > server_metrics["counters"]["frames_sent"]):
+            server_metrics = server
+    for result in streams:
+        playing = result["playing_seconds"]
+        result["fps"] = result["frames"] / playing if playing else 0.0
+        result["bytes_per_second"] = result["bytes"] / playing if playing else 0.0
+        result["control_latency"] = statistics.median(result["control_latencies"]) if result["control_latencies"] else None
+        result["server_cpu_seconds"] = server_cpu and server_cpu / clients  # The server's CPU, shared out evenly
+
+    # Loss and recovery over every client's datagrams
+    datagrams = None
+    if transport == "udp":
+        datagrams = new_reception_stats()
+        for result in streams:
+            for name, value in result.get("datagrams", {}).items():
+                datagrams[name] += value
+
+    return {
+        "version": RESULTS_VERSION,
+        "config": {
+            "clients": clients, "engine": engine, "workers": workers, "processes": processes,
+            "placement": placement, "scenario": scenario,
+            "duration": duration, "videos": videos, "width": width, "height": height, "fps": fps,
+            "delta": delta, "transport": transport, "loss": loss, "loss_burst": loss_burst,
+            "python": platform.python_version(), "cpus": os.cpu_count(),
+        },
+        "summary": {
+            "errors": sum(1 for result in streams if result["error"]),
+            "wall_seconds": wall_seconds,
+            "server_cpu_seconds": server_cpu,
+            "server_cpu_percent": server_cpu and 100 * server_cpu / wall_seconds,
+            "fps": summarize(result["fps"] for result in streams),
+            "connect_latency": summarize(result["connect_latency"] for result in streams),
+            "time_to_first_frame": summarize(ttff for result in streams for ttff in result["time_to_first_frame"]),
+            "control_latency": summarize(result["control_latency"] for result in streams),
+            "frame_gap": summarize(gap for result in streams for gap in result["frame_gaps"]),
+            "resume_latency": summarize(result["resume_latency"] for result in streams),
+            "bytes_per_second": summarize(result["bytes_per_second"] for result in streams),
+            "total_bytes_per_second": sum(result["bytes_per_second"] for result in streams),
+            "server_metrics": server_metrics,
+            "datagrams": datagrams,
+        },
+        "streams": streams,
+    }
+
+
+def format_seconds(summary):
+    if summary is None or summary["p50"] is None:
+        return "n/a"
+    p95 = f"{summary['p95'] * 1000:.1f} ms" if summary["p95"] is not None else "off the scale"
+    return f"{summary['p50'] * 1000:.1f} ms (p95 {p95})"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load test: N virtual clients against a local server")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--workers", type=int, default=None, help="encode workers for the asyncio engine")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("mixed",), default="mixed")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds each client plays for")
+    parser.add_argument("--videos", type=int, default=4, help="distinct test videos the clients spread over")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--delta", action="store_true", help="ask for tile-based delta frames")
+    parser.add_argument("--processes", type=int, default=1, help="server worker processes (0: one per CPU)")
+    parser.add_argument("--placement", choices=PLACEMENTS, default=PLACEMENTS[0],
+                        help="placement of clients on worker processes")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp",
+                        help="receive frames on the connection or as UDP datagrams (default: %(default)s)")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="fraction of frame datagrams the server drops on purpose, with --transport udp")
+    parser.add_argument("--loss-burst", type=float, default=1.0,
+                        help="average run of datagrams dropped in a row with --loss (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=None, help="server port (default: any free port)")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--output", help="also write the machine-readable results to this file")
+    args = parser.parse_args()
+
+    results = benchmark(args.clients, args.engine, args.workers, args.scenario, args.duration, args.videos,
+                        args.width, args.height, args.fps, args.delta, args.port,
+                        args.processes, args.placement, args.transport, args.loss, args.loss_burst)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        summary = results["summary"]
+        processes = f" in {args.processes or os.cpu_count()} processes" if args.processes != 1 else ""
+        print(f"{args.clients} clients, {args.engine} engine{processes}, {args.scenario} scenario, "
+              f"{args.width}x{args.height} at {args.fps} fps")
+        print(f"  errors:              {summary['errors']}")
+        if summary["fps"]:
+            print(f"  fps per stream:      {summary['fps']['p50']:.1f} (worst {min(r['fps'] for r in results['streams']):.1f})")
+        print(f"  connect latency:     {format_seconds(summary['connect_latency'])}")
+        print(f"  time to first frame: {format_seconds(summary['time_to_first_frame'])}")
+        print(f"  control latency:     {format_seconds(summary['control_latency'])}")
+        if summary["frame_gap"]:
+            print(f"  frame gap:           {format_seconds(summary['frame_gap'])}, "
+                  f"longest {summary['frame_gap']['max'] * 1000:.1f} ms")
+        print(f"  resume latency:      {format_seconds(summary['resume_latency'])}")
+        print(f"  throughput:          {summary['total_bytes_per_second'] / 1e6:.1f} MB/s")
+        if summary["datagrams"]:
+            datagrams = summary["datagrams"]
+            print(f"  datagrams:           {datagrams['datagrams_received']} received, "
+                  f"{datagrams['datagrams_lost']} lost, {datagrams['fragments_recovered']} rebuilt from parity; "
+                  f"{datagrams['frames_incomplete']} of "
+                  f"{datagrams['frames_completed'] + datagrams['frames_incomplete']} frames incomplete")
+        if summary["server_cpu_seconds"] is not None:
+            print(f"  server CPU:          {summary['server_cpu_percent']:.0f}% of a core "
+                  f"({summary['server_cpu_seconds'] / args.clients:.2f} s per stream)")
+        if summary["server_metrics"]:
+            # Histogram quantiles are bucket upper bounds
+            for stage, timing in summary["server_metrics"]["stages"].items():
+                print(f"  {stage + ':':<21}{format_seconds(timing)}, {timing['count']} samples")
@@ -0,0 +1,139 @@
+"""
+The video catalog, held in memory and shared by every connection.
+
+Ingest writes the catalog to the metadata file. The catalog service reads it once,
+then only again when the file changes: it looks at the file's modification time
+and size at most every CHECK_INTERVAL seconds, so a burst of connections costs one
+stat, not one read and parse each. Each version of the catalog is a snapshot
+holding the entries and the catalog message every new connection is sent, built
+once when the snapshot is made, plain and (when large) zlib-compressed.
+
+Clients can also ask for part of the catalog, with a catalog control signal naming
+a title to search for and a page (offset and limit); the reply is a catalog page
+message with the total number of matches and the entries on that page.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from protocol import MSG_CATALOG, MSG_CATALOG_PAGE, encode_json
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks of the metadata file for a new catalog
+CHECK_INTERVAL = 1.0
+
+# Catalog messages whose JSON is larger than this many bytes are sent zlib-compressed
+COMPRESS_MIN_BYTES = 4096
+
+# Entries per catalog page when a query gives no limit, and the most a query may ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def parse_query(control_signal):
+    """
+    The (search, offset, limit) of a catalog control signal, {"search": text, "offset": n, "limit": n},
+    all optional; None if invalid. search matches titles containing it, ignoring case.
+    """
+    try:
+        search = control_signal.get("search") or ""
+        offset = int(control_signal.get("offset", 0))
+        limit = int(control_signal.get("limit", PAGE_SIZE))
+        if not isinstance(search, str) or offset < 0 or limit < 0:
+            raise ValueError(control_signal)
+    except (TypeError, ValueError):
+        log.warning("invalid_catalog_query signal=%s", control_signal)
+        return None
+    return search.casefold(), offset, min(limit, MAX_PAGE_SIZE)
+
+
+class CatalogSnapshot:
+    """One version of the catalog, with its catalog message ready to send."""
+
+    def __init__(self, entries, signature):
+        self.entries = entries
+        self.signature = signature  # (metadata file, modification time, size) it was read from
+        self.titles = [entry["title"].casefold() for entry in entries]  # For searches
+        self.by_title = {entry["title"]: entry for entry in entries}
+        self.plain = encode_json(MSG_CATALOG, entries)
+        self.compressed = encode_json(MSG_CATALOG, entries, compress_above=COMPRESS_MIN_BYTES)
+
+    def message(self, compress=True):
+        """The catalog message sent to a new connection."""
+        return self.compressed if compress else self.plain
+
+    def page(self, search="", offset=0, limit=PAGE_SIZE):
+        """The entries whose titles contain search (casefolded), from offset on, and how many match in all."""
+        if search:
+            matches = [entry for entry, title in zip(self.entries, self.titles) if search in title]
+        else:
+            matches = self.entries
+        return {"offset": offset, "total": len(matches), "videos": matches[offset:offset + limit]}
+
+    def page_message(self, query, compress=True):
+        """The catalog page message answering a query from parse_query."""
+        return encode_json(MSG_CATALOG_PAGE, self.page(*query),
+                           compress_above=COMPRESS_MIN_BYTES if compress else None)
+
+
+class CatalogService:
+    """
+    The current catalog snapshot, read again from the metadata file only once that changes.
+    generate() is called to write the file when there is none. Thread-safe.
+    """
+
+    def __init__(self, generate=None, check_interval=CHECK_INTERVAL):
+        self.generate = generate
+        self.check_interval = check_interval
+        self.snapshot = None
+        self.checked_at = float("-inf")  # When the metadata file was last looked at
+        self.lock = threading.Lock()
+
+    def cached(self, metadata_file):
+        """The snapshot of the given metadata file if it is not due a check, else None. Never touches the disk."""
+        snapshot, checked_at = self.snapshot, self.checked_at
+        if (snapshot is not None and snapshot.signature[0] == metadata_file
+                and time.monotonic() < checked_at + self.check_interval):
+            return snapshot
+        return None
+
+    def current(self, metadata_file):
+        """The snapshot of the given metadata file, reading it (or generating it) first if it has changed."""
+        snapshot = self.cached(metadata_file)
+        if snapshot is not None:
+            return snapshot
+
+        with self.lock:
+            snapshot = self.cached(metadata_file)  # Another thread may have just checked
+            if snapshot is not None:
+                return snapshot
+
+            if not os.path.exists(metadata_file) and self.generate is not None:
+                print("Metadata file not found, generating metadata...")
+                self.generate()
+            try:
+                snapshot = self.load(metadata_file)
+            except (OSError, ValueError) as e:
+                if self.snapshot is None or self.snapshot.signature[0] != metadata_file:
+                    raise
+                # Keep serving the catalog as it was rather than none at all
+                log.warning("catalog_load_failed file=%s error=%r", metadata_file, e)
+                snapshot = self.snapshot
+            self.snapshot, self.checked_at = snapshot, time.monotonic()
+            return snapshot
+
+    def load(self, metadata_file):
+        """A snapshot of the metadata file: the current one if the file has not changed since."""
+        stat = os.stat(metadata_file)
+        signature = (metadata_file, stat.st_mtime_ns, stat.st_size)
+        if self.snapshot is not None and self.snapshot.signature == signature:
+            return self.snapshot
+
+        with open(metadata_file, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        snapshot = CatalogSnapshot(entries, signature)
+        log.info("catalog_loaded videos=%d bytes=%d compressed_bytes=%d", len(entries), len(snapshot.plain),
+                 len(snapshot.compressed))
+        return snapshot
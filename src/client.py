@@ -3,9 +3,46 @@ from tkinter import ttk
 from PIL import Image, ImageTk
 import cv2
 import numpy as np
+import os
+import queue
 import socket
-import json
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from framecache import FrameCache
+from jitter import JitterBuffer
+from datagram import Reassembler, open_receiver
+from protocol import (MESSAGE_HEADER, MSG_CATALOG, MSG_CONTROL, MSG_FRAME, MSG_PREVIEW, MSG_SEEKED, MSG_STATS,
+                      MSG_THUMBNAIL, MSG_TILES, BufferPool, MessageReader, ProtocolError, decode_frame, decode_header,
+                      decode_json, decode_preview, decode_thumbnail, decode_tiles, decompress, encode_json,
+                      read_message)
+
+# Decoded frames held back to absorb network and decode jitter
+JITTER_BUFFER_DEPTH = 8
+# Threads decoding JPEG frames in parallel
+DECODE_WORKERS = 2
+# Skip frames that are already late instead of showing every frame behind schedule
+DROP_LATE_FRAMES = True
+# Ask for tile-based delta frames (only changed regions are sent); best for screen recordings
+# and other low-motion video
+DELTA_FRAMES = False
+# Wait for the canvas to stop resizing for this long before asking the server for a new frame size
+VIEWPORT_DEBOUNCE_MS = 300
+# Thumbnails fetched from the server, stored by content hash so each is only downloaded once
+THUMBNAIL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "video-streaming", "thumbnails")
+# Space kept for each thumbnail in the list; the server sends them scaled to fit it
+THUMBNAIL_SIZE = (160, 120)
+# Receive frames as UDP datagrams (see datagram.py) rather than on the connection, so a lost packet costs
+# a frame instead of holding up every frame behind it; control signals and the catalog stay on the connection.
+# Delta frames build on each other, so in delta mode they come on the connection regardless.
+UDP_TRANSPORT = False
+# Thumbnails in view played as live previews, all over this one connection (0: still thumbnails only);
+# the server allows up to 16
+LIVE_PREVIEWS = 8
+# Received JPEG frames kept for rewinding and replaying without the server, in bytes (0: no cache).
+# Delta frames only make sense on top of the frames before them, so they are never cached.
+FRAME_CACHE_BYTES = 64 * 1024 * 1024
 
 
 class VideoPlayerUI:
@@ -16,7 +53,50 @@ class VideoPlayerUI:
         self.selected_title_label = None
         self.is_paused = False
         self.is_streaming = False
-        self.stream_thread = None
+        self.stream_level = 0  # Quality ladder level reported by the server (0 = best)
+
+        # Playback pipeline: network reader -> decode workers -> jitter buffer -> Tk render loop
+        self.jitter_buffer = JitterBuffer(JITTER_BUFFER_DEPTH, drop_late=DROP_LATE_FRAMES)
+        self.decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+        self.buffer_pool = BufferPool(max_free=JITTER_BUFFER_DEPTH)
+        self.frame_interval = 1 / 30  # Updated from the stream's timestamps
+        self.last_pts = None
+        self.render_job = None
+        self.canvas_size = (500, 300)
+        self.viewport_sent = None  # Canvas size last reported to the server
+        self.viewport_job = None
+        self.photo_image = None    # Reused for every frame of the same size
+        self.videos = {}           # Catalog entries by title
+        self.frame_buffer = None   # Delta mode: the frame that tile patches are painted onto
+
+        # Seeking: frames from before a seek are dropped until the server confirms where it landed
+        self.seek_id = 0
+        self.seek_pending = False
+        self.seek_requested_at = None  # For time-to-first-frame after a seek
+        self.seek_sequence = 0         # Sequence number of the first frame from where the last seek landed
+        self.decode_generation = 0     # Bumped on each seek and stop, so in-flight decodes are discarded
+        self.scrubbing = False
+
+        # Frames played again from the cache are fed into the decode pool by a thread of their own,
+        # with the server paused (or stopped) until playback runs past the end of what is cached
+        self.frame_cache = FrameCache(FRAME_CACHE_BYTES) if FRAME_CACHE_BYTES and not DELTA_FRAMES else None
+        self.caching = False           # Whether frames arriving now are known to be from the selected video
+        self.start_pts = 0.0           # Where the server was last asked to start the stream from
+        self.local_playback = False
+        self.server_state = "stopped"  # What the server was last told: "streaming", "paused" or "stopped"
+        self.resume_after_pts = None   # Frames up to this one were already shown from the cache
+        self.cache_run_end = None      # (decode generation, pts) where the cache player ran out, for the Tk loop
+
+        # Thumbnails arrive on the reader thread and are shown from the Tk main loop
+        self.thumbnail_queue = queue.SimpleQueue()
+        self.thumbnail_labels = {}      # Video title -> label showing its thumbnail
+        self.thumbnails_loading = set()  # Titles already requested or loaded
+
+        # Live previews: frames are decoded by the decode workers and the newest of each video painted by
+        # the Tk main loop over its thumbnail
+        self.preview_titles = {}    # Preview stream ID -> video title
+        self.previews_sent = []     # Titles last asked to be previewed
+        self.preview_frames = {}    # Video title -> newest decoded preview frame not shown yet
 
         # Base colors for the UI
         self.bg_color = "#f0f0f5"
@@ -42,6 +122,15 @@ class VideoPlayerUI:
         self.video_window.withdraw()
         self.thumbnail_screen()
 
+        # Read from the server on one thread for the whole connection
+        self.reader_thread = threading.Thread(target=self.receive_stream, daemon=True)
+        self.reader_thread.start()
+        self.datagram_socket = None
+        self.reassembler = None  # UDP mode: puts frames back together, and counts what was lost and recovered
+        if UDP_TRANSPORT and not DELTA_FRAMES:
+            self.open_datagram_transport()
+        self.show_received_thumbnails()
+
     def create_top_panel(self, parent, title):
         """Create a red panel at the top with the app title."""
         top_panel = tk.Frame(parent, bg=self.panel_color, height=50)
@@ -73,6 +162,7 @@ class VideoPlayerUI:
 
         # Fetch video metadata from server
         videos = self.receive_metadata()
+        self.videos = {video["title"]: video for video in videos}
 
         # Add a red panel on top with the app name
         header_frame = tk.Frame(self.thumbnail_window, bg="#FF4C4C")  # Red header
@@ -92,32 +182,42 @@ class VideoPlayerUI:
             self.thumbnail_window, orient="vertical", command=canvas.yview
         )
         scrollable_frame = tk.Frame(canvas, bg=self.bg_color)
+        self.thumbnail_canvas = canvas
 
         scrollable_frame.bind(
             "<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
         )
 
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            self.load_visible_thumbnails()
+
         # Create a window in the canvas for the scrollable frame
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
+        canvas.configure(yscrollcommand=on_scroll)
 
         # Place canvas and scrollbar in the window
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
+        # Rows start with a blank placeholder; thumbnails are loaded as they scroll into view
+        self.thumbnail_placeholder = tk.PhotoImage(width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1])
+        self.thumbnail_rows = []
+        # Each video is previewed under its place in the list
+        self.preview_titles = {stream_id: video["title"] for stream_id, video in enumerate(videos)}
+
         # Display videos in the scrollable frame
         for video in videos:
             video_frame = tk.Frame(scrollable_frame, bg=self.bg_color, bd=1, relief="solid")
             video_frame.pack(fill="x", pady=5, padx=5)
 
-            thumbnail_path = video["thumbnail"]
-            img = Image.open(thumbnail_path)
-            img = img.resize((100, 100), Image.Resampling.LANCZOS)
-            img = ImageTk.PhotoImage(img)
-
-            thumbnail_label = tk.Label(video_frame, image=img, bg=self.bg_color)
-            thumbnail_label.image = img
+            thumbnail_label = tk.Label(
+                video_frame, image=self.thumbnail_placeholder, bg=self.bg_color,
+                width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1]
+            )
             thumbnail_label.pack(side="left", padx=5)
+            self.thumbnail_labels[video["title"]] = thumbnail_label
+            self.thumbnail_rows.append((video_frame, video))
 
             title_label = tk.Label(
                 video_frame, text=video["title"], bg=self.bg_color, font=("Arial", 12)
@@ -141,6 +241,110 @@ class VideoPlayerUI:
         )
         play_button.pack(pady=10)
 
+    def visible_videos(self):
+        """Catalog entries of the rows that are in view, top to bottom."""
+        top = self.thumbnail_canvas.canvasy(0)
+        bottom = top + self.thumbnail_canvas.winfo_height()
+        visible = []
+        for video_frame, video in self.thumbnail_rows:
+            row_top = video_frame.winfo_y()
+            if row_top <= bottom and row_top + video_frame.winfo_height() >= top:
+                visible.append(video)
+        return visible
+
+    def load_visible_thumbnails(self):
+        """Load the thumbnails of rows that are in view, from the disk cache or else from the server."""
+        for video in self.visible_videos():
+            title = video["title"]
+            if title in self.thumbnails_loading:
+                continue
+
+            self.thumbnails_loading.add(title)
+            digest = video.get("thumbnail_hash")
+            cached_path = os.path.join(THUMBNAIL_CACHE_DIR, f"{digest}.jpg")
+            if digest and os.path.exists(cached_path):
+                self.show_thumbnail(title, cached_path)
+            else:
+                self.send_control_signal("thumbnail", title)
+        self.update_previews()
+
+    def update_previews(self):
+        """Play the thumbnails in view as live previews, telling the server when that changes."""
+        if not LIVE_PREVIEWS or self.is_streaming:
+            return
+        titles = [video["title"] for video in self.visible_videos()[:LIVE_PREVIEWS]]
+        if titles != self.previews_sent:
+            self.send_previews(titles)
+
+    def send_previews(self, titles):
+        """Ask the server for live previews of the given videos (none: stop them), sized like thumbnails."""
+        stream_ids = {title: stream_id for stream_id, title in self.preview_titles.items()}
+        streams = [{"id": stream_ids[title], "video": title} for title in titles]
+        self.send_control_signal("preview", None, streams=streams, width=THUMBNAIL_SIZE[0],
+                                 height=THUMBNAIL_SIZE[1])
+        self.previews_sent = titles
+
+    def decode_preview_frame(self, payload):
+        """Decode worker: decode a preview frame and keep it as its video's newest, for the Tk main loop."""
+        try:
+            stream_id, frame_info, frame_data = decode_preview(payload)
+            frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
+            del frame_data
+            self.buffer_pool.release(payload)
+
+            title = self.preview_titles.get(stream_id)
+            if frame is not None and title is not None:
+                self.preview_frames[title] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        except Exception as e:
+            print(f"Error decoding preview frame: {e}")
+
+    def cache_thumbnail(self, payload):
+        """Reader thread: store a thumbnail from the server in the disk cache and queue it for display."""
+        digest, title, data = decode_thumbnail(payload)
+        cached_path = os.path.join(THUMBNAIL_CACHE_DIR, f"{digest}.jpg")
+        try:
+            os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+            with open(cached_path + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(cached_path + ".tmp", cached_path)
+        except OSError as e:
+            print(f"Error caching thumbnail for {title}: {e}")
+            return
+        self.thumbnail_queue.put((title, cached_path))
+
+    def show_received_thumbnails(self):
+        """Show thumbnails the reader thread has received, and the newest preview frames. Runs on the Tk main loop."""
+        while not self.thumbnail_queue.empty():
+            self.show_thumbnail(*self.thumbnail_queue.get())
+        for title in list(self.preview_frames):
+            self.show_preview_frame(title, self.preview_frames.pop(title))
+        self.window.after(50, self.show_received_thumbnails)
+
+    def show_thumbnail(self, title, path):
+        label = self.thumbnail_labels.get(title)
+        if label is None:
+            return
+        try:
+            img = ImageTk.PhotoImage(Image.open(path))  # Already sized by the server
+        except OSError as e:
+            print(f"Error loading thumbnail for {title}: {e}")
+            return
+        label.config(image=img)
+        label.image = img  # Keep a reference to avoid garbage collection
+
+    def show_preview_frame(self, title, img):
+        label = self.thumbnail_labels.get(title)
+        if label is None:
+            return
+        photo = getattr(label, "image", None)
+        if isinstance(photo, ImageTk.PhotoImage) and (photo.width(), photo.height()) == img.size:
+            # Same size as the thumbnail or last frame: draw into the label's image instead of creating one
+            photo.paste(img)
+        else:
+            photo = ImageTk.PhotoImage(img)
+            label.config(image=photo)
+            label.image = photo  # Keep a reference to avoid garbage collection
+
     def select_video(self, video_title, title_label):
         """Select a video from the list and highlight its title."""
         if self.selected_title_label:
@@ -152,16 +356,24 @@ class VideoPlayerUI:
 
         print(f"Selected video: {self.selected_video}")
 
-    def send_control_signal(self, action, video_title):
+    def open_datagram_transport(self):
+        """Ask the server to send frames as datagrams to a UDP socket of our own, and read them on a thread."""
+        self.datagram_socket = open_receiver()
+        self.reassembler = Reassembler()
+        threading.Thread(target=self.receive_datagrams, daemon=True).start()
+        self.send_control_signal("transport", None, mode="udp", port=self.datagram_socket.getsockname()[1])
+
+    def send_control_signal(self, action, video_title, **fields):
         """Send control signal to the server."""
-        control_signal = {"action": action, "video": video_title}
-        control_signal_json = json.dumps(control_signal)
-        self.client_socket.sendall(control_signal_json.encode("utf-8"))
-        print(f"Sent control signal: {control_signal_json}")
+        control_signal = {"action": action, "video": video_title, **fields}
+        self.client_socket.sendall(encode_json(MSG_CONTROL, control_signal))
+        print(f"Sent control signal: {control_signal}")
 
     def video_screen(self):
         """Display a UI for video playback controls."""
         self.thumbnail_window.withdraw()  # Hide the thumbnail window
+        if self.previews_sent:
+            self.send_previews([])  # Nobody sees them while a video plays
         self.video_window.deiconify()  # Show the video window
 
         # Clear the video window for fresh content
@@ -173,7 +385,21 @@ class VideoPlayerUI:
 
         # Video canvas for displaying frames
         self.video_canvas = tk.Canvas(self.video_window, bg="black", width=500, height=300)
-        self.video_canvas.pack(padx=20, pady=20)
+        self.video_canvas.pack(padx=20, pady=20, fill="both", expand=True)
+        self.video_canvas.bind("<Configure>", self.on_canvas_resize)
+        self.canvas_image = self.video_canvas.create_image(250, 150, anchor="center")
+        self.photo_image = None
+
+        # Scrub bar spanning the video's duration; releasing it seeks to that point
+        duration = self.videos.get(self.selected_video, {}).get("duration") or 0
+        self.scrub_position = tk.DoubleVar(value=0)
+        self.scrub_bar = tk.Scale(
+            self.video_window, variable=self.scrub_position, from_=0, to=max(duration, 0.1), resolution=0.1,
+            orient="horizontal", showvalue=False, bg=self.bg_color, highlightthickness=0
+        )
+        self.scrub_bar.pack(fill="x", padx=20)
+        self.scrub_bar.bind("<ButtonPress-1>", self.on_scrub_start)
+        self.scrub_bar.bind("<ButtonRelease-1>", self.on_scrub_end)
 
         # Control buttons
         control_frame = tk.Frame(self.video_window, bg=self.bg_color)
@@ -187,34 +413,146 @@ class VideoPlayerUI:
         self.style_button(self.pause_button)
         self.pause_button.pack(side="left", padx=10)
 
-        # Start the video stream in a separate thread
+        # Start buffering frames and rendering them from the Tk main loop
+        self.jitter_buffer.clear()
+        self.last_pts = None
+        self.frame_buffer = None
         self.is_streaming = True
-        self.stream_thread = threading.Thread(target=self.receive_stream)
-        self.stream_thread.start()
+        self.render_next_frame()
+
+    def on_canvas_resize(self, event):
+        """
+        Remember the canvas size, so decode workers never have to query Tk,
+        and tell the server once the user has finished resizing.
+        """
+        self.canvas_size = (event.width, event.height)
+        if self.viewport_job is not None:
+            self.window.after_cancel(self.viewport_job)
+        self.viewport_job = self.window.after(VIEWPORT_DEBOUNCE_MS, self.send_viewport)
+
+    def send_viewport(self):
+        """Report the canvas size, so the server scales frames down to it before encoding."""
+        self.viewport_job = None
+        if self.selected_video and self.canvas_size != self.viewport_sent:
+            width, height = self.canvas_size
+            self.send_control_signal("viewport", self.selected_video, width=width, height=height)
+            self.viewport_sent = self.canvas_size
+
+    def on_scrub_start(self, event):
+        """Stop the scrub bar following playback while the user drags it."""
+        self.scrubbing = True
+
+    def on_scrub_end(self, event):
+        self.scrubbing = False
+        self.seek_to(self.scrub_position.get())
+
+    def seek_to(self, seconds):
+        """Continue playback from the given time: from the frame cache if it holds that point, else from the server."""
+        if not self.selected_video:
+            return
+        self.seek_requested_at = time.monotonic()
+        self.decode_generation += 1
+        self.jitter_buffer.clear()
+        if not self.play_from_cache(seconds):
+            self.request_stream_from(seconds)
+
+    def request_stream_from(self, seconds, after_pts=None):
+        """
+        Ask the server to stream from the given time: a seek, a seek and resume if it was paused
+        for local playback, or a start at that time if it was stopped. Frames up to after_pts
+        are skipped, having been shown from the cache already.
+        """
+        self.local_playback = False
+        self.seek_id += 1
+        # Frames already on their way are from the old position: drop them until the server confirms the seek
+        self.seek_pending = True
+        self.resume_after_pts = after_pts
+        if self.server_state == "stopped":
+            self.start_stream(time=seconds, id=self.seek_id)
+            return
+        self.send_control_signal("seek", self.selected_video, time=seconds, id=self.seek_id)
+        if self.server_state == "paused" and not self.is_paused:
+            self.send_control_signal("resume", self.selected_video)
+            self.server_state = "streaming"
+
+    def start_stream(self, **fields):
+        """Ask the server to start the selected video, from the beginning or from a given time."""
+        self.caching = False  # Until frames are known to be from this start
+        self.start_pts = fields.get("time", 0.0)
+        self.send_control_signal("start", self.selected_video, delta=DELTA_FRAMES, **fields)
+        self.server_state = "streaming"
+
+    def play_from_cache(self, seconds):
+        """
+        Play the cached frames from the given time, pausing the server while they last.
+        Returns False if that point is not cached.
+        """
+        frames = self.frame_cache.run_from(self.selected_video, seconds) if self.frame_cache else []
+        if not frames:
+            return False
+        if self.server_state == "streaming":
+            self.send_control_signal("pause", self.selected_video)
+            self.server_state = "paused"
+        self.local_playback = True
+        self.seek_pending = False
+        self.last_pts = None
+        threading.Thread(target=self.feed_cached_frames, args=(frames, self.decode_generation), daemon=True).start()
+        print(f"Playing {len(frames)} cached frames from {frames[0][0].pts:.2f} s")
+        return True
+
+    def feed_cached_frames(self, frames, generation):
+        """
+        Cache player thread: hand cached frames to the decode workers, keeping the jitter buffer
+        topped up rather than flooding it, then have the server carry on from where they end.
+        Other viewers may have kept the server's stream going while it was paused, so it is
+        always sent to the end of the run explicitly rather than just resumed. That is left to
+        the Tk main loop, which owns the control messages and what the server was told.
+        """
+        def current():
+            return self.is_streaming and generation == self.decode_generation
+
+        decoding = deque()  # Decodes handed out and not yet in the jitter buffer
+        while frames:
+            for frame_info, data in frames:
+                while current() and (self.is_paused or len(self.jitter_buffer) + len(decoding) >= JITTER_BUFFER_DEPTH // 2):
+                    time.sleep(self.frame_interval / 2)
+                    while decoding and decoding[0].done():
+                        decoding.popleft()
+                if not current():
+                    return
+                if self.last_pts is not None and 0 < frame_info.pts - self.last_pts < 1:
+                    self.frame_interval = frame_info.pts - self.last_pts
+                self.last_pts = frame_info.pts
+                decoding.append(self.decode_pool.submit(self.decode_frame, frame_info, data, None, generation))
+            end_pts = frames[-1][0].pts
+            # Frames still arriving when the server was paused extend the run
+            frames = self.frame_cache.run_from(self.selected_video, end_pts)[1:]
+
+        self.cache_run_end = (generation, end_pts)
 
     def stop_button_action(self):
         """Stop video playback and return to the thumbnail screen."""
         print("Stopping video playback...")
 
-        # Send a stop signal to the server for the current video
+        # Send a stop signal to the server for the current video; what was received stays cached for a replay
         if self.selected_video:
             self.send_control_signal("stop", self.selected_video)
+            self.server_state = "stopped"
 
-        # Signal the streaming thread to stop
-        self.is_streaming = False
-
-        # Wait for the thread to safely finish if it's alive
-        if self.stream_thread and self.stream_thread.is_alive():
-            self.stream_thread.join(timeout=2)  # Allow a timeout to prevent hanging
+        # Stop rendering; frames still arriving are discarded by the reader
+        self.stop_rendering()
+        if self.reassembler is not None:
+            print(f"Frame datagrams: {self.reassembler.stats}")
 
         # Clear the video canvas to remove the last displayed frame
         if hasattr(self, "video_canvas"):
-            self.video_canvas.delete("all")
+            self.video_canvas.itemconfig(self.canvas_image, image="")
 
 
         # Show the thumbnail screen and hide the video window
         self.video_window.withdraw()
         self.thumbnail_window.deiconify()
+        self.update_previews()
 
         print("Video playback stopped. Returned to thumbnail screen.")
 
@@ -226,25 +564,35 @@ class VideoPlayerUI:
         if self.selected_video:
             # Stop any ongoing stream
             if self.is_streaming:
-                self.is_streaming = False
-                if self.stream_thread and self.stream_thread.is_alive():
-                    self.stream_thread.join()
+                self.stop_rendering()
 
-            # Send signal to start the new video
-            self.send_control_signal("start", self.selected_video)
-
-            # Display the video screen and start streaming
+            # Send the display size, then start the new video, unless its beginning can be played from the cache
+            self.send_viewport()
+            self.is_paused = False
             self.video_screen()
+            if self.server_state != "stopped":
+                self.send_control_signal("stop", self.selected_video)
+                self.server_state = "stopped"
+            if not self.play_from_cache(0.0):
+                self.local_playback = False
+                self.seek_pending = False
+                self.resume_after_pts = None
+                self.start_stream()
 
     def pause_button_action(self):
         """Pause or resume the video."""
         if self.selected_video:
+            # While frames are played from the cache the server is already paused, and stays so
             if self.is_paused:
-                self.send_control_signal("resume", self.selected_video)
+                if not self.local_playback:
+                    self.send_control_signal("resume", self.selected_video)
+                    self.server_state = "streaming"
                 self.pause_button.config(text="Pause")
                 self.is_paused = False
             else:
-                self.send_control_signal("pause", self.selected_video)
+                if not self.local_playback:
+                    self.send_control_signal("pause", self.selected_video)
+                    self.server_state = "paused"
                 self.pause_button.config(text="Resume")
                 self.is_paused = True
                 
@@ -252,63 +600,239 @@ class VideoPlayerUI:
 
 
     def receive_stream(self):
-        """Receive video frames from the server and display them on the canvas."""
+        """
+        Network reader: receive messages from the server for the life of the connection
+        and hand video frames to the decode workers.
+        """
+        # Frames are received with recv_into straight into pooled buffers, released once decoded
+        reader = MessageReader(self.client_socket, self.buffer_pool)
         try:
-            while self.is_streaming:
-                # Receive the frame size (4 bytes)
-                frame_size_data = self.client_socket.recv(4)
-                if len(frame_size_data) < 4:
-                    print("Error: Incomplete frame size received.")
+            while True:
+                # Receive the next message from the server
+                message = reader.read()
+                if message is None:
+                    print("Error: Connection closed by the server.")
                     break
 
-                frame_size = int.from_bytes(frame_size_data, 'big')
-
-                # Receive the actual frame data based on the frame size
-                frame_data = b''
-                while len(frame_data) < frame_size:
-                    packet = self.client_socket.recv(frame_size - len(frame_data))
-                    if not packet:
-                        print("Error: Connection closed before frame was fully received.")
-                        return
-                    frame_data += packet
-
-                # Decode and process the frame
-                frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-                if frame is not None:
-                    # Resize the frame to fit the canvas
-                    frame_height, frame_width = frame.shape[:2]
-                    canvas_width = self.video_canvas.winfo_width()
-                    canvas_height = self.video_canvas.winfo_height()
-
-                    scale = min(canvas_width / frame_width, canvas_height / frame_height)
-                    new_width = int(frame_width * scale)
-                    new_height = int(frame_height * scale)
-                    frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
-
-                    # Convert the frame to RGB format for Tkinter
-                    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    img = Image.fromarray(frame_rgb)
-                    img_tk = ImageTk.PhotoImage(img)
-
-                    # Update the canvas with the new frame
-                    self.video_canvas.create_image(
-                        canvas_width // 2, canvas_height // 2, image=img_tk, anchor="center"
-                )
-                    self.video_canvas.image = img_tk  # Keep a reference to avoid garbage collection
+                msg_type, payload = message
+                if msg_type in (MSG_FRAME, MSG_TILES):
+                    self.receive_frame(msg_type, payload)
+                elif msg_type == MSG_PREVIEW:
+                    self.decode_pool.submit(self.decode_preview_frame, payload)
+                else:
+                    if msg_type == MSG_STATS:
+                        print(f"Stream stats: {decode_json(payload)}")
+                    elif msg_type == MSG_THUMBNAIL:
+                        self.cache_thumbnail(payload)
+                    elif msg_type == MSG_SEEKED:
+                        self.on_seeked(decode_json(payload))
+                    self.buffer_pool.release(payload)
         except Exception as e:
             print(f"Error receiving video frames: {e}")
         finally:
             self.is_streaming = False
             print("Stopped receiving video frames.")
 
+    def receive_datagrams(self):
+        """
+        UDP reader: put frame messages back together from their datagrams (see datagram.py)
+        and hand them on like frames received on the connection.
+        """
+        server_host = self.client_socket.getpeername()[0]
+        buffer = bytearray(65536)  # Any datagram fits
+        view = memoryview(buffer)
+        try:
+            while True:
+                length, (host, _) = self.datagram_socket.recvfrom_into(buffer)
+                if host != server_host:
+                    continue  # Frames only come from the server
+                try:
+                    messages = self.reassembler.add(view[:length])
+                except ProtocolError as e:
+                    print(f"Error in frame datagram: {e}")
+                    continue
+                for message in messages:
+                    msg_type, payload_length = decode_header(message)
+                    self.receive_frame(msg_type, memoryview(message)[MESSAGE_HEADER.size:][:payload_length])
+        except OSError as e:
+            print(f"Error receiving frame datagrams: {e}")
+
+    def receive_frame(self, msg_type, payload):
+        """Reader threads: a frame or tiles message from the server, to be decoded and shown, or dropped."""
+        if not self.is_streaming or self.seek_pending:
+            self.buffer_pool.release(payload)
+            return
+
+        if msg_type == MSG_TILES:
+            frame_info, patches = decode_tiles(payload)
+        else:
+            frame_info, frame_data = decode_frame(payload)
+            if frame_info.sequence < self.seek_sequence:
+                # Sent as a datagram before the seek, and overtaken by the seeked message
+                del frame_data
+                self.buffer_pool.release(payload)
+                return
+            self.cache_frame(frame_info, frame_data)
+            if self.local_playback or (self.resume_after_pts is not None
+                                       and frame_info.pts <= self.resume_after_pts):
+                # Shown from the cache instead (or already)
+                del frame_data
+                self.buffer_pool.release(payload)
+                return
+            self.resume_after_pts = None
+
+        # The server adapts quality to the connection; note when it changes level
+        if frame_info.level != self.stream_level:
+            self.stream_level = frame_info.level
+            print(f"Stream quality level: {self.stream_level} (JPEG quality {frame_info.quality})")
+
+        # Follow the stream's frame rate from its timestamps, for the render loop
+        if self.last_pts is not None and 0 < frame_info.pts - self.last_pts < 1:
+            self.frame_interval = frame_info.pts - self.last_pts
+        self.last_pts = frame_info.pts
+
+        if msg_type == MSG_TILES:
+            # Patches build on each other, so they are painted here, in the order they arrive
+            frame = self.apply_tiles(frame_info, patches)
+            del patches
+            self.buffer_pool.release(payload)
+            if frame is not None:
+                self.decode_pool.submit(self.queue_frame, frame_info, frame.copy(), self.decode_generation)
+        else:
+            self.decode_pool.submit(self.decode_frame, frame_info, frame_data, payload, self.decode_generation)
+
+    def cache_frame(self, frame_info, frame_data):
+        """Reader thread: keep a copy of a received frame for replays, once it is known to be from this video."""
+        if self.frame_cache is None:
+            return
+        if not self.caching:
+            # Frames of a video stopped a moment ago can still be arriving; the new stream starts at start_pts
+            if abs(frame_info.pts - self.start_pts) > self.frame_cache.max_gap:
+                return
+            self.caching = True
+        self.frame_cache.add(self.selected_video, frame_info, bytes(frame_data))
+
+    def on_seeked(self, seeked):
+        """Reader thread: the server has moved the stream; frames from here on are from the new position."""
+        if seeked.get("id") not in (None, self.seek_id):
+            return  # Superseded by a later seek
+        if self.resume_after_pts is None:
+            self.jitter_buffer.clear()  # Unless the cache is still playing up to where the server carries on
+        self.last_pts = None
+        self.frame_buffer = None
+        self.seek_pending = False
+        self.seek_sequence = seeked.get("sequence", 0)
+        self.caching = True
+        print(f"Seeked to frame {seeked['frame']} ({seeked['pts']:.2f} s)")
+
+    def apply_tiles(self, frame_info, patches):
+        """
+        Reader thread: paint a delta frame's JPEG patches onto the persistent frame buffer.
+        Returns the updated frame, or None until a full frame has arrived to paint onto.
+        """
+        size = (frame_info.height, frame_info.width)
+        for x, y, width, height, data in patches:
+            full = (x, y, width, height) == (0, 0, frame_info.width, frame_info.height)
+            if not full and (self.frame_buffer is None or self.frame_buffer.shape[:2] != size):
+                continue  # Nothing to patch yet; wait for the next full frame
+            tile = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if tile is None:
+                continue
+            if full:
+                self.frame_buffer = tile
+            else:
+                self.frame_buffer[y:y + height, x:x + width] = tile
+        if self.frame_buffer is None or self.frame_buffer.shape[:2] != size:
+            return None
+        return self.frame_buffer
+
+    def decode_frame(self, frame_info, frame_data, payload, generation):
+        """Decode worker: turn JPEG data (received, or from the cache) into an image and queue it for display."""
+        try:
+            frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
+            del frame_data
+            if payload is not None:
+                self.buffer_pool.release(payload)  # The receive buffer can be reused now
+
+            if frame is not None:
+                self.queue_frame(frame_info, frame, generation)
+        except Exception as e:
+            print(f"Error decoding video frame: {e}")
+
+    def queue_frame(self, frame_info, frame, generation):
+        """Decode worker: size a decoded frame for the canvas and put it in the jitter buffer."""
+        try:
+            if not self.is_streaming or generation != self.decode_generation:
+                return
+
+            # Resize the frame to fit the canvas
+            frame_height, frame_width = frame.shape[:2]
+            canvas_width, canvas_height = self.canvas_size
+
+            scale = min(canvas_width / frame_width, canvas_height / frame_height)
+            new_width = max(int(frame_width * scale), 1)
+            new_height = max(int(frame_height * scale), 1)
+            frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+            # Convert the frame to RGB format for Tkinter
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            self.jitter_buffer.push(frame_info.pts, (frame_info.pts, Image.fromarray(frame_rgb)))
+        except Exception as e:
+            print(f"Error preparing video frame: {e}")
+
+    def render_next_frame(self):
+        """Show the frame that is due now. Runs on the Tk main loop at the stream's frame rate."""
+        if not self.is_streaming:
+            self.render_job = None
+            return
+
+        if self.cache_run_end is not None:
+            # The cache player has run out: have the server carry on from the end of its run
+            generation, end_pts = self.cache_run_end
+            self.cache_run_end = None
+            if generation == self.decode_generation:
+                self.request_stream_from(end_pts + self.frame_interval, after_pts=end_pts)
+
+        due = self.jitter_buffer.pop_due()
+        if due is not None:
+            pts, img = due
+            if self.photo_image is not None and (self.photo_image.width(), self.photo_image.height()) == img.size:
+                # Same size as the last frame: draw into the existing image instead of creating one
+                self.photo_image.paste(img)
+            else:
+                self.photo_image = ImageTk.PhotoImage(img)  # Kept referenced to avoid garbage collection
+                self.video_canvas.itemconfig(self.canvas_image, image=self.photo_image)
 
+            canvas_width, canvas_height = self.canvas_size
+            self.video_canvas.coords(self.canvas_image, canvas_width // 2, canvas_height // 2)
 
+            if not self.scrubbing:
+                self.scrub_position.set(pts)
+            if self.seek_requested_at is not None:
+                print(f"Seek: first frame shown {(time.monotonic() - self.seek_requested_at) * 1000:.1f} ms "
+                      f"after the request")
+                self.seek_requested_at = None
 
+        self.render_job = self.window.after(max(int(self.frame_interval * 1000), 1), self.render_next_frame)
+
+    def stop_rendering(self):
+        """Stop the render loop and forget any buffered frames."""
+        self.is_streaming = False
+        self.local_playback = False
+        self.decode_generation += 1  # Also stops the cache player
+        if self.render_job is not None:
+            self.window.after_cancel(self.render_job)
+            self.render_job = None
+        self.jitter_buffer.clear()
 
     def receive_metadata(self):
         """Receive video metadata from the server."""
-        data = self.client_socket.recv(4096).decode()
-        return json.loads(data)
+        message = read_message(self.client_socket)
+        if message is not None:
+            message = decompress(*message)  # Large catalogs are sent compressed
+        if message is None or message[0] != MSG_CATALOG:
+            raise ProtocolError("Expected the video catalog from the server")
+        return decode_json(message[1])
 
 
 def connect_to_server():
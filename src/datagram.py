@@ -0,0 +1,297 @@
+"""
+UDP transport for the frame path.
+
+Over TCP a single lost packet holds up every frame behind it until it has been
+retransmitted. In UDP mode frame messages are sent as datagrams instead, while the
+catalog, control signals and everything else stay on the TCP connection. Each
+message is cut into fragments of at most FRAGMENT_SIZE bytes, and every FEC_GROUP
+fragments are followed by a parity fragment, their XOR, from which any one missing
+fragment of the group is rebuilt. The receiver puts messages back together as their
+fragments arrive and gives up on one it cannot complete as soon as a later message
+is complete, or once it is older than REASSEMBLY_TIMEOUT: a late frame is better
+skipped than waited for.
+
+Every datagram starts with a header (protocol version, message ID, message length,
+fragment index, number of data fragments, fragment size and FEC group size),
+followed by the fragment's bytes. Data fragments have indexes 0 to count - 1 and all
+but the last are full size; the parity fragment of group g has index count + g.
+
+Loopback never loses a datagram; a LossInjector drops them on purpose, to see how
+the transport copes.
+"""
+import random
+import socket
+import struct
+import time
+import numpy as np
+from protocol import PROTOCOL_VERSION, ProtocolError
+
+# Fragment bytes per datagram: with the headers, fits an Ethernet MTU with room for tunnels
+FRAGMENT_SIZE = 1200
+
+# Data fragments covered by each parity fragment (0: no parity); more costs less bandwidth but recovers less
+FEC_GROUP = 4
+
+# Seconds a partly received message is kept waiting for its missing fragments
+REASSEMBLY_TIMEOUT = 0.25
+
+# Socket buffers for a burst of datagrams: a whole frame is sent at once
+SOCKET_BUFFER_BYTES = 4 * 1024 * 1024
+
+# version, message ID, message length, fragment index, data fragment count, fragment size, FEC group size
+DATAGRAM_HEADER = struct.Struct("!BIIHHHB")
+
+# Largest datagram a sender makes
+MAX_DATAGRAM = DATAGRAM_HEADER.size + FRAGMENT_SIZE
+
+
+def new_reception_stats():
+    """Per-session datagram loss and recovery counters, kept by the receiver."""
+    return {
+        "datagrams_received": 0,
+        "datagrams_lost": 0,        # Missing when their message was complete (and rebuilt) or given up
+        "fragments_recovered": 0,   # Rebuilt from parity
+        "frames_completed": 0,
+        "frames_incomplete": 0,     # Given up on, or never seen: not complete by the time a later frame was
+    }
+
+
+class LossInjector:
+    """
+    Decides which datagrams to drop, as a lossy network would. loss is the fraction dropped;
+    with burst above 1 they are dropped in runs of that many on average (a two-state model),
+    which single parity cannot recover from.
+    """
+
+    def __init__(self, loss, burst=1.0, seed=None):
+        self.loss = loss
+        self.burst = max(burst, 1.0)
+        self.random = random.Random(seed)
+        self.losing = False
+
+    def drop(self):
+        if self.losing:
+            self.losing = self.random.random() < 1 - 1 / self.burst
+        elif self.loss < 1:
+            # Runs start at the rate that keeps the fraction dropped at loss
+            self.losing = self.random.random() < self.loss / (self.burst * (1 - self.loss))
+        else:
+            self.losing = True
+        return self.losing
+
+
+def fragment(buffers, message_id, fragment_size=FRAGMENT_SIZE, fec_group=FEC_GROUP):
+    """The datagrams carrying a message made up of the given buffers, parity fragments included."""
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    length = sum(view.nbytes for view in views)
+    count = max(-(-length // fragment_size), 1)
+    groups = -(-count // fec_group) if fec_group else 0
+
+    # Zero-padded to whole groups of whole fragments, so the parity of every group is one XOR
+    data = np.zeros(((groups * fec_group if fec_group else count), fragment_size), np.uint8)
+    flat = data.reshape(-1)
+    offset = 0
+    for view in views:
+        flat[offset:offset + view.nbytes] = np.frombuffer(view, np.uint8)
+        offset += view.nbytes
+
+    datagrams = []
+    for index in range(count):
+        header = DATAGRAM_HEADER.pack(PROTOCOL_VERSION, message_id, length, index, count, fragment_size, fec_group)
+        datagrams.append(header + flat[index * fragment_size:min((index + 1) * fragment_size, length)].tobytes())
+    if groups:
+        parity = np.bitwise_xor.reduce(data.reshape(groups, fec_group, fragment_size), axis=1)
+        for group in range(groups):
+            header = DATAGRAM_HEADER.pack(PROTOCOL_VERSION, message_id, length, count + group, count, fragment_size,
+                                          fec_group)
+            datagrams.append(header + parity[group].tobytes())
+    return datagrams
+
+
+class DatagramSender:
+    """
+    Sends messages as datagrams to one client, from a socket of its own. Sends never block:
+    a datagram that does not fit in the socket buffer is lost like any other.
+    """
+
+    def __init__(self, address, stats, loss=None, fragment_size=FRAGMENT_SIZE, fec_group=FEC_GROUP):
+        family, _, _, _, address = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+        self.sock.connect(address)
+        self.sock.setblocking(False)
+        self.stats = stats    # Session stats, for the datagrams sent and dropped
+        self.loss = loss      # LossInjector, or None
+        self.fragment_size = fragment_size
+        self.fec_group = fec_group
+        self.message_id = 0
+
+    def send(self, buffers):
+        """Send one message, made up of the given buffers. Returns the bytes sent, headers included."""
+        datagrams = fragment(buffers, self.message_id, self.fragment_size, self.fec_group)
+        self.message_id = (self.message_id + 1) & 0xFFFFFFFF
+        sent = 0
+        for datagram in datagrams:
+            if self.loss is not None and self.loss.drop():
+                self.stats["datagrams_dropped"] += 1
+                continue
+            try:
+                sent += self.sock.send(datagram)
+                self.stats["datagrams_sent"] += 1
+            except OSError:
+                # Buffer full, or nobody listening on the client's port (yet)
+                self.stats["datagrams_dropped"] += 1
+        return sent
+
+    def close(self):
+        self.sock.close()
+
+
+class PartialMessage:
+    """A message some of whose fragments have arrived."""
+
+    def __init__(self, length, count, fec_group, fragment_size):
+        self.data = bytearray(length)
+        self.count = count
+        self.fec_group = fec_group
+        self.fragment_size = fragment_size
+        self.fragments = set()   # Indexes of the data fragments in place
+        self.parity = {}         # Group -> parity fragment
+        self.received = 0
+        self.recovered = 0       # Data fragments rebuilt from parity
+        self.first_seen = time.monotonic()
+
+    def add(self, index, payload):
+        """Put a fragment in place. Returns how many fragments were rebuilt from parity as a result."""
+        if index in self.fragments or index - self.count in self.parity:
+            return 0  # Duplicate
+        self.received += 1
+        if index < self.count:
+            start = index * self.fragment_size
+            self.data[start:start + len(payload)] = payload
+            self.fragments.add(index)
+            group = index // self.fec_group if self.fec_group else None
+        else:
+            group = index - self.count
+            self.parity[group] = bytes(payload)
+        return self.recover(group) if group is not None else 0
+
+    def recover(self, group):
+        """Rebuild the one missing data fragment of a group, if only one is missing and its parity is here."""
+        members = range(group * self.fec_group, min((group + 1) * self.fec_group, self.count))
+        missing = [index for index in members if index not in self.fragments]
+        if len(missing) != 1 or group not in self.parity:
+            return 0
+
+        rebuilt = np.frombuffer(self.parity[group], np.uint8).copy()
+        for index in members:
+            if index != missing[0]:
+                fragment_data = self.fragment_bytes(index)
+                rebuilt[:len(fragment_data)] ^= fragment_data
+        start = missing[0] * self.fragment_size
+        end = min(start + self.fragment_size, len(self.data))
+        self.data[start:end] = rebuilt[:end - start].tobytes()
+        self.fragments.add(missing[0])
+        self.recovered += 1
+        return 1
+
+    def fragment_bytes(self, index):
+        start = index * self.fragment_size
+        return np.frombuffer(self.data, np.uint8, min(self.fragment_size, len(self.data) - start), start)
+
+    def complete(self):
+        return len(self.fragments) == self.count
+
+    def expected(self):
+        """Datagrams the sender made for this message."""
+        return self.count + (-(-self.count // self.fec_group) if self.fec_group else 0)
+
+
+class Reassembler:
+    """
+    Puts messages back together from their datagrams, in whatever order these arrive. Once a
+    message is complete, or one has waited REASSEMBLY_TIMEOUT, every earlier message that is
+    not complete is given up and its late datagrams are ignored. Fed by a single reader.
+    """
+
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT):
+        self.timeout = timeout
+        self.partial = {}      # Message ID -> PartialMessage, all of them after latest
+        self.latest = None     # ID of the newest message complete or given up
+        self.stats = new_reception_stats()
+
+    def add(self, datagram):
+        """Take one datagram. Returns the messages it completes (none or one), as bytearrays."""
+        if len(datagram) < DATAGRAM_HEADER.size:
+            raise ProtocolError("Datagram too short")
+        version, message_id, length, index, count, fragment_size, fec_group = DATAGRAM_HEADER.unpack_from(datagram)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        groups = -(-count // fec_group) if fec_group else 0
+        if (not fragment_size or index >= count + groups
+                or not (count - 1) * fragment_size < length <= count * fragment_size):
+            raise ProtocolError("Malformed datagram header")
+        self.stats["datagrams_received"] += 1
+        self.expire()
+
+        if self.latest is not None and not self.is_older(self.latest, message_id):
+            return []  # Part of a message already complete or given up
+
+        message = self.partial.get(message_id)
+        if message is None:
+            message = self.partial[message_id] = PartialMessage(length, count, fec_group, fragment_size)
+        self.stats["fragments_recovered"] += message.add(index, memoryview(datagram)[DATAGRAM_HEADER.size:])
+        if not message.complete():
+            return []
+
+        self.advance(message_id)
+        self.stats["frames_completed"] += 1
+        return [message.data]
+
+    def expire(self):
+        """Give up on the messages that have waited too long for their missing fragments."""
+        deadline = time.monotonic() - self.timeout
+        expired = [message_id for message_id, message in self.partial.items() if message.first_seen < deadline]
+        if expired:
+            newest = expired[0]
+            for message_id in expired:
+                if self.is_older(newest, message_id):
+                    newest = message_id
+            self.advance(newest)
+            self.stats["frames_incomplete"] += 1
+
+    def advance(self, message_id):
+        """Move past the given message, giving up on every earlier one that is not complete."""
+        message = self.partial.pop(message_id)
+        self.count_lost(message)
+        for other in [other for other in self.partial if self.is_older(other, message_id)]:
+            self.count_lost(self.partial.pop(other))
+            if self.latest is None:
+                self.stats["frames_incomplete"] += 1
+        if self.latest is not None:
+            # Those given up on just now, and those none of whose datagrams arrived
+            self.stats["frames_incomplete"] += (message_id - self.latest - 1) & 0xFFFFFFFF
+        self.latest = message_id
+
+    def count_lost(self, message):
+        # Parity that was not needed is not waited for, so a complete message only lost what was rebuilt
+        self.stats["datagrams_lost"] += (message.recovered if message.complete()
+                                         else max(message.expected() - message.received, 0))
+
+    def reset(self):
+        """Forget every message, e.g. for a new sender whose message IDs start over."""
+        self.partial.clear()
+        self.latest = None
+
+    @staticmethod
+    def is_older(message_id, other):
+        """Whether a message ID comes before another, allowing for wrap-around."""
+        return 0 < (other - message_id) & 0xFFFFFFFF < 0x80000000
+
+
+def open_receiver(host="0.0.0.0"):
+    """A UDP socket for frames, on a port of the system's choosing, with room for bursts."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+    sock.bind((host, 0))
+    return sock
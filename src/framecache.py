@@ -0,0 +1,66 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+# Received frames kept, in bytes of JPEG data
+FRAME_CACHE_BYTES = 64 * 1024 * 1024
+
+# Largest gap between two cached frames still played as one run, in seconds; the server
+# skips frames to keep up, so consecutive frames are not always one frame interval apart
+MAX_GAP = 0.25
+
+
+class FrameCache:
+    """
+    Ring cache of received JPEG frames, by video and presentation timestamp, within a byte budget.
+    Frames are kept as the encoded bytes the server sent, a small fraction of their decoded size,
+    and the oldest received are evicted first. A run of cached frames can be played again
+    (rewind, replay, short seeks back) without asking the server for it.
+    """
+
+    def __init__(self, budget=FRAME_CACHE_BYTES, max_gap=MAX_GAP):
+        self.budget = budget
+        self.max_gap = max_gap
+        self.entries = OrderedDict()  # (video, pts) -> (frame info, JPEG bytes), oldest received first
+        self.timestamps = {}          # video -> sorted pts of its cached frames
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, video, frame_info, data):
+        """Cache a received frame, replacing any with the same timestamp, and evict down to the budget."""
+        key = (video, frame_info.pts)
+        with self.lock:
+            replaced = self.entries.pop(key, None)
+            if replaced is not None:
+                self.size -= len(replaced[1])
+            else:
+                bisect.insort(self.timestamps.setdefault(video, []), frame_info.pts)
+            self.entries[key] = (frame_info, data)
+            self.size += len(data)
+
+            while self.size > self.budget:
+                (evicted_video, pts), (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                timestamps = self.timestamps[evicted_video]
+                del timestamps[bisect.bisect_left(timestamps, pts)]
+
+    def run_from(self, video, pts):
+        """
+        The cached frames, as (frame info, JPEG bytes), from the one showing at pts on for as
+        long as they follow each other without a gap. Empty if pts is not cached.
+        """
+        with self.lock:
+            timestamps = self.timestamps.get(video, [])
+            first = bisect.bisect_right(timestamps, pts) - 1
+            if first < 0 or pts - timestamps[first] > self.max_gap:
+                return []
+            last = first
+            while last + 1 < len(timestamps) and timestamps[last + 1] - timestamps[last] <= self.max_gap:
+                last += 1
+            return [self.entries[video, timestamp] for timestamp in timestamps[first:last + 1]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.timestamps.clear()
+            self.size = 0
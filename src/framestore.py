@@ -0,0 +1,196 @@
+import argparse
+import array
+import json
+import mmap
+import os
+import cv2
+from adaptive import DEFAULT_LADDER, parse_ladder
+
+# Where pre-encoded frame stores live, next to the videos and thumbnails directories
+STORE_DIR = os.path.join(os.path.dirname(__file__), "../framestore")
+VIDEO_DIR = os.path.join(os.path.dirname(__file__), "../videos")
+
+# Variants to pre-encode when none are given on the command line: the whole quality ladder
+DEFAULT_LEVELS = DEFAULT_LADDER
+
+
+def asset_paths(store_dir, video_path, quality, scale=1.0):
+    """Paths of the frames file, offset index and info file for one (video, quality, scale) variant."""
+    variant = f"q{quality}" if scale == 1.0 else f"q{quality}s{round(scale * 100)}"
+    base = os.path.join(store_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}.{variant}")
+    return base + ".frames", base + ".idx", base + ".json"
+
+
+def source_signature(video_path):
+    """The source file's mtime and size, used to tell when stored assets are stale."""
+    stat = os.stat(video_path)
+    return {"source_mtime": stat.st_mtime_ns, "source_size": stat.st_size}
+
+
+def remove_assets(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def ingest_video(video_path, quality, scale=1.0, store_dir=STORE_DIR):
+    """
+    Transcode a video once into a contiguous file of JPEG frames plus an offset index.
+    The info file is written last, so a variant only counts as stored once it is complete.
+    """
+    frames_path, index_path, info_path = asset_paths(store_dir, video_path, quality, scale)
+    os.makedirs(store_dir, exist_ok=True)
+    remove_assets((info_path,))
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Unable to open video '{video_path}'")
+        return False
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    width = height = 0
+    signature = source_signature(video_path)
+
+    # offsets[i] is where frame i starts; the last entry is the end of the final frame
+    offsets = array.array('Q', [0])
+    try:
+        with open(frames_path + ".tmp", 'wb') as frames_file:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if scale != 1.0:
+                    frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                height, width = frame.shape[:2]
+                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                frames_file.write(buffer)
+                offsets.append(offsets[-1] + len(buffer))
+    finally:
+        cap.release()
+
+    with open(index_path + ".tmp", 'wb') as index_file:
+        offsets.tofile(index_file)
+
+    os.replace(frames_path + ".tmp", frames_path)
+    os.replace(index_path + ".tmp", index_path)
+
+    info = dict(signature, quality=quality, scale=scale, fps=fps, width=width, height=height,
+                frame_count=len(offsets) - 1)
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=4)
+
+    print(f"Stored {info['frame_count']} frames of {video_path} at quality {quality}, scale {scale}")
+    return True
+
+
+class StoredVideo:
+    """A pre-encoded variant of a video, memory-mapped for serving without OpenCV."""
+
+    def __init__(self, frames_path, offsets, info):
+        self.offsets = offsets
+        self.fps = info["fps"]
+        self.frame_count = info["frame_count"]
+        self.quality = info["quality"]
+        self.scale = info.get("scale", 1.0)
+        self.width = info.get("width", 0)
+        self.height = info.get("height", 0)
+
+        self.file = open(frames_path, 'rb')
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+        self.view = memoryview(self.data)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def frame_span(self, index):
+        """(offset, length) of a frame within the frames file."""
+        start = self.offsets[index]
+        return start, self.offsets[index + 1] - start
+
+    def frame(self, index):
+        """A zero-copy view of one encoded frame."""
+        return self.view[self.offsets[index]:self.offsets[index + 1]]
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # A frame is still queued in a socket buffer; the mapping goes when it does
+                pass
+        self.file.close()
+
+
+def open_stored(video_path, quality, scale=1.0, store_dir=STORE_DIR):
+    """
+    Open the stored variant of a video, or return None if there is none.
+    Variants whose source has changed since ingest are deleted.
+    """
+    paths = asset_paths(store_dir, video_path, quality, scale)
+    frames_path, index_path, info_path = paths
+    if not os.path.exists(info_path):
+        return None
+
+    try:
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+
+        signature = source_signature(video_path)
+        if any(info.get(key) != value for key, value in signature.items()):
+            print(f"Stored frames for {video_path} are stale, removing them.")
+            remove_assets(paths)
+            return None
+
+        offsets = array.array('Q')
+        with open(index_path, 'rb') as index_file:
+            offsets.frombytes(index_file.read())
+        if len(offsets) != info["frame_count"] + 1:
+            print(f"Warning: Stored frame index for {video_path} is damaged, ignoring it.")
+            return None
+
+        return StoredVideo(frames_path, offsets, info)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Unable to open stored frames for {video_path}: {e}")
+        return None
+
+
+def send_stored_frame(sock, stored, index):
+    """Send one stored frame straight from the page cache with sendfile, where available."""
+    offset, length = stored.frame_span(index)
+    if not hasattr(os, "sendfile"):
+        sock.sendall(stored.frame(index))
+        return
+
+    while length:
+        sent = os.sendfile(sock.fileno(), stored.fileno(), offset, length)
+        if sent == 0:
+            raise ConnectionError("Socket closed during sendfile")
+        offset += sent
+        length -= sent
+
+
+def ingest_all(video_dir=VIDEO_DIR, levels=DEFAULT_LEVELS, store_dir=STORE_DIR, force=False):
+    """Pre-encode every video in the directory, skipping variants that are already up to date."""
+    videos = [f for f in os.listdir(video_dir) if f.endswith(('.mp4', '.avi', '.mkv'))]
+    for video in videos:
+        video_path = os.path.join(video_dir, video)
+        for quality, scale in levels:
+            stored = None if force else open_stored(video_path, quality, scale, store_dir)
+            if stored is not None:
+                stored.close()
+                continue
+            ingest_video(video_path, quality, scale, store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-encode videos into frame stores for the server")
+    parser.add_argument("--video-dir", default=VIDEO_DIR)
+    parser.add_argument("--store-dir", default=STORE_DIR)
+    parser.add_argument("--ladder", type=parse_ladder, default=DEFAULT_LEVELS,
+                        help='variants to store as "quality:scale,..." (default: the server\'s quality ladder)')
+    parser.add_argument("--force", action="store_true", help="re-encode even if up to date")
+    args = parser.parse_args()
+
+    ingest_all(args.video_dir, args.ladder, args.store_dir, args.force)
@@ -0,0 +1,432 @@
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from metrics import StageTimings
+from pacing import FramePacer, new_session_stats
+from pipeline import FramePipeline
+from tiles import TileEncoder, merge_patches
+from warmstart import CapturePool, FirstFrames, source_key
+
+log = logging.getLogger(__name__)
+
+# Threads encoding JPEGs for every hub; OpenCV releases the GIL while it encodes
+ENCODE_THREADS = os.cpu_count() or 4
+
+# One encoded frame as handed to subscribers: JPEG data plus what the frame header needs.
+# In delta mode data is None and patches holds (x, y, width, height, JPEG buffer) tuples instead.
+EncodedFrame = namedtuple("EncodedFrame", "data index pts quality width height patches", defaults=(None,))
+
+
+class Subscription:
+    """
+    A single client's handle on a broadcast hub.
+    Holds only the most recent encoded frame, so a slow client never stalls the hub.
+    The client's own condition variable is used, letting one wait cover new frames
+    as well as the client's pause/stop signals.
+    """
+
+    def __init__(self, condition, stats=None):
+        self.hub = None          # Set by the registry on subscribe
+        self.condition = condition
+        self.frame = None        # Latest EncodedFrame not yet taken by the client
+        self.ended = False       # Set once the hub has no more frames to give
+        self.paused = False      # Paused subscribers do not keep the hub running
+        self.stats = stats if stats is not None else new_session_stats()
+
+    def push(self, frame):
+        """Store a new frame, replacing any frame the client has not taken yet."""
+        with self.condition:
+            self._store(frame)
+            self.condition.notify_all()
+
+    def _store(self, frame):
+        if self.frame is not None:
+            self.stats["frames_dropped"] += 1
+            if frame.patches is not None and self.frame.patches is not None:
+                # A delta frame only makes sense on top of the one it replaces, so keep both sets of patches
+                frame = frame._replace(patches=merge_patches(self.frame.patches, frame.patches,
+                                                             frame.width, frame.height))
+        self.frame = frame
+
+    def end(self):
+        """Mark the subscription as finished and wake the client."""
+        with self.condition:
+            self.ended = True
+            self.condition.notify_all()
+
+    def ready(self):
+        """Whether a frame (or the end of the stream) is waiting. Call with the condition held."""
+        return self.frame is not None or self.ended
+
+    def take(self):
+        """Take the pending frame, or None at the end of the stream. Call with the condition held."""
+        frame, self.frame = self.frame, None
+        return frame
+
+    def next_index(self):
+        """Index of the next frame the client would get from its hub. Call with the condition held."""
+        return self.frame.index if self.frame is not None else self.hub.position
+
+
+class AsyncSubscription(Subscription):
+    """
+    Subscription for a client served from an asyncio event loop.
+    Frames arrive on hub threads and are handed over to the loop, which
+    then sets the client's wake-up event.
+    """
+
+    def __init__(self, loop, wakeup, stats=None):
+        super().__init__(None, stats)
+        self.loop = loop
+        self.wakeup = wakeup
+
+    def push(self, frame):
+        self.loop.call_soon_threadsafe(self._deliver, frame)
+
+    def end(self):
+        self.loop.call_soon_threadsafe(self._finish)
+
+    def _deliver(self, frame):
+        self._store(frame)
+        self.wakeup.set()
+
+    def _finish(self):
+        self.ended = True
+        self.wakeup.set()
+
+
+class BroadcastHub:
+    """
+    Runs a single decode + encode pipeline for one (video, quality, scale, viewport) variant
+    and fans every encoded frame out to all subscribed clients. Frames are decoded ahead of
+    playback and encoded on the registry's pool (see pipeline.py), so only publishing waits
+    for the clock. In delta mode frames are encoded as patches of the tiles that changed,
+    rather than as whole JPEGs; each delta depends on the one before and a joining viewer
+    needs a full frame next, so those are encoded in order as they are published.
+
+    A hub given the cached first frames of its variant (see warmstart.py) publishes those
+    while its pipeline starts up from where they end; a hub playing a popular variant from
+    the start records them for the next one.
+    """
+
+    def __init__(self, registry, key, cap, quality, scale, position=0, viewport=None, delta=False, source=None,
+                 first_frames=(), max_fps=None):
+        self.registry = registry
+        self.key = key
+        self.source = source      # The video file's identity, under which its capture goes back to the pool
+        self.variant = (source, quality, scale, viewport)
+        self.cap = cap
+        self.quality = quality
+        self.scale = scale
+        self.viewport = viewport  # (width, height) the clients display at, or None for full size
+        self.timeline = key[4]    # The shared timeline, or one private to a client that seeked
+        self.tile_encoder = TileEncoder() if delta else None
+        self.position = position  # Index of the next frame to be published
+        self.pacer = FramePacer(cap.get(cv2.CAP_PROP_FPS), position)
+        self.frame_interval = self.pacer.frame_interval
+        # Below the source's frame rate (previews), only every stride-th frame is decoded and published
+        self.stride = max(round(self.pacer.fps / max_fps), 1) if max_fps else 1
+        self.first_frames = deque(first_frames)  # Cached frames to publish before the pipeline's
+        # The cached run can have gaps (frames skipped to catch up), so the pipeline starts after its last frame
+        start = first_frames[-1].index + 1 if first_frames else position
+        self.pipeline = FramePipeline(cap, start, None if delta else self.encode, registry.encoder(),
+                                      self.skip_late_frames, registry.timings)
+        self.recording = None     # First frames being recorded for the cache
+        if (position == 0 and not first_frames and not delta and self.stride == 1
+                and registry.first_frames.wants(self.variant)):
+            self.recording = []
+        self.idle = False         # Set while every subscriber is paused
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def has_active_subscribers(self):
+        with self.lock:
+            return any(not sub.paused for sub in self.subscribers)
+
+    def publish(self, frame):
+        """Hand an encoded frame to every subscriber."""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            sub.push(frame)
+
+    def next_delay(self):
+        """
+        Seconds to wait before the next frame is due, or None while every viewer is paused.
+        Playback is re-anchored to the clock when a viewer comes back.
+        """
+        if not self.has_active_subscribers():
+            self.idle = True
+            return None
+        if self.idle:
+            self.pacer.reset(self.position)
+            self.idle = False
+        return max(self.pacer.delay(self.position), 0)
+
+    def skip_late_frames(self, position):
+        """
+        Decode thread: skip, without decoding, frames from position on whose deadline has already
+        passed, and those between the stride's frames.
+        """
+        behind = self.pacer.frames_behind(position)
+        target = -(-(position + behind) // self.stride) * self.stride
+        skipped = 0
+        while position + skipped < target and self.cap.grab():
+            skipped += 1
+
+        # Frames skipped for the stride were never going to be published
+        dropped = (position + skipped) // self.stride - -(-position // self.stride)
+        if dropped > 0:
+            with self.lock:
+                for sub in self.subscribers:
+                    if not sub.paused:
+                        sub.stats["frames_dropped"] += dropped
+        return skipped
+
+    def fit(self, frame):
+        """Downscale before encoding: to fit the viewers' display, then by the ladder level's scale."""
+        factor = fit_scale(frame.shape[1], frame.shape[0], self.viewport) * self.scale
+        if factor < 1.0:
+            frame = cv2.resize(frame, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def encode(self, frame, frame_index):
+        """Encode pool: scale and JPEG-encode one decoded frame."""
+        encode_start = time.monotonic()
+        frame = self.fit(frame)
+        height, width = frame.shape[:2]
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        self.registry.timings.observe("encode", time.monotonic() - encode_start)
+        # The NumPy buffer itself is published and sent; it is never copied into bytes
+        return EncodedFrame(buffer, frame_index, frame_index * self.frame_interval, self.quality, width, height)
+
+    def step(self):
+        """
+        Publish the next frame: a cached one, or the pipeline's once it has it decoded and encoded.
+        Returns False at the end of the video.
+        """
+        if self.first_frames:
+            frame = self.first_frames.popleft()
+            self.position = frame.index + 1
+            self.publish(frame)
+            return True
+
+        item = self.pipeline.next()
+        if item is None:
+            return False
+        frame_index, frame = item
+        self.position = frame_index + self.stride
+
+        if self.tile_encoder is not None:
+            encode_start = time.monotonic()
+            frame = self.fit(frame)
+            height, width = frame.shape[:2]
+            patches = self.tile_encoder.encode(frame, self.quality)
+            self.registry.timings.observe("encode", time.monotonic() - encode_start)
+            frame = EncodedFrame(None, frame_index, frame_index * self.frame_interval, self.quality, width, height,
+                                 patches)
+        elif self.recording is not None:
+            self.record(frame)
+        self.publish(frame)
+        return True
+
+    def record(self, frame):
+        """Keep the frames of the first seconds for the cache, gaps from frames skipped to catch up and all."""
+        self.recording.append(frame)
+        if (frame.index + 1) * self.frame_interval >= self.registry.first_frames.seconds:
+            self.registry.first_frames.store(self.variant, self.recording)
+            self.recording = None
+
+    def close(self):
+        """Drain the pipeline, give the capture back to the pool and end any remaining subscriptions."""
+        self.pipeline.close()
+        self.registry.captures.release(self.source, self.cap)
+        self.registry.close_hub(self)
+
+    def run(self):
+        """Threaded driver: publish frames until the video ends or everyone leaves."""
+        self.pipeline.start()
+        try:
+            while not self.closed:
+                # Hold the video position while every viewer is paused
+                delay = self.next_delay()
+                if delay is None:
+                    time.sleep(self.frame_interval)
+                    continue
+
+                sleep_start = time.monotonic()
+                time.sleep(delay)
+                self.registry.timings.observe("pacing_sleep", time.monotonic() - sleep_start)
+                if not self.step():
+                    break
+        finally:
+            self.close()
+
+
+async def run_hub_async(hub, executor):
+    """
+    Asyncio driver: same loop as BroadcastHub.run, but waiting for the pipeline's
+    next frame is offloaded to a bounded executor and the pacing sleep is awaited.
+    """
+    loop = asyncio.get_running_loop()
+    hub.pipeline.start()
+    try:
+        while not hub.closed:
+            delay = hub.next_delay()
+            if delay is None:
+                await asyncio.sleep(hub.frame_interval)
+                continue
+
+            sleep_start = time.monotonic()
+            await asyncio.sleep(delay)
+            hub.registry.timings.observe("pacing_sleep", time.monotonic() - sleep_start)
+            if not await loop.run_in_executor(executor, hub.step):
+                break
+    finally:
+        await loop.run_in_executor(executor, hub.close)
+
+
+def fit_scale(width, height, viewport):
+    """Scale factor that fits a frame inside the viewport without enlarging it."""
+    if not viewport:
+        return 1.0
+    return min(viewport[0] / width, viewport[1] / height, 1.0)
+
+
+def start_hub_thread(hub):
+    """Default way of running a hub: on its own daemon thread."""
+    threading.Thread(target=hub.run, daemon=True).start()
+
+
+class HubRegistry:
+    """Keeps one running hub per video variant and tears it down when the last viewer leaves."""
+
+    # Timeline shared by everyone who starts a video from the beginning at the same time
+    SHARED_TIMELINE = 0
+
+    def __init__(self, start_hub=start_hub_thread, timings=None, encode_threads=ENCODE_THREADS, captures=None,
+                 first_frames=None):
+        self.start_hub = start_hub  # Called with each new hub to get it running
+        self.timings = timings if timings is not None else StageTimings()  # Decode, encode and pacing of every hub
+        self.captures = captures if captures is not None else CapturePool()
+        self.first_frames = first_frames if first_frames is not None else FirstFrames()
+        self.hubs = {}
+        self.lock = threading.Lock()
+        self.timelines = itertools.count(self.SHARED_TIMELINE + 1)
+        self.encode_threads = encode_threads
+        self.executor = None  # JPEG encode pool shared by every hub, started with the first
+
+    def encoder(self):
+        """The encode pool, or None to encode on each hub's decode thread."""
+        if self.executor is None and self.encode_threads > 1:
+            self.executor = ThreadPoolExecutor(self.encode_threads, thread_name_prefix="encode")
+        return self.executor
+
+    def new_timeline(self):
+        """A private timeline for a client away from the shared hub's position; nobody else joins its hubs."""
+        return next(self.timelines)
+
+    def subscribe(self, video_path, quality, scale, subscription, start_frame=0, viewport=None,
+                  timeline=SHARED_TIMELINE, delta=False, max_fps=None):
+        """
+        Attach a subscription to the hub for the given video variant and timeline, starting one if needed.
+        A newly started hub begins at start_frame, from a pooled capture and cached first frames
+        when there are some. A running hub is only joined if it is at start_frame, so nobody starts
+        mid-stream; otherwise the subscription gets a hub on a private timeline of its own. With
+        max_fps the hub publishes at most that many frames a second, and is joined wherever it is
+        (previews are live). Returns None if the video cannot be opened.
+        """
+        key = (video_path, quality, scale, viewport, timeline, delta, max_fps)
+        source = source_key(video_path)
+        if source is None:
+            return None
+        if start_frame == 0 and timeline == self.SHARED_TIMELINE and max_fps is None:
+            self.first_frames.request(source)
+
+        with self.lock:
+            hub = self.hubs.get(key)
+            if hub is not None:
+                if self._joinable(hub, start_frame):
+                    return self._join(hub, subscription)
+                key = self._private(key)
+
+        # Opening a container can take a while, so not with every other subscribe waiting on the lock
+        cap = self.captures.acquire(source)
+        if cap is None:
+            return None
+        # Cached first frames only make sense from the start, as whole frames, at the full rate
+        first_frames = () if start_frame or delta or max_fps else self.first_frames.get(
+            (source, quality, scale, viewport))
+
+        with self.lock:
+            hub = self.hubs.get(key)
+            if hub is not None and not self._joinable(hub, start_frame):
+                hub, key = None, self._private(key)
+            if hub is None:
+                hub = BroadcastHub(self, key, cap, quality, scale, start_frame, viewport, delta, source, first_frames,
+                                   max_fps)
+                self.hubs[key] = hub
+                self.start_hub(hub)
+                log.info("hub_started video=%s quality=%s scale=%s viewport=%s timeline=%s delta=%s max_fps=%s "
+                         "cached_frames=%d", video_path, quality, scale, viewport, key[4], delta, max_fps,
+                         len(first_frames))
+                return self._join(hub, subscription)
+            subscription = self._join(hub, subscription)
+
+        # Another subscriber started the hub meanwhile
+        self.captures.release(source, cap)
+        return subscription
+
+    def _joinable(self, hub, start_frame):
+        """Whether a viewer asking for start_frame can join a running hub."""
+        return hub.key[6] is not None or hub.position == start_frame
+
+    def _private(self, key):
+        """The key of the same video variant on a new private timeline."""
+        return key[:4] + (self.new_timeline(),) + key[5:]
+
+    def _join(self, hub, subscription):
+        """Add a subscription to a hub. Call with the registry lock held."""
+        if hub.tile_encoder is not None and hub.subscribers:
+            # The new viewer has nothing to apply patches to yet
+            hub.tile_encoder.request_keyframe()
+        subscription.hub = hub
+        with hub.lock:
+            hub.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscriber and stop its hub if nobody else is watching."""
+        hub = subscription.hub
+        with self.lock:
+            with hub.lock:
+                if subscription in hub.subscribers:
+                    hub.subscribers.remove(subscription)
+                if hub.subscribers:
+                    return
+            self._remove(hub)
+
+    def close_hub(self, hub):
+        """Called by a hub when its video ends, ending all remaining subscriptions."""
+        with self.lock:
+            self._remove(hub)
+            with hub.lock:
+                subscribers, hub.subscribers = hub.subscribers, []
+        for sub in subscribers:
+            sub.end()
+
+    def _remove(self, hub):
+        """Stop a hub and forget it. Call with the registry lock held."""
+        if not hub.closed:
+            hub.closed = True
+            hub.pipeline.stop()  # Wakes the hub if it is waiting for a frame; the hub drains it on close
+            log.info("hub_stopped video=%s quality=%s scale=%s", hub.key[0], hub.quality, hub.scale)
+        if self.hubs.get(hub.key) is hub:
+            del self.hubs[hub.key]
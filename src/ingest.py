@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+from keyframes import KEYFRAME_DIR, keyframe_path, read_mp4_keyframes, write_keyframes
+
+VIDEO_DIR = os.path.join(os.path.dirname(__file__), "../videos")
+THUMBNAIL_DIR = os.path.join(os.path.dirname(__file__), "../thumbnails")
+METADATA_FILE = os.path.join(VIDEO_DIR, "metadata.json")
+# Per-file ingest results keyed by file name, with the mtime and size they were made from
+INDEX_FILE = os.path.join(VIDEO_DIR, "index.json")
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv')
+
+# Bumped when catalog entries gain fields, so videos ingested before are processed again
+INGEST_VERSION = 3
+
+# Thumbnails are stored scaled to fit this box (width, height), so nobody resizes them later
+THUMBNAIL_SIZE = (160, 120)
+# Take the thumbnail this far into the video; the first frame is often black or a title card
+THUMBNAIL_POSITION = 0.1
+
+# Seconds between rescans in watch mode
+WATCH_INTERVAL = 5.0
+
+
+def list_videos(video_dir):
+    """{file name: (mtime, size)} for every video in the directory."""
+    videos = {}
+    with os.scandir(video_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(VIDEO_EXTENSIONS):
+                stat = entry.stat()
+                videos[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return videos
+
+
+def probe_video(video_path, thumbnail_dir=THUMBNAIL_DIR, keyframe_dir=KEYFRAME_DIR):
+    """
+    Read a video's properties and write its thumbnail and keyframe index. Runs in a worker process.
+    Returns the video's catalog entry, or None if it cannot be read.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Warning: Unable to open video '{video_path}'")
+        return None
+
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 0
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # A representative frame a little way in, falling back to the first one
+        frame = None
+        if frame_count > 1:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_count * THUMBNAIL_POSITION))
+            ret, frame = cap.read()
+            if not ret:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                frame = None
+        if frame is None:
+            ret, frame = cap.read()
+            if not ret:
+                print(f"Warning: No frames could be read from '{video_path}'")
+                return None
+    finally:
+        cap.release()
+
+    if not (width and height):
+        height, width = frame.shape[:2]
+    scale = min(THUMBNAIL_SIZE[0] / frame.shape[1], THUMBNAIL_SIZE[1] / frame.shape[0], 1.0)
+    if scale < 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # Write next to the final name and swap it in, so readers never see half a thumbnail
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    thumbnail_path = os.path.join(thumbnail_dir, f"{video_name}.jpg")
+    ret, buffer = cv2.imencode('.jpg', frame)
+    if not ret:
+        print(f"Warning: Unable to encode thumbnail for '{video_path}'")
+        return None
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    with open(thumbnail_path + ".tmp", 'wb') as f:
+        f.write(buffer)
+    os.replace(thumbnail_path + ".tmp", thumbnail_path)
+
+    # Read from the container, so nothing has to be decoded to find them
+    write_keyframes(keyframe_dir, video_path, read_mp4_keyframes(video_path))
+
+    return {
+        "title": video_name,
+        "thumbnail": thumbnail_path,
+        # Clients cache thumbnails by content, so an unchanged one is never fetched twice
+        "thumbnail_hash": hashlib.sha1(buffer).hexdigest(),
+        "duration": frame_count / fps if fps else 0.0,
+        "fps": fps,
+        "width": width,
+        "height": height,
+        "frame_count": frame_count,
+    }
+
+
+def load_index(index_file=INDEX_FILE):
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path, obj):
+    """Write JSON atomically, so the server never reads a half-written catalog."""
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def remove_derived_files(video_path, entry, keyframe_dir):
+    """Remove a deleted video's thumbnail and keyframe index."""
+    for path in (entry.get("thumbnail"), keyframe_path(keyframe_dir, video_path)):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def scan(video_dir, thumbnail_dir, index, workers=None, force=False, keyframe_dir=KEYFRAME_DIR):
+    """
+    Bring the index up to date with the video directory, probing only new or changed files
+    in parallel worker processes. Returns True if anything changed.
+    """
+    videos = list_videos(video_dir)
+
+    removed = [name for name in index if name not in videos]
+    for name in removed:
+        remove_derived_files(os.path.join(video_dir, name), index.pop(name)["entry"] or {}, keyframe_dir)
+        print(f"Removed {name} from the catalog")
+
+    changed = [
+        name for name, (mtime, size) in videos.items()
+        if force or name not in index
+        or (index[name]["source_mtime"], index[name]["source_size"]) != (mtime, size)
+        or index[name].get("version") != INGEST_VERSION
+    ]
+    if changed:
+        paths = [os.path.join(video_dir, name) for name in changed]
+        # One OpenCV thread per worker process; the parallelism comes from the pool. Workers are spawned,
+        # not forked, since a forked child inherits OpenCV's thread pool and locks mid-use and can hang.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+            entries = pool.map(probe_video, paths, [thumbnail_dir] * len(paths), [keyframe_dir] * len(paths),
+                               chunksize=8)
+            for name, entry in zip(changed, entries):
+                mtime, size = videos[name]
+                # Unreadable files are indexed too, so they are not retried until they change
+                index[name] = {"source_mtime": mtime, "source_size": size, "version": INGEST_VERSION,
+                               "entry": entry}
+                if entry is not None:
+                    print(f"Ingested {name}: {entry['width']}x{entry['height']}, "
+                          f"{entry['frame_count']} frames at {entry['fps']:.2f} fps")
+
+    return bool(removed or changed)
+
+
+def catalog_from_index(index):
+    """The catalog sent to clients, in title order."""
+    entries = [record["entry"] for record in index.values() if record["entry"] is not None]
+    return sorted(entries, key=lambda entry: entry["title"])
+
+
+def ingest_catalog(video_dir=VIDEO_DIR, thumbnail_dir=THUMBNAIL_DIR, metadata_file=METADATA_FILE,
+                   index_file=INDEX_FILE, workers=None, force=False, keyframe_dir=KEYFRAME_DIR):
+    """
+    Incrementally ingest the video directory: thumbnails and properties for new or changed videos,
+    then the catalog (metadata file) if anything changed. Returns the catalog.
+    """
+    index = load_index(index_file)
+    if scan(video_dir, thumbnail_dir, index, workers, force, keyframe_dir) or not os.path.exists(metadata_file):
+        write_json(index_file, index)
+        write_json(metadata_file, catalog_from_index(index))
+        print(f"Metadata saved to {metadata_file}")
+    return catalog_from_index(index)
+
+
+def watch(video_dir=VIDEO_DIR, thumbnail_dir=THUMBNAIL_DIR, metadata_file=METADATA_FILE,
+          index_file=INDEX_FILE, workers=None, interval=WATCH_INTERVAL, keyframe_dir=KEYFRAME_DIR):
+    """Rescan the video directory every interval seconds, picking up new, changed and removed videos."""
+    while True:
+        try:
+            ingest_catalog(video_dir, thumbnail_dir, metadata_file, index_file, workers,
+                           keyframe_dir=keyframe_dir)
+        except OSError as e:
+            print(f"Error scanning {video_dir}: {e}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate thumbnails and catalog metadata for the videos")
+    parser.add_argument("--video-dir", default=VIDEO_DIR)
+    parser.add_argument("--thumbnail-dir", default=THUMBNAIL_DIR)
+    parser.add_argument("--keyframe-dir", default=KEYFRAME_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="re-ingest every video, even if unchanged")
+    parser.add_argument("--watch", action="store_true", help="keep rescanning for new or changed videos")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="seconds between rescans")
+    args = parser.parse_args()
+
+    metadata_file = os.path.join(args.video_dir, "metadata.json")
+    index_file = os.path.join(args.video_dir, "index.json")
+    if args.watch:
+        watch(args.video_dir, args.thumbnail_dir, metadata_file, index_file, args.workers, args.interval,
+              args.keyframe_dir)
+    else:
+        ingest_catalog(args.video_dir, args.thumbnail_dir, metadata_file, index_file, args.workers, args.force,
+                       args.keyframe_dir)
@@ -0,0 +1,66 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class JitterBuffer:
+    """
+    Bounded buffer of decoded frames ordered by presentation timestamp.
+    Decode workers push frames in whatever order they finish; the renderer
+    pops them against a playback clock that starts once enough frames are buffered.
+    """
+
+    def __init__(self, depth=8, prebuffer=None, drop_late=True):
+        self.depth = depth
+        self.prebuffer = prebuffer if prebuffer is not None else max(depth // 2, 1)
+        self.drop_late = drop_late
+        self.frames = []                # Heap of (pts, tiebreak, frame)
+        self.tiebreak = itertools.count()
+        self.lock = threading.Lock()
+        self.clock_start = None         # Monotonic time at which pts 0 is (or was) due
+        self.dropped = 0
+
+    def push(self, pts, frame):
+        """Add a decoded frame. When full, the oldest frame is dropped to make room."""
+        with self.lock:
+            heapq.heappush(self.frames, (pts, next(self.tiebreak), frame))
+            if len(self.frames) > self.depth:
+                heapq.heappop(self.frames)
+                self.dropped += 1
+
+    def __len__(self):
+        with self.lock:
+            return len(self.frames)
+
+    def pop_due(self):
+        """
+        The frame to show now, or None if nothing is due yet.
+        With drop_late, frames that were due before the newest due frame are discarded;
+        otherwise they are shown one per call, in order.
+        """
+        with self.lock:
+            if not self.frames:
+                # Underrun (e.g. paused): restart the clock once the buffer refills
+                self.clock_start = None
+                return None
+
+            if self.clock_start is None:
+                if len(self.frames) < self.prebuffer:
+                    return None
+                self.clock_start = time.monotonic() - self.frames[0][0]
+
+            playback_pts = time.monotonic() - self.clock_start
+            if self.frames[0][0] > playback_pts:
+                return None
+
+            _, _, frame = heapq.heappop(self.frames)
+            while self.drop_late and self.frames and self.frames[0][0] <= playback_pts:
+                _, _, frame = heapq.heappop(self.frames)
+                self.dropped += 1
+            return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.clock_start = None
@@ -0,0 +1,119 @@
+"""
+Per-video keyframe index, used to seek with as little decoding as possible.
+
+For MP4 files the keyframes are read from the video track's sync sample box
+(stss) at ingest time, without decoding anything, and stored as an array of
+0-based frame numbers. Videos without an index (other containers, or MP4s in
+which every frame is a keyframe) are seeked to the exact frame instead.
+"""
+import array
+import bisect
+import os
+import struct
+import sys
+
+KEYFRAME_DIR = os.path.join(os.path.dirname(__file__), "../keyframes")
+
+
+def keyframe_path(keyframe_dir, video_path):
+    return os.path.join(keyframe_dir, os.path.splitext(os.path.basename(video_path))[0] + ".keyframes")
+
+
+def iter_boxes(f, start, end):
+    """(type, payload start, box end) of each box between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:    # 64-bit size follows the type
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:  # Box runs to the end of its parent
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def find_box(f, start, end, kind):
+    for box_kind, payload_start, box_end in iter_boxes(f, start, end):
+        if box_kind == kind:
+            return payload_start, box_end
+    return None
+
+
+def read_mp4_keyframes(video_path):
+    """
+    0-based frame numbers of the video track's keyframes, from its stss box.
+    Returns None if the file is not an MP4, has no video track, or has no stss
+    (in which case every frame is a keyframe).
+    """
+    try:
+        with open(video_path, 'rb') as f:
+            moov = find_box(f, 0, os.fstat(f.fileno()).st_size, b"moov")
+            if moov is None:
+                return None
+
+            for kind, trak_start, trak_end in iter_boxes(f, *moov):
+                if kind != b"trak":
+                    continue
+                mdia = find_box(f, trak_start, trak_end, b"mdia")
+                hdlr = mdia and find_box(f, *mdia, b"hdlr")
+                if hdlr is None:
+                    continue
+                # version/flags, pre_defined, then the handler type
+                f.seek(hdlr[0] + 8)
+                if f.read(4) != b"vide":
+                    continue
+
+                minf = find_box(f, *mdia, b"minf")
+                stbl = minf and find_box(f, *minf, b"stbl")
+                stss = stbl and find_box(f, *stbl, b"stss")
+                if stss is None:
+                    return None
+                f.seek(stss[0] + 4)  # Skip version/flags
+                count = struct.unpack(">I", f.read(4))[0]
+                keyframes = array.array('I')
+                keyframes.frombytes(f.read(count * 4))
+                if sys.byteorder == "little":  # Stored big-endian
+                    keyframes.byteswap()
+                # Sample numbers in stss count from 1
+                return array.array('I', (sample - 1 for sample in keyframes))
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def write_keyframes(keyframe_dir, video_path, keyframes):
+    """Store a video's keyframe index, or remove a stale one if it has none."""
+    path = keyframe_path(keyframe_dir, video_path)
+    if keyframes is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(keyframe_dir, exist_ok=True)
+    with open(path + ".tmp", 'wb') as f:
+        keyframes.tofile(f)
+    os.replace(path + ".tmp", path)
+
+
+def load_keyframes(video_path, keyframe_dir=KEYFRAME_DIR):
+    """A video's keyframe index, or None if it has none or it is older than the video."""
+    path = keyframe_path(keyframe_dir, video_path)
+    try:
+        if os.stat(path).st_mtime_ns < os.stat(video_path).st_mtime_ns:
+            return None
+        keyframes = array.array('I')
+        with open(path, 'rb') as f:
+            keyframes.frombytes(f.read())
+        return keyframes or None
+    except OSError:
+        return None
+
+
+def keyframe_at_or_before(keyframes, frame_index):
+    """The last keyframe at or before the frame (the first keyframe if there is none before it)."""
+    position = bisect.bisect_right(keyframes, frame_index)
+    return keyframes[max(position - 1, 0)]
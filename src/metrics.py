@@ -0,0 +1,192 @@
+"""
+Server-wide instrumentation of the frame path.
+
+Time spent in each stage (decode, encode, send and the pacing sleep) is
+recorded in fixed-bucket histograms: one observation is a bisect and a few
+increments, cheap enough to leave on for every frame. Sessions keep their own
+histograms, which also feed the server-wide ones. Frame, byte, drop and
+control message counters are the sessions' own stats dicts, summed when the
+metrics are read rather than kept twice on the hot path.
+
+Time to first frame, from a client's start request to its first frame
+going out, has a histogram of its own.
+
+The server-wide view is served in the Prometheus text format over a local
+HTTP endpoint, and returned to clients by the "stats" control action.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stages of the frame path that are timed
+STAGES = ("decode", "encode", "send", "pacing_sleep")
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# Session stats summed into server-wide counters
+COUNTERS = ("frames_sent", "frames_late", "frames_dropped", "bytes_sent", "control_messages", "seeks",
+            "preview_frames_sent", "datagrams_sent", "datagrams_dropped")
+
+# Prefix of every exported metric name
+METRIC_PREFIX = "video_server"
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one catches everything above the largest bound
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    def quantile(self, counts, q):
+        """Upper bound of the bucket holding the q-quantile (None if it lies above every bucket)."""
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        """Count, mean and estimated p50/p95/p99 in seconds."""
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        count = sum(counts)
+        return {
+            "count": count,
+            "mean": total / count if count else None,
+            "p50": self.quantile(counts, 0.5) if count else None,
+            "p95": self.quantile(counts, 0.95) if count else None,
+            "p99": self.quantile(counts, 0.99) if count else None,
+        }
+
+
+class StageTimings:
+    """A histogram per frame path stage. Observations are passed on to the parent's histograms too."""
+
+    def __init__(self, parent=None):
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.parent = parent
+
+    def observe(self, stage, seconds):
+        self.histograms[stage].observe(seconds)
+        if self.parent is not None:
+            self.parent.observe(stage, seconds)
+
+    def snapshot(self, observed_only=False):
+        """Each stage's histogram snapshot; with observed_only, only the stages observed at least once."""
+        snapshots = {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+        if observed_only:
+            return {stage: snapshot for stage, snapshot in snapshots.items() if snapshot["count"]}
+        return snapshots
+
+
+class ServerMetrics:
+    """Stage timings and counters for the whole server, across live and finished sessions."""
+
+    def __init__(self):
+        self.timings = StageTimings()
+        self.first_frame = Histogram()  # Seconds from a start request to its first frame
+        self.lock = threading.Lock()
+        self.sessions = {}                               # id(stats) -> stats of each live session
+        self.finished = dict.fromkeys(COUNTERS, 0)       # Counters of sessions that have ended
+        self.sessions_total = 0
+
+    def open_session(self, stats):
+        """Start counting a session's stats. Returns the session's own stage timings."""
+        with self.lock:
+            self.sessions[id(stats)] = stats
+            self.sessions_total += 1
+        return StageTimings(self.timings)
+
+    def close_session(self, stats):
+        """Fold a finished session's counters into the totals."""
+        with self.lock:
+            if self.sessions.pop(id(stats), None) is None:
+                return
+            for name in COUNTERS:
+                self.finished[name] += stats.get(name, 0)
+
+    def counters(self):
+        with self.lock:
+            totals = dict(self.finished)
+            for stats in self.sessions.values():
+                for name in COUNTERS:
+                    totals[name] += stats.get(name, 0)
+            totals["sessions_total"] = self.sessions_total
+            totals["sessions_active"] = len(self.sessions)
+        return totals
+
+    def snapshot(self):
+        return {"counters": self.counters(), "stages": self.timings.snapshot(),
+                "time_to_first_frame": self.first_frame.snapshot()}
+
+    def render_text(self, prefix=METRIC_PREFIX):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, value in self.counters().items():
+            if name == "sessions_active":
+                kind = "gauge"
+            else:
+                kind = "counter"
+                name = name if name.endswith("_total") else name + "_total"
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+
+        name = f"{prefix}_stage_seconds"
+        lines.append(f"# HELP {name} Time spent in each stage of the frame path")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in self.timings.histograms.items():
+            lines.extend(histogram_lines(name, histogram, f'stage="{stage}",'))
+
+        name = f"{prefix}_time_to_first_frame_seconds"
+        lines.append(f"# HELP {name} Time from a start request to its first frame being sent")
+        lines.append(f"# TYPE {name} histogram")
+        lines.extend(histogram_lines(name, self.first_frame))
+        return "\n".join(lines) + "\n"
+
+
+def histogram_lines(name, histogram, labels=""):
+    """A histogram's bucket, sum and count lines in the text format; labels end with a comma."""
+    with histogram.lock:
+        counts, total = list(histogram.counts), histogram.sum
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ("+Inf",), counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    braces = f"{{{labels.rstrip(',')}}}" if labels else ""
+    lines.append(f'{name}_sum{braces} {total}')
+    lines.append(f'{name}_count{braces} {cumulative}')
+    return lines
+
+
+def serve_metrics(metrics, host="127.0.0.1", port=9100):
+    """Serve the metrics over HTTP (any path) from a daemon thread. Returns the HTTP server."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are too frequent to be worth logging
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
@@ -0,0 +1,57 @@
+import time
+
+# Frame rate to assume when a video does not report one
+DEFAULT_FPS = 30
+
+
+class FramePacer:
+    """
+    Schedules frames against the source's own timestamps on a monotonic clock.
+    Frame i is due at start + (i - origin) / fps, so time spent decoding, encoding
+    and sending is absorbed instead of added on top of a fixed sleep.
+    """
+
+    def __init__(self, fps, frame_index=0):
+        self.fps = fps if fps and fps > 0 else DEFAULT_FPS
+        self.frame_interval = 1 / self.fps
+        self.reset(frame_index)
+
+    def reset(self, frame_index=0):
+        """Make the given frame due now, e.g. when playback starts or resumes."""
+        self.origin = frame_index
+        self.start = time.monotonic()
+
+    def deadline(self, frame_index):
+        """Monotonic time at which the frame should be sent."""
+        return self.start + (frame_index - self.origin) * self.frame_interval
+
+    def delay(self, frame_index):
+        """Seconds until the frame is due; negative if it is already late."""
+        return self.deadline(frame_index) - time.monotonic()
+
+    def frames_behind(self, frame_index):
+        """How many frames from this one on have already missed their deadline entirely."""
+        late_by = time.monotonic() - self.deadline(frame_index)
+        return int(late_by / self.frame_interval) if late_by > 0 else 0
+
+    def is_late(self, frame_index, sent_at=None):
+        """Whether a frame sent at the given time went out after the next frame was already due."""
+        sent_at = time.monotonic() if sent_at is None else sent_at
+        return sent_at > self.deadline(frame_index + 1)
+
+
+def new_session_stats():
+    """Per-session pacing, traffic and seek counters."""
+    return {
+        "frames_sent": 0,
+        "bytes_sent": 0,      # Frame, tile and preview messages, headers included
+        "frames_late": 0,     # Sent after the following frame was already due
+        "frames_dropped": 0,  # Skipped to catch up, or replaced before the client took them
+        "control_messages": 0,
+        "seeks": 0,
+        "preview_frames_sent": 0,
+        "datagrams_sent": 0,     # UDP mode: frame message fragments and parity
+        "datagrams_dropped": 0,  # UDP mode: not sent, the socket buffer being full, or dropped by the loss injector
+        "seek_time_to_first_frame": None,  # Seconds from the last seek request to its first frame
+        "time_to_first_frame": None,       # Seconds from the last start request to its first frame
+    }
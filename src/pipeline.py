@@ -0,0 +1,132 @@
+"""
+Read-ahead decode and parallel encode for one stream of frames.
+
+A decode thread reads frames ahead of playback and hands each one to a thread
+pool for encoding as soon as it is decoded; OpenCV releases the GIL while it
+decodes and encodes, so frame N+1 is decoded, and several frames encoded, while
+frame N is waiting for its deadline or being sent. The pending encodes wait in
+a bounded queue in frame order, so frames come out in order however the
+encodes finish, and the decode thread stops reading once the queue is full.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import cv2
+
+# Frames decoded (and being encoded) ahead of the one being published
+READ_AHEAD = 4
+
+
+def completed(result):
+    """A future that already holds its result, for stages run without a pool."""
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class FramePipeline:
+    """
+    Decodes a capture on a thread of its own and encodes the frames on an executor.
+    encode(frame, frame_index) runs on the executor (or on the decode thread when
+    there is none); skip(position) is called before each read and returns how many
+    frames were skipped without being decoded, so a stream that has fallen behind
+    the clock catches up.
+    """
+
+    def __init__(self, cap, position, encode=None, executor=None, skip=None, timings=None, depth=READ_AHEAD):
+        self.cap = cap
+        self.position = position  # Index of the next frame to be read
+        self.encode = encode
+        self.executor = executor
+        self.skip = skip
+        self.timings = timings
+        self.depth = depth
+        self.pending = deque()    # (frame index, future of the encoded frame) in frame order
+        self.ended = False        # Set once the decode thread has read the last frame
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def decode(self):
+        """Decode thread: keep the queue full until the video ends or the pipeline is stopped."""
+        try:
+            # A capture can come from a pool (see warmstart.py), left wherever its last reader stopped
+            if self.cap.get(cv2.CAP_PROP_POS_FRAMES) != self.position:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.position)
+            while True:
+                with self.condition:
+                    while len(self.pending) >= self.depth and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+
+                if self.skip is not None:
+                    self.position += self.skip(self.position)
+                decode_start = time.monotonic()
+                ret, frame = self.cap.read()
+                if self.timings is not None:
+                    self.timings.observe("decode", time.monotonic() - decode_start)
+                if not ret:
+                    return
+
+                frame_index = self.position
+                self.position += 1
+                if self.encode is None:
+                    future = completed(frame)
+                elif self.executor is None:
+                    future = completed(self.encode(frame, frame_index))
+                else:
+                    future = self.executor.submit(self.encode, frame, frame_index)
+                with self.condition:
+                    if self.stopped:
+                        future.cancel()
+                        return
+                    self.pending.append((frame_index, future))
+                    self.condition.notify_all()
+        except Exception as e:
+            # Handed to the consumer, which sees it when it reaches this point of the stream
+            failed = Future()
+            failed.set_exception(e)
+            with self.condition:
+                self.pending.append((self.position, failed))
+        finally:
+            with self.condition:
+                self.ended = True
+                self.condition.notify_all()
+
+    def next(self):
+        """
+        The next (frame index, encoded frame) in order, waiting for it to be decoded and
+        encoded; None at the end of the video or once the pipeline is stopped.
+        """
+        with self.condition:
+            while not self.pending and not self.ended and not self.stopped:
+                self.condition.wait()
+            if self.stopped or not self.pending:
+                return None
+            frame_index, future = self.pending.popleft()
+            self.condition.notify_all()  # Room for the decode thread to read another
+        return frame_index, future.result()
+
+    def stop(self):
+        """Stop reading ahead and wake anyone waiting. Does not wait; see close."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Stop the pipeline and drain it: wait for the decode thread to finish its read, so
+        the capture can be released, and drop the frames queued but never published.
+        """
+        self.stop()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        with self.condition:
+            pending, self.pending = self.pending, deque()
+        for _, future in pending:
+            future.cancel()  # Encodes already running finish on their own; nobody waits for them
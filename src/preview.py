@@ -0,0 +1,141 @@
+"""
+Live previews: several videos playing at once over one connection, for the browse page.
+
+A client sends a preview control signal naming the videos it shows as thumbnails,
+each under a stream ID of its choosing, and the size of its tiles. Every video is
+then played by a low-rate, low-resolution broadcast hub, shared with every other
+client previewing it at the same size, and the frames of all of them are sent on
+the client's one connection tagged with their stream ID (MSG_PREVIEW). A preview
+that reaches the end of its video starts over.
+
+Frames are interleaved fairly: each round sends at most one frame per stream,
+starting one stream further along each time, and a stream the client cannot keep
+up with only ever has its latest frame waiting. So a handful of previews cost a
+handful of cheap hubs and no extra sockets or threads.
+"""
+import logging
+import os
+from collections import deque
+from protocol import encode_preview_header, is_title
+
+log = logging.getLogger(__name__)
+
+# JPEG quality of preview frames
+PREVIEW_QUALITY = 50
+
+# Frames per second of each preview stream
+PREVIEW_FPS = 5
+
+# Tile size previews are scaled down to when the client does not give one
+PREVIEW_SIZE = (160, 120)
+
+# Preview streams a connection may have at once
+MAX_PREVIEW_STREAMS = 16
+
+# Largest stream ID that fits the preview header
+MAX_STREAM_ID = 0xFFFF
+
+
+def parse_preview(control_signal, max_streams=MAX_PREVIEW_STREAMS):
+    """
+    The streams of a preview control signal, {"streams": [{"id": n, "video": title}, ...]},
+    as {stream ID: video title}; None if invalid. An empty list stops every preview.
+    """
+    try:
+        streams = {}
+        for stream in control_signal["streams"]:
+            stream_id, video_name = int(stream["id"]), stream["video"]
+            if not 0 <= stream_id <= MAX_STREAM_ID or not is_title(video_name):
+                raise ValueError(stream)
+            streams[stream_id] = video_name
+    except (KeyError, TypeError, ValueError):
+        log.warning("invalid_preview signal=%s", control_signal)
+        return None
+    if len(streams) > max_streams:
+        log.warning("too_many_previews count=%d max=%d", len(streams), max_streams)
+        return None
+    return streams
+
+
+def preview_buffers(stream_id, frame):
+    """The buffers of the preview message for an EncodedFrame: headers, then the encoder's JPEG buffer."""
+    # The frame's index in its video stands in for the sequence number; each stream counts on its own
+    return (encode_preview_header(stream_id, frame.index, frame.pts, frame.quality, frame.width, frame.height,
+                                  len(frame.data)),
+            frame.data)
+
+
+class PreviewScheduler:
+    """
+    The preview streams of one connection, each a subscription to a low-rate hub, and the
+    order their frames are sent in. new_subscription() makes a subscription that wakes the
+    connection's preview sender. update, restart and close subscribe and unsubscribe, which
+    can open a capture, so they are called without the subscriptions' lock held; ready and
+    take_round look at the subscriptions, so they are called with it held.
+    """
+
+    def __init__(self, hubs, new_subscription, video_dir):
+        self.hubs = hubs
+        self.new_subscription = new_subscription
+        self.video_dir = video_dir
+        self.streams = {}      # stream ID -> (video title, subscription)
+        self.order = deque()   # Stream IDs, rotated every round so none is always sent first
+        self.viewport = PREVIEW_SIZE
+
+    def update(self, streams, viewport=None):
+        """Preview the given {stream ID: video title}, at the given tile size; streams left out are stopped."""
+        viewport = viewport or PREVIEW_SIZE
+        for stream_id, (video_name, subscription) in list(self.streams.items()):
+            if streams.get(stream_id) != video_name or viewport != self.viewport:
+                self.stop(stream_id)
+        self.viewport = viewport
+        for stream_id, video_name in streams.items():
+            if stream_id not in self.streams:
+                self.start(stream_id, video_name)
+        log.info("previews_updated streams=%d viewport=%s", len(self.streams), viewport)
+
+    def start(self, stream_id, video_name):
+        video_path = os.path.join(self.video_dir, video_name + '.mp4')
+        subscription = self.hubs.subscribe(video_path, PREVIEW_QUALITY, 1.0, self.new_subscription(),
+                                           viewport=self.viewport, max_fps=PREVIEW_FPS)
+        if subscription is None:
+            log.warning("preview_open_failed video=%s", video_name)
+            return
+        self.streams[stream_id] = (video_name, subscription)
+        self.order.append(stream_id)
+
+    def stop(self, stream_id):
+        _, subscription = self.streams.pop(stream_id)
+        self.order.remove(stream_id)
+        self.hubs.unsubscribe(subscription)
+
+    def restart(self, stream_ids):
+        """Start the given streams, whose videos have ended, over from the beginning."""
+        for stream_id in stream_ids:
+            if stream_id in self.streams:
+                video_name, _ = self.streams[stream_id]
+                self.stop(stream_id)
+                self.start(stream_id, video_name)
+
+    def close(self):
+        for stream_id in list(self.streams):
+            self.stop(stream_id)
+
+    def ready(self):
+        """Whether any stream has a frame waiting, or has ended."""
+        return any(subscription.ready() for _, subscription in self.streams.values())
+
+    def take_round(self):
+        """
+        One round of frames: the waiting frame of every stream that has one, as (stream ID, frame),
+        and the IDs of the streams that have ended.
+        """
+        frames, ended = [], []
+        for stream_id in self.order:
+            subscription = self.streams[stream_id][1]
+            if subscription.frame is not None:
+                frames.append((stream_id, subscription.take()))
+            elif subscription.ended:
+                ended.append(stream_id)
+        self.order.rotate(-1)
+        return frames, ended
@@ -0,0 +1,298 @@
+"""
+Wire protocol shared by the server and the client.
+
+Every message starts with a fixed header: protocol version (1 byte), message
+type (1 byte) and payload length (4 bytes, big-endian). Catalog, control,
+stats, seeked and catalog page payloads are UTF-8 JSON; large catalog ones are
+zlib-compressed, and flagged as such in their message type. Frame payloads start with a frame header
+(sequence number, presentation timestamp and encode parameters) followed by
+the JPEG data. Tile payloads (delta mode) carry the same frame header, a patch
+count, and for each patch its position, size and JPEG data. Thumbnail payloads start with the JPEG's SHA-1 and the video
+title, followed by the JPEG data. Preview payloads (live thumbnails) are frame payloads
+prefixed with the ID of the preview stream, so frames of several videos can share
+one connection.
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+
+PROTOCOL_VERSION = 1
+
+# Message types
+MSG_CATALOG = 1   # server -> client: list of videos
+MSG_CONTROL = 2   # client -> server: start/stop/pause/resume/seek/stats/viewport/thumbnail/preview/catalog
+MSG_FRAME = 3     # server -> client: one encoded video frame
+MSG_STATS = 4     # server -> client: session statistics
+MSG_THUMBNAIL = 5  # server -> client: a video's thumbnail, in reply to a thumbnail control signal
+MSG_SEEKED = 6     # server -> client: where a seek landed; frames after it are from the new position
+MSG_TILES = 7      # server -> client: a frame as JPEG patches over the previous one (delta mode)
+MSG_PREVIEW = 8    # server -> client: one frame of a preview stream, in reply to a preview control signal
+MSG_CATALOG_PAGE = 9  # server -> client: the catalog entries matching a catalog control signal, one page of them
+
+# Set on the type of a message whose JSON payload is zlib-compressed
+COMPRESSED = 0x80
+
+# version, type, payload length
+MESSAGE_HEADER = struct.Struct("!BBI")
+# sequence, presentation timestamp (microseconds), ladder level, JPEG quality, width, height
+FRAME_HEADER = struct.Struct("!IQBBHH")
+# Number of patches in a tiles message
+TILE_COUNT = struct.Struct("!H")
+# x, y, width, height, JPEG data length of one patch
+TILE_HEADER = struct.Struct("!HHHHI")
+# SHA-1 of the JPEG data, length of the UTF-8 video title that follows
+THUMBNAIL_HEADER = struct.Struct("!20sH")
+# Preview stream ID, chosen by the client; a frame header and the JPEG data follow
+PREVIEW_HEADER = struct.Struct("!H")
+
+# Largest payload a server accepts from a client: control messages are small, and a length
+# is otherwise a promise to allocate that much for the connection
+MAX_CLIENT_PAYLOAD = 64 * 1024
+
+FrameInfo = namedtuple("FrameInfo", "sequence pts level quality width height")
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid message."""
+
+
+def encode_header(msg_type, payload_length):
+    return MESSAGE_HEADER.pack(PROTOCOL_VERSION, msg_type, payload_length)
+
+
+def encode_json(msg_type, obj, compress_above=None):
+    """
+    A complete JSON message (catalog, control or stats). A payload of more than compress_above
+    bytes is zlib-compressed and its message type flagged COMPRESSED.
+    """
+    payload = json.dumps(obj).encode("utf-8")
+    if compress_above is not None and len(payload) > compress_above:
+        payload = zlib.compress(payload)
+        msg_type |= COMPRESSED
+    return encode_header(msg_type, len(payload)) + payload
+
+
+def encode_frame_header(sequence, pts, level, quality, width, height, data_length):
+    """
+    Message and frame headers for a frame whose JPEG data is data_length bytes long.
+    The JPEG data is sent right after, so it never has to be copied into a new buffer.
+    """
+    return (encode_header(MSG_FRAME, FRAME_HEADER.size + data_length)
+            + FRAME_HEADER.pack(sequence & 0xFFFFFFFF, int(pts * 1_000_000), level, quality, width, height))
+
+
+def decode_header(buffer, max_length=None):
+    """Parse a message header. Returns (message type, payload length), which must not be above max_length."""
+    version, msg_type, length = MESSAGE_HEADER.unpack_from(buffer)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if max_length is not None and length > max_length:
+        raise ProtocolError(f"Payload of {length} bytes is over the limit of {max_length}")
+    return msg_type, length
+
+
+def decode_json(payload):
+    return json.loads(str(payload, "utf-8"))
+
+
+def is_title(video_name):
+    """Whether a video named in a control signal is a title, not a path or something other than a string."""
+    # Titles name files in the videos and thumbnails directories; anything path-like is not a title
+    return (isinstance(video_name, str) and video_name not in ("", ".", "..")
+            and os.path.basename(video_name) == video_name)
+
+
+def decompress(msg_type, payload):
+    """The type and payload of a message as they were before any compression."""
+    if msg_type & COMPRESSED:
+        return msg_type & ~COMPRESSED, memoryview(zlib.decompress(payload))
+    return msg_type, payload
+
+
+def decode_frame(payload):
+    """Split a frame payload into its FrameInfo and a zero-copy view of the JPEG data."""
+    sequence, pts_us, level, quality, width, height = FRAME_HEADER.unpack_from(payload)
+    info = FrameInfo(sequence, pts_us / 1_000_000, level, quality, width, height)
+    return info, memoryview(payload)[FRAME_HEADER.size:]
+
+
+def encode_preview_header(stream_id, sequence, pts, quality, width, height, data_length):
+    """Message, preview and frame headers for a preview frame; like encode_frame_header, the JPEG data follows."""
+    return (encode_header(MSG_PREVIEW, PREVIEW_HEADER.size + FRAME_HEADER.size + data_length)
+            + PREVIEW_HEADER.pack(stream_id)
+            + FRAME_HEADER.pack(sequence & 0xFFFFFFFF, int(pts * 1_000_000), 0, quality, width, height))
+
+
+def decode_preview(payload):
+    """Split a preview payload into its stream ID, FrameInfo and a zero-copy view of the JPEG data."""
+    stream_id, = PREVIEW_HEADER.unpack_from(payload)
+    info, data = decode_frame(memoryview(payload)[PREVIEW_HEADER.size:])
+    return stream_id, info, data
+
+
+def encode_tiles(sequence, pts, level, quality, width, height, patches):
+    """
+    Buffers making up a tiles message, ready for send_buffers or writelines.
+    Each patch is (x, y, width, height, JPEG buffer); the JPEG buffers are not copied.
+    """
+    headers = [TILE_HEADER.pack(x, y, patch_width, patch_height, len(data))
+               for x, y, patch_width, patch_height, data in patches]
+    length = FRAME_HEADER.size + TILE_COUNT.size + sum(len(header) + len(patch[4]) for header, patch in
+                                                       zip(headers, patches))
+    buffers = [encode_header(MSG_TILES, length)
+               + FRAME_HEADER.pack(sequence & 0xFFFFFFFF, int(pts * 1_000_000), level, quality, width, height)
+               + TILE_COUNT.pack(len(patches))]
+    for header, patch in zip(headers, patches):
+        buffers.append(header)
+        buffers.append(patch[4])
+    return buffers
+
+
+def decode_tiles(payload):
+    """Split a tiles payload into its FrameInfo and a list of (x, y, width, height, JPEG data view) patches."""
+    sequence, pts_us, level, quality, width, height = FRAME_HEADER.unpack_from(payload)
+    info = FrameInfo(sequence, pts_us / 1_000_000, level, quality, width, height)
+    view = memoryview(payload)
+    offset = FRAME_HEADER.size + TILE_COUNT.size
+    patches = []
+    for _ in range(TILE_COUNT.unpack_from(payload, FRAME_HEADER.size)[0]):
+        x, y, patch_width, patch_height, length = TILE_HEADER.unpack_from(payload, offset)
+        offset += TILE_HEADER.size
+        patches.append((x, y, patch_width, patch_height, view[offset:offset + length]))
+        offset += length
+    return info, patches
+
+
+def encode_thumbnail(title, data):
+    """A complete thumbnail message for a video, tagged with the hash clients cache it under."""
+    title = title.encode("utf-8")
+    payload = THUMBNAIL_HEADER.pack(hashlib.sha1(data).digest(), len(title)) + title + data
+    return encode_header(MSG_THUMBNAIL, len(payload)) + payload
+
+
+def decode_thumbnail(payload):
+    """Split a thumbnail payload into (SHA-1 as hex, video title, JPEG data)."""
+    digest, title_length = THUMBNAIL_HEADER.unpack_from(payload)
+    start = THUMBNAIL_HEADER.size
+    title = str(payload[start:start + title_length], "utf-8")
+    return digest.hex(), title, bytes(payload[start + title_length:])
+
+
+class BufferPool:
+    """
+    Reusable receive buffers, so each large frame does not cost a fresh allocation.
+    Buffers grow to fit the largest payload they have held and are handed back with release().
+    """
+
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        with self.lock:
+            buffer = self.free.pop() if self.free else bytearray()
+        if len(buffer) < size:
+            try:
+                buffer.extend(bytes(size - len(buffer)))
+            except BufferError:
+                # Something still holds a view of it; leave it to the garbage collector
+                buffer = bytearray(size)
+        return buffer
+
+    def release(self, buffer):
+        """Return a buffer (or a memoryview of one) once nothing reads it any more."""
+        if isinstance(buffer, memoryview):
+            buffer = buffer.obj
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+
+def recv_exactly_into(sock, view):
+    """Fill the view from the socket. Returns False if the connection closes first."""
+    received = 0
+    size = len(view)
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+
+def recv_exactly(sock, size):
+    """Receive exactly size bytes. Returns None if the connection closes first."""
+    buffer = bytearray(size)
+    return buffer if recv_exactly_into(sock, memoryview(buffer)) else None
+
+
+class MessageReader:
+    """
+    Reads messages from a blocking socket with recv_into, straight into reusable buffers.
+    Without a pool every payload gets its own buffer; with one, the caller hands each
+    payload back with pool.release() when done with it. A payload longer than max_length
+    raises ProtocolError before anything is allocated for it.
+    """
+
+    def __init__(self, sock, pool=None, max_length=None):
+        self.sock = sock
+        self.pool = pool
+        self.max_length = max_length
+        self.header = bytearray(MESSAGE_HEADER.size)
+        self.header_view = memoryview(self.header)
+
+    def read(self):
+        """Returns (message type, payload as a memoryview), or None when the peer has closed."""
+        if not recv_exactly_into(self.sock, self.header_view):
+            return None
+        msg_type, length = decode_header(self.header, self.max_length)
+
+        buffer = self.pool.acquire(length) if self.pool else bytearray(length)
+        payload = memoryview(buffer)[:length]
+        if not recv_exactly_into(self.sock, payload):
+            return None
+        return msg_type, payload
+
+
+def read_message(sock, max_length=None):
+    """
+    Read one message from a blocking socket.
+    Returns (message type, payload as a memoryview), or None when the peer has closed.
+    """
+    return MessageReader(sock, max_length=max_length).read()
+
+
+def send_buffers(sock, buffers):
+    """
+    Send several buffers (e.g. a header and a NumPy JPEG buffer) in as few system calls
+    as possible, using sendmsg's scatter/gather I/O so nothing is joined or copied first.
+    """
+    if not hasattr(sock, "sendmsg"):  # Windows
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+async def read_message_async(reader, max_length=None):
+    """read_message for an asyncio StreamReader."""
+    try:
+        header = await reader.readexactly(MESSAGE_HEADER.size)
+        msg_type, length = decode_header(header, max_length)
+        payload = await reader.readexactly(length)
+    except EOFError:
+        return None
+    return msg_type, memoryview(payload)
@@ -1,89 +1,192 @@
+import argparse
 import socket
-import json
+import logging
 import os
-import cv2
 import threading
 import time
+from adaptive import DEFAULT_LADDER, AdaptiveController, parse_ladder, send_buffer_occupancy
+from catalog import CatalogService, parse_query
+from datagram import DatagramSender, LossInjector
+from framestore import STORE_DIR, open_stored, send_stored_frame
+from hub import HubRegistry, Subscription
+from ingest import WATCH_INTERVAL, ingest_catalog, watch
+from keyframes import KEYFRAME_DIR, keyframe_at_or_before, load_keyframes
+from metrics import ServerMetrics, serve_metrics
+from pacing import DEFAULT_FPS, FramePacer, new_session_stats
+from preview import PreviewScheduler, parse_preview, preview_buffers
+from protocol import (MAX_CLIENT_PAYLOAD, MSG_CONTROL, MSG_SEEKED, MSG_STATS, decode_json, encode_frame_header,
+                      encode_json, encode_thumbnail, encode_tiles, is_title, read_message, send_buffers)
 
 # Paths for videos and thumbnails directories
 VIDEO_DIR = os.path.join(os.path.dirname(__file__), "../videos")
 THUMBNAIL_DIR = os.path.join(os.path.dirname(__file__), "../thumbnails")
 METADATA_FILE = os.path.join(VIDEO_DIR, "metadata.json")
+INDEX_FILE = os.path.join(VIDEO_DIR, "index.json")
+
+# Worker processes extracting thumbnails and video properties (None: one per CPU)
+INGEST_WORKERS = None
+
+# Pre-encoded frames written by `python framestore.py`, served in place of live encoding
+FRAME_STORE_DIR = STORE_DIR
+
+# Quality ladder for adaptive streaming, best level first: (JPEG quality, resolution scale).
+# Each session starts at the top and moves along it as its socket backs up or drains.
+QUALITY_LADDER = DEFAULT_LADDER
+
+# Server engine: "threaded" (a thread per client) or "asyncio" (one event loop for all clients)
+SERVER_ENGINE = "threaded"
+
+# Size of the asyncio engine's executor for blocking work, and of its hubs' JPEG encode pool
+# (each hub decodes on a read-ahead thread of its own)
+ENCODE_WORKERS = os.cpu_count() or 4
+
+# Bounds on the viewport size a client may ask frames to be scaled down to
+MIN_VIEWPORT = 16
+MAX_VIEWPORT = 8192
+
+# Hint that more data follows right away (Linux), so a header is not sent in a packet of its own
+SEND_MORE = getattr(socket, "MSG_MORE", 0)
+
+# Local port of the Prometheus text-format metrics endpoint (None: not served)
+METRICS_PORT = None
+
+# Server processes; more than one runs a pool of workers (see workers.py), None for one per CPU
+PROCESSES = 1
+
+# UDP frame transport: the fraction of datagrams dropped on purpose, and how many in a row on average,
+# to see how it copes with a lossy network on one that loses nothing, such as loopback
+UDP_LOSS = 0.0
+UDP_LOSS_BURST = 1.0
+
+# Send catalogs zlib-compressed when they are large; clients decompress them
+CATALOG_COMPRESSION = True
+
+# Log lines: one event per line as "event key=value ...", easy to grep and to parse
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+# Stage timings and counters across every session and hub
+server_metrics = ServerMetrics()
+
+# Broadcast hubs shared by all clients, one decode/encode pipeline per (video, quality, scale, viewport)
+hubs = HubRegistry(timings=server_metrics.timings)
+
+# The catalog in memory, with the message sent to every new connection; read again only when it changes
+catalog = CatalogService(generate=lambda: generate_metadata())
+
+log = logging.getLogger(__name__)
 
 
 def generate_metadata():
-    """Generate video metadata (title and thumbnail paths) and store it in a JSON file."""
-    # List all videos in the directory
-    videos = [f for f in os.listdir(VIDEO_DIR) if f.endswith(('.mp4', '.avi', '.mkv'))]
-    metadata = []
-
-    # check all video files in directory 
-    for video in videos:
-        video_name = os.path.splitext(video)[0] # take the first frame for thumbnail
-        thumbnail_path = os.path.join(THUMBNAIL_DIR, f"{video_name}.jpg")
-
-        # Verify if thumbnail exists
-        if os.path.exists(thumbnail_path):
-            metadata.append({
-                "title": video_name,
-                "thumbnail": thumbnail_path
-            })
-        else:
-            print(f"Warning: Thumbnail missing for {video}")
-
-    # Save metadata as JSON in the videos directory
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=4)
-    print(f"Metadata saved to {METADATA_FILE}")
-
-def read_metadata():
-    """Read video metadata from the stored JSON file."""
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        return metadata
-    else:
-        print("Metadata file not found, generating metadata...")
-        generate_metadata()
-        return read_metadata()  # Recursively call after generating metadata
+    """
+    Bring the video metadata up to date: thumbnails, duration, fps, resolution and frame count
+    for new or changed videos are extracted in parallel, then stored in a JSON file.
+    """
+    ingest_catalog(VIDEO_DIR, THUMBNAIL_DIR, METADATA_FILE, INDEX_FILE, INGEST_WORKERS, keyframe_dir=KEYFRAME_DIR)
+
+def watch_metadata(interval):
+    """Keep the metadata current as videos are added, replaced or removed, without a restart."""
+    watcher = threading.Thread(target=watch, args=(VIDEO_DIR, THUMBNAIL_DIR, METADATA_FILE, INDEX_FILE,
+                                                   INGEST_WORKERS, interval, KEYFRAME_DIR), daemon=True)
+    watcher.start()
 
 def send_metadata(client_socket):
-    """Send video metadata as JSON to the client."""
-    # Get the metadata (either from the JSON or generated)
-    metadata = read_metadata()
-    
-    # Convert metadata to JSON string  and send 
-    metadata_json = json.dumps(metadata)
-    client_socket.sendall(metadata_json.encode('utf-8'))  # Send JSON over TCP
+    """Send video metadata to the client, as the catalog message made when the catalog last changed."""
+    client_socket.sendall(catalog.current(METADATA_FILE).message(CATALOG_COMPRESSION))
     print("Metadata sent to client!")
 
-def receive_control_signal(client_socket, shared_state, state_condition):
+def catalog_page_message(control_signal, snapshot=None):
+    """The catalog page message answering a catalog control signal, or None if it is invalid."""
+    query = parse_query(control_signal)
+    if query is None:
+        return None
+    snapshot = snapshot or catalog.current(METADATA_FILE)
+    return snapshot.page_message(query, CATALOG_COMPRESSION)
+
+def receive_control_signal(client_socket, shared_state, state_condition, pending=()):
     """
-    Handles receiving control signals from the client.
+    Handles receiving control signals from the client, after any already read elsewhere (pending).
     Updates the shared state and notifies the streaming thread.
     """
+    pending = list(pending)
     while True:
         try:
-            data = client_socket.recv(1024).decode()
-            if not data:
+            message = pending.pop(0) if pending else read_message(client_socket, MAX_CLIENT_PAYLOAD)
+            if message is None:
                 break
 
-            control_signal = eval(data)  
+            msg_type, payload = message
+            if msg_type != MSG_CONTROL:
+                log.warning("unexpected_message type=%s", msg_type)
+                continue
+
+            control_signal = decode_json(payload)
             action = control_signal.get("action")
             video_name = control_signal.get("video")
 
-            print(control_signal)
+            shared_state["stats"]["control_messages"] += 1
+            log.debug("control action=%s video=%s signal=%s", action, video_name, control_signal)
+            if action == "stats":
+                send_message(client_socket, shared_state, stats_message(shared_state))
+                continue
+
+            if action == "thumbnail":
+                message = thumbnail_message(video_name)
+                if message is not None:
+                    send_message(client_socket, shared_state, message)
+                continue
+
+            if action == "catalog":
+                message = catalog_page_message(control_signal)
+                if message is not None:
+                    send_message(client_socket, shared_state, message)
+                continue
+
+            if action in ("start", "seek") and (action == "start" or video_name is not None) \
+                    and not is_title(video_name):
+                log.warning("invalid_video action=%s video=%r", action, video_name)
+                continue
+
+            if action == "transport":
+                with shared_state["send_lock"]:  # Not while a frame is going out on the old transport
+                    shared_state["datagram"] = open_transport(control_signal, client_socket.getpeername()[0],
+                                                              shared_state)
+                continue
+
+            if action == "preview":
+                request = preview_request(control_signal)
+                if request is not None:
+                    with shared_state["preview_condition"]:
+                        shared_state["preview"] = request
+                        shared_state["preview_condition"].notify()
+                continue
+
             with state_condition:
-                if action == "start" and video_name:
+                if action == "viewport":
+                    viewport = parse_viewport(control_signal)
+                    if viewport is not None:
+                        shared_state["viewport"] = viewport
+                        state_condition.notify()
+
+                elif action == "start":
                     shared_state["video_name"] = video_name
                     shared_state["control_flags"]["stop"] = False
+                    shared_state["seek"] = start_position(control_signal)
+                    shared_state["started_at"] = time.monotonic()
+                    shared_state["delta"] = bool(control_signal.get("delta"))
                     state_condition.notify()
 
                 elif action == "stop":
                     shared_state["control_flags"]["stop"] = True
                     shared_state["video_name"] = None
+                    shared_state["seek"] = None
                     state_condition.notify()
 
+                elif action == "seek":
+                    seek = parse_seek(control_signal)
+                    if seek is not None:
+                        shared_state["seek"] = seek
+                        state_condition.notify()
+
                 elif action == "pause":
                     shared_state["control_flags"]["pause"] = True
                     state_condition.notify()
@@ -93,20 +196,457 @@ def receive_control_signal(client_socket, shared_state, state_condition):
                     state_condition.notify()
 
         except Exception as e:
-            print(f"Error in receiving control signal: {e}")
+            log.error("control_error error=%r", e)
             break
 
+def stats_message(shared_state):
+    """
+    The reply to a stats control signal: the session's counters and stage timings, then the server's.
+    A session only times the stages it runs itself (a hub decodes and encodes for all of its subscribers,
+    and only the server's timings include it), so its stages leave out the ones it has never timed.
+    """
+    stages = shared_state["timings"].snapshot(observed_only=True)
+    return encode_json(MSG_STATS, {**shared_state["stats"], "stages": stages, "server": server_metrics.snapshot()})
+
+def thumbnail_message(video_name):
+    """The thumbnail message for a video, or None if it has no thumbnail."""
+    if not is_title(video_name):
+        log.warning("invalid_thumbnail_request video=%r", video_name)
+        return None
+    try:
+        with open(os.path.join(THUMBNAIL_DIR, f"{video_name}.jpg"), 'rb') as f:
+            return encode_thumbnail(video_name, f.read())
+    except OSError:
+        log.warning("thumbnail_missing video=%s", video_name)
+        return None
+
+def parse_viewport(control_signal):
+    """The (width, height) of a viewport control signal, clamped to sane bounds, or None if invalid."""
+    try:
+        width, height = int(control_signal["width"]), int(control_signal["height"])
+    except (KeyError, TypeError, ValueError):
+        log.warning("invalid_viewport signal=%s", control_signal)
+        return None
+    return (min(max(width, MIN_VIEWPORT), MAX_VIEWPORT), min(max(height, MIN_VIEWPORT), MAX_VIEWPORT))
+
+def preview_request(control_signal):
+    """The (streams, tile size) a preview control signal asks for, or None if invalid."""
+    streams = parse_preview(control_signal)
+    if streams is None:
+        return None
+    viewport = parse_viewport(control_signal) if "width" in control_signal else None
+    return streams, viewport
+
+def open_transport(control_signal, host, shared_state):
+    """
+    Switch the session's frame transport as a transport control signal asks: to UDP datagrams,
+    sent to the given port on the client's host (see datagram.py), or back to the connection.
+    Returns the DatagramSender, or None for the connection.
+    """
+    previous = shared_state["datagram"]
+    if previous is not None:
+        previous.close()
+    if control_signal.get("mode") != "udp":
+        log.info("transport mode=tcp")
+        return None
+
+    try:
+        port = int(control_signal["port"])
+        if not 0 < port < 65536:
+            raise ValueError(port)
+    except (KeyError, TypeError, ValueError):
+        log.warning("invalid_transport signal=%s", control_signal)
+        return None
+    loss = LossInjector(UDP_LOSS, UDP_LOSS_BURST) if UDP_LOSS else None
+    datagram = DatagramSender((host, port), shared_state["stats"], loss)
+    if previous is not None:
+        datagram.message_id = previous.message_id  # The client's reassembler carries on where it was
+    log.info("transport mode=udp host=%s port=%d loss=%s", host, port, UDP_LOSS)
+    return datagram
+
+def frame_transport(shared_state, frame):
+    """
+    The DatagramSender to send a frame with in UDP mode, or None to send it on the connection.
+    A delta frame only makes sense on top of the one before, so losing one would spoil those
+    after it: they always go on the connection.
+    """
+    return shared_state["datagram"] if frame.patches is None else None
+
+def parse_seek(control_signal):
+    """A seek request from a seek control signal (by "frame" or by "time" in seconds), or None if invalid."""
+    try:
+        if "frame" in control_signal:
+            seek = {"frame": max(int(control_signal["frame"]), 0), "time": None}
+        else:
+            seek = {"frame": None, "time": max(float(control_signal["time"]), 0.0)}
+    except (KeyError, TypeError, ValueError):
+        log.warning("invalid_seek signal=%s", control_signal)
+        return None
+    seek["id"] = control_signal.get("id")  # Echoed back, so clients can tell which seek landed
+    seek["requested_at"] = time.monotonic()
+    return seek
+
+def start_position(control_signal):
+    """A start signal may carry a "time" or "frame" to start from (e.g. where a client's cache ends): a seek."""
+    if "time" in control_signal or "frame" in control_signal:
+        return parse_seek(control_signal)
+    return None
+
+def take_seek(shared_state):
+    """Take the pending seek request, if any. Call with the state condition held."""
+    seek, shared_state["seek"] = shared_state["seek"], None
+    return seek
+
+def seek_target(seek, fps, video_path=None):
+    """
+    The frame to restart playback from for a seek request. Given the video (for live decoding),
+    the seek lands on the keyframe at or before the requested point when the video has a keyframe
+    index, so the capture can start there without decoding frames that would be thrown away.
+    """
+    frame_index = seek["frame"] if seek["frame"] is not None else int(seek["time"] * fps)
+    keyframes = load_keyframes(video_path, KEYFRAME_DIR) if video_path else None
+    return keyframe_at_or_before(keyframes, frame_index) if keyframes else frame_index
+
+def video_fps(video_name):
+    """A video's frame rate as the catalog has it, for placing a seek before its capture is open."""
+    entry = catalog.current(METADATA_FILE).by_title.get(video_name) or {}
+    return entry.get("fps") or DEFAULT_FPS
+
+def start_target(registry, seek, video_name, video_path):
+    """
+    Where a stream subscribes when it starts: (start frame, timeline). A start that carries a seek
+    (e.g. to where the client's cache ends) goes straight to its target on a timeline of its own,
+    rather than joining the shared hub only to leave it, which would also count as a start from
+    the beginning.
+    """
+    if seek is None:
+        return 0, HubRegistry.SHARED_TIMELINE
+    return seek_target(seek, video_fps(video_name), video_path), registry.new_timeline()
+
+def seeked_message(seek, frame_index, fps, sequence):
+    """
+    The message telling a client where a seek landed; frames sent before it are from the old position.
+    It carries the sequence number of the first frame from the new position, for frames sent as
+    datagrams, which can arrive after it.
+    """
+    return encode_json(MSG_SEEKED, {"id": seek["id"], "frame": frame_index, "pts": frame_index / fps,
+                                    "sequence": sequence})
+
+def record_seek_latency(stats, seek):
+    """Record how long a seek took to produce its first frame."""
+    latency = time.monotonic() - seek["requested_at"]
+    stats["seek_time_to_first_frame"] = latency
+    log.info("seek_first_frame latency_ms=%.1f", latency * 1000)
+
+def record_first_frame(shared_state, video_name):
+    """Record how long the last start request took to produce its first frame, once it has."""
+    started_at, shared_state["started_at"] = shared_state["started_at"], None
+    if started_at is None:
+        return
+    latency = time.monotonic() - started_at
+    shared_state["stats"]["time_to_first_frame"] = latency
+    server_metrics.first_frame.observe(latency)
+    log.info("stream_first_frame video=%s latency_ms=%.1f", video_name, latency * 1000)
+
+def is_stopped(shared_state, video_name):
+    """Whether the client has stopped or switched away from the given video."""
+    return shared_state["control_flags"]["stop"] or shared_state["video_name"] != video_name
+
+def send_message(client_socket, shared_state, message):
+    """Send a complete message; the send lock keeps it from landing in the middle of a frame."""
+    with shared_state["send_lock"]:
+        client_socket.sendall(message)
+
+def next_sequence(shared_state):
+    """Sequence number for the session's next frame. Call with the send lock held."""
+    sequence = shared_state["sequence"]
+    shared_state["sequence"] += 1
+    return sequence
+
+def next_frame_header(shared_state, pts, level, quality, width, height, data_length):
+    """Message and frame headers for the session's next frame. Call with the send lock held."""
+    return encode_frame_header(next_sequence(shared_state), pts, level, quality, width, height, data_length)
+
+def frame_buffers(shared_state, frame, level):
+    """The buffers of the message for an EncodedFrame: a whole JPEG, or tile patches in delta mode."""
+    if frame.patches is not None:
+        return encode_tiles(next_sequence(shared_state), frame.pts, level, frame.quality,
+                            frame.width, frame.height, frame.patches)
+    header = next_frame_header(shared_state, frame.pts, level, frame.quality, frame.width, frame.height,
+                               len(frame.data))
+    return header, frame.data
+
+def subscribe_at_level(video_path, level, shared_state, state_condition, start_frame=0,
+                       timeline=HubRegistry.SHARED_TIMELINE):
+    """Subscribe to the hub for the given quality ladder level, encoding at the client's viewport size."""
+    quality, scale = QUALITY_LADDER[level]
+    subscription = Subscription(state_condition, shared_state["stats"])
+    return hubs.subscribe(video_path, quality, scale, subscription, start_frame, shared_state["viewport"], timeline,
+                          shared_state["delta"])
+
+def message_size(buffers):
+    return sum(memoryview(buffer).nbytes for buffer in buffers)
+
+def record_frame_sent(stats, pacer, frame_index, size):
+    """Count a sent frame of the given size, and whether it went out too late to keep playback real-time."""
+    stats["frames_sent"] += 1
+    stats["bytes_sent"] += size
+    if pacer.is_late(frame_index):
+        stats["frames_late"] += 1
+
+def stream_from_hub(client_socket, shared_state, state_condition, video_name, video_path, controller):
+    """
+    Streams frames from the broadcast hub shared with every client watching the same video.
+    Moves to the hub for another ladder level when the adaptive controller asks for it,
+    or for another viewport size when the client's display is resized. A seek moves the
+    client to a hub of its own, started from the seek target, and so does resuming after
+    a pause if other viewers kept the hub playing meanwhile.
+    """
+    # Join (or start) the shared decode/encode pipeline for this video, or one of its own from a start position
+    with state_condition:
+        seek = take_seek(shared_state)
+    start_frame, timeline = start_target(hubs, seek, video_name, video_path)
+    subscription = subscribe_at_level(video_path, controller.level, shared_state, state_condition, start_frame,
+                                      timeline)
+    if subscription is None:
+        log.error("video_open_failed path=%s", video_path)
+        with state_condition:
+            shared_state["video_name"] = None
+        return
+
+    log.info("stream_started video=%s source=hub frame=%d", video_name, start_frame)
+    controller.frame_interval = subscription.hub.frame_interval
+    pending_seek = None  # Seek whose first frame has not been sent yet
+    if seek is not None:
+        shared_state["stats"]["seeks"] += 1
+        send_message(client_socket, shared_state, seeked_message(seek, start_frame, 1 / subscription.hub.frame_interval,
+                                                                 shared_state["sequence"]))
+        pending_seek = seek
+    position = start_frame  # Index of the next frame the client is due
+
+    try:
+        while True:
+            with state_condition:
+                frame = seek = None
+                resume = False
+                while True:
+                    # Check for stop signal or a switch to another video
+                    if is_stopped(shared_state, video_name):
+                        log.info("stream_stopped video=%s", video_name)
+                        break
+
+                    seek = take_seek(shared_state)
+                    if seek is not None:
+                        break
+
+                    # Handle pause signal; paused viewers let the hub idle
+                    if shared_state["control_flags"]["pause"]:
+                        if not subscription.paused:
+                            log.info("stream_paused video=%s", video_name)
+                            subscription.paused = True
+                        state_condition.wait()
+                        continue
+                    if subscription.paused and subscription.next_index() != position:
+                        # Other viewers kept the hub playing; carry on from where this client paused instead
+                        resume = True
+                        break
+                    subscription.paused = False
+
+                    if subscription.ready():
+                        frame = subscription.take()
+                        break
+                    state_condition.wait()
+
+            if seek is not None:
+                # Restart from the target in a new hub; frames the old one had queued are dropped with it
+                fps = 1 / subscription.hub.frame_interval
+                target = seek_target(seek, fps, video_path)
+                new_subscription = subscribe_at_level(video_path, controller.level, shared_state, state_condition,
+                                                      target, hubs.new_timeline())
+                if new_subscription is None:
+                    continue
+                hubs.unsubscribe(subscription)
+                subscription = new_subscription
+                shared_state["stats"]["seeks"] += 1
+                send_message(client_socket, shared_state, seeked_message(seek, target, fps, shared_state["sequence"]))
+                pending_seek = seek
+                position = target
+                log.info("stream_seeked video=%s frame=%d", video_name, target)
+                continue
+
+            if resume:
+                new_subscription = subscribe_at_level(video_path, controller.level, shared_state, state_condition,
+                                                      position, subscription.hub.timeline)
+                if new_subscription is None:
+                    subscription.paused = False  # Join the hub where it is rather than not at all
+                    continue
+                hubs.unsubscribe(subscription)
+                subscription = new_subscription
+                log.info("stream_resumed video=%s frame=%d", video_name, position)
+                continue
+
+            if frame is None:
+                if subscription.ended:
+                    log.info("stream_ended video=%s", video_name)
+                break
+
+            # Send frame header and data, timing how long the socket takes to accept them
+            level = controller.level
+            datagram = frame_transport(shared_state, frame)
+            send_start = time.monotonic()
+            with shared_state["send_lock"]:
+                # Headers and the encoder's own buffers go out together in one sendmsg call
+                buffers = frame_buffers(shared_state, frame, level)
+                if datagram is not None:
+                    datagram.send(buffers)
+                else:
+                    send_buffers(client_socket, buffers)
+            send_time = time.monotonic() - send_start
+            shared_state["timings"].observe("send", send_time)
+            new_level = controller.record_send(send_time, send_buffer_occupancy(
+                datagram.sock if datagram is not None else client_socket))
+            record_frame_sent(shared_state["stats"], subscription.hub.pacer, frame.index, message_size(buffers))
+            record_first_frame(shared_state, video_name)
+            position = frame.index + 1
+            if pending_seek is not None:
+                record_seek_latency(shared_state["stats"], pending_seek)
+                pending_seek = None
+
+            resized = subscription.hub.viewport != shared_state["viewport"]
+            if new_level is not None or resized:
+                # Carry on from the same point of the video in the hub for the new level or size
+                new_subscription = subscribe_at_level(video_path, controller.level, shared_state, state_condition,
+                                                      subscription.hub.position, subscription.hub.timeline)
+                if new_subscription is None:
+                    controller.set_level(level)
+                    continue
+                hubs.unsubscribe(subscription)
+                subscription = new_subscription
+                if new_level is not None:
+                    log.info("stream_level video=%s level=%d quality=%s scale=%s", video_name, new_level,
+                             *QUALITY_LADDER[new_level])
+                if resized:
+                    log.info("stream_viewport video=%s viewport=%s", video_name, subscription.hub.viewport)
+    finally:
+        hubs.unsubscribe(subscription)  # Leave the hub when done
+
+def stream_from_store(client_socket, shared_state, state_condition, video_name, video_path, stored, controller):
+    """
+    Streams a pre-encoded video straight from its frame store, with no decoding or encoding.
+    Frames are paced at the source frame rate; ones that are already late are skipped.
+    Switches between stored variants when the adaptive controller asks for another level.
+    Every stored frame can be decoded on its own, so seeks land on the exact frame.
+    """
+    log.info("stream_started video=%s source=store", video_name)
+    stats = shared_state["stats"]
+    variants = {controller.level: stored}
+    pacer = FramePacer(stored.fps)
+    controller.frame_interval = pacer.frame_interval
+    pending_seek = None
+
+    try:
+        index = 0
+        while index < stored.frame_count:
+            with state_condition:
+                # Handle pause signal
+                paused = False
+                while (shared_state["control_flags"]["pause"] and shared_state["seek"] is None
+                       and not is_stopped(shared_state, video_name)):
+                    if not paused:
+                        log.info("stream_paused video=%s", video_name)
+                        paused = True
+                    state_condition.wait()
+
+                # Check for stop signal or a switch to another video
+                if is_stopped(shared_state, video_name):
+                    log.info("stream_stopped video=%s", video_name)
+                    return
+
+                seek = take_seek(shared_state)
+
+            if seek is not None:
+                index = min(seek_target(seek, stored.fps), stored.frame_count)
+                pacer.reset(index)
+                stats["seeks"] += 1
+                send_message(client_socket, shared_state, seeked_message(seek, index, stored.fps,
+                                                                         shared_state["sequence"]))
+                pending_seek = seek
+                log.info("stream_seeked video=%s frame=%d", video_name, index)
+                continue
+
+            if paused:
+                pacer.reset(index)
+
+            # Skip frames that have already missed their deadline, then wait for this one's
+            behind = pacer.frames_behind(index)
+            if behind:
+                stats["frames_dropped"] += min(behind, stored.frame_count - index)
+                index += behind
+                continue
+            sleep_start = time.monotonic()
+            time.sleep(max(pacer.delay(index), 0))
+            shared_state["timings"].observe("pacing_sleep", time.monotonic() - sleep_start)
+
+            # Send frame header, then the frame itself from the store
+            level = controller.level
+            variant = variants[level]
+            _, frame_size = variant.frame_span(index)
+            datagram = shared_state["datagram"]
+            send_start = time.monotonic()
+            with shared_state["send_lock"]:
+                header = next_frame_header(shared_state, index / variant.fps, level, variant.quality,
+                                           variant.width, variant.height, frame_size)
+                if datagram is not None:
+                    datagram.send((header, variant.frame(index)))
+                else:
+                    client_socket.sendall(header, SEND_MORE)  # Let the kernel merge it with the sendfile data
+                    send_stored_frame(client_socket, variant, index)
+            send_time = time.monotonic() - send_start
+            shared_state["timings"].observe("send", send_time)
+            new_level = controller.record_send(send_time, send_buffer_occupancy(
+                datagram.sock if datagram is not None else client_socket))
+            record_frame_sent(stats, pacer, index, len(header) + frame_size)
+            record_first_frame(shared_state, video_name)
+            if pending_seek is not None:
+                record_seek_latency(stats, pending_seek)
+                pending_seek = None
+
+            if new_level is not None and new_level not in variants:
+                quality, scale = QUALITY_LADDER[new_level]
+                variant = open_stored(video_path, quality, scale, FRAME_STORE_DIR)
+                if variant is not None and variant.frame_count == stored.frame_count:
+                    variants[new_level] = variant
+                else:
+                    # Only levels that have been pre-encoded can be served from the store
+                    if variant is not None:
+                        variant.close()
+                    controller.set_level(level)
+
+            index += 1
+
+        log.info("stream_ended video=%s", video_name)
+    finally:
+        for variant in variants.values():
+            variant.close()
+
 def stream_video(client_socket, shared_state, state_condition):
     """
     Streams the video requested by the client, using the shared state.
     Dynamically switches videos based on the requested video name.
+    Pre-encoded frames are served when the video has been ingested into the frame store;
+    otherwise frames come from a broadcast hub shared with every client watching it.
+    Quality and resolution adapt to how fast the client drains its socket.
     """
+    controller = AdaptiveController(QUALITY_LADDER, 1 / DEFAULT_FPS)
     try:
         while True:
             with state_condition:
-                # Wait for a video to be assigned or the stop flag to reset
-                while shared_state["video_name"] is None or shared_state["control_flags"]["stop"]:
+                # Wait for a video to be assigned or the stop flag to reset, until the client has gone
+                while not shared_state["closed"] and (shared_state["video_name"] is None
+                                                      or shared_state["control_flags"]["stop"]):
                     state_condition.wait()
+                if shared_state["closed"]:
+                    break
 
                 # Retrieve the video name
                 video_name = shared_state["video_name"]
@@ -114,108 +654,147 @@ def stream_video(client_socket, shared_state, state_condition):
 
                 # Check if the requested video exists
                 if not os.path.exists(video_path):
-                    print(f"Error: Video '{video_name}' not found.")
+                    log.error("video_not_found video=%s", video_name)
                     shared_state["video_name"] = None
                     continue
 
-                # Open the video file
-                cap = cv2.VideoCapture(video_path)
-                if not cap.isOpened():
-                    print(f"Error: Unable to open video '{video_path}'")
-                    shared_state["video_name"] = None
-                    continue
-
-                print(f"Streaming video: {video_name}")
-
-            # Stream video frames
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    print("End of video reached.")
-                    break
-
-                with state_condition:
-                    # Check for stop signal
-                    if shared_state["control_flags"]["stop"]:
-                        print("Stop signal received. Ending current stream.")
-                        state_condition.wait()
-                        break
-
-                    # Handle pause signal
-                    while shared_state["control_flags"]["pause"]:
-                        print("Streaming paused. Waiting for resume signal...")
-                        state_condition.wait()
-
-                # Encode frame as JPEG
-                _, buffer = cv2.imencode('.jpg', frame)
-                frame_data = buffer.tobytes()
+            quality, scale = QUALITY_LADDER[controller.level]
+            stored = open_stored(video_path, quality, scale, FRAME_STORE_DIR)
+            if stored is None:
+                stream_from_hub(client_socket, shared_state, state_condition, video_name, video_path, controller)
+            else:
+                stream_from_store(client_socket, shared_state, state_condition, video_name, video_path,
+                                  stored, controller)
 
-                # Send frame size and data
-                frame_size = len(frame_data)
-                client_socket.sendall(frame_size.to_bytes(4, 'big'))  # Frame size (4 bytes)
-                client_socket.sendall(frame_data)  # Frame data
+            stats = shared_state["stats"]
+            log.info("session_frames video=%s sent=%d late=%d dropped=%d bytes=%d", video_name,
+                     stats["frames_sent"], stats["frames_late"], stats["frames_dropped"], stats["bytes_sent"])
 
-                # Simulate 30 FPS streaming
-                time.sleep(1 / 30)
+    except Exception as e:
+        log.error("stream_error error=%r", e)
+    finally:
+        log.debug("stream_thread_terminated")
 
-            cap.release()  # Release the video file when done
+def stream_previews(client_socket, shared_state):
+    """
+    Sends the live previews the client has asked for (see preview.py) until the connection closes.
+    Frames are sent a round at a time, at most one per preview stream, in between the frames
+    of the stream being watched.
+    """
+    preview_condition = shared_state["preview_condition"]
+    scheduler = PreviewScheduler(hubs, lambda: Subscription(preview_condition), VIDEO_DIR)
+    stats = shared_state["stats"]
+    try:
+        while True:
+            with preview_condition:
+                while not shared_state["closed"] and shared_state["preview"] is None and not scheduler.ready():
+                    preview_condition.wait()
+                if shared_state["closed"]:
+                    break
+                request, shared_state["preview"] = shared_state["preview"], None
+                if request is None:
+                    frames, ended = scheduler.take_round()
+
+            if request is not None:
+                scheduler.update(*request)
+                continue
+
+            for stream_id, frame in frames:
+                buffers = preview_buffers(stream_id, frame)
+                with shared_state["send_lock"]:
+                    send_buffers(client_socket, buffers)
+                stats["preview_frames_sent"] += 1
+                stats["bytes_sent"] += message_size(buffers)
+            scheduler.restart(ended)
 
     except Exception as e:
-        print(f"Error during video streaming: {e}")
+        log.error("preview_error error=%r", e)
     finally:
-        print("Video streaming thread terminated.")
+        scheduler.close()
+        log.debug("preview_thread_terminated")
 
-def handle_client(client_socket):
+def handle_client(client_socket, pending=None):
     """
-    Handles the connection with a single client.
-    Manages threads for streaming video and receiving control signals.
+    Handles the connection with a single client: its catalog first, then threads for streaming video
+    and receiving control signals. A connection handed over with the control messages read from it
+    so far (pending) has had its catalog already; those messages are handled first.
     """
     print("Client connected.")
+    if pending is None:
+        try:
+            send_metadata(client_socket)
+        except OSError as e:
+            log.warning("handshake_failed error=%r", e)
+            client_socket.close()
+            return
+        pending = ()
     
     # Shared state for the client
     shared_state = {
         "video_name": None,  # Currently requested video name
+        "viewport": None,    # Client display size (width, height) that frames are scaled down to
+        "seek": None,        # Seek request waiting for the streaming thread
+        "started_at": None,  # When the last start request arrived, until its first frame is sent
+        "delta": False,      # Whether the client asked for tile-based delta frames
+        "preview": None,     # Preview streams and tile size waiting for the preview thread
+        "closed": False,     # Set once the client has gone
+        "datagram": None,    # UDP mode: the DatagramSender frames go out on, instead of the connection
         "control_flags": {
             "pause": False,  # Pause/resume video
             "stop": True     # Stop video streaming
-        }
+        },
+        "stats": new_session_stats(),  # Sent, late and dropped frame counts
+        "sequence": 0,                 # Sequence number of the next frame sent
+        "send_lock": threading.Lock(),           # Keeps messages from the three threads whole
+        "preview_condition": threading.Condition()  # Wakes the preview thread for requests and frames
     }
+    shared_state["timings"] = server_metrics.open_session(shared_state["stats"])  # Send and pacing times
     
     # Condition variable for thread synchronization
     state_condition = threading.Condition()
 
-    # Create threads for streaming and receiving control signals
+    # Create threads for streaming, live previews and receiving control signals
     stream_thread = threading.Thread(target=stream_video, args=(client_socket, shared_state, state_condition))
-    control_thread = threading.Thread(target=receive_control_signal, args=(client_socket, shared_state, state_condition))
+    preview_thread = threading.Thread(target=stream_previews, args=(client_socket, shared_state))
+    control_thread = threading.Thread(target=receive_control_signal,
+                                      args=(client_socket, shared_state, state_condition, pending))
 
     # Start threads
     stream_thread.start()
+    preview_thread.start()
     control_thread.start()
 
     # Wait for threads to finish
     control_thread.join()  # Control thread should end when client disconnects
-    shared_state["control_flags"]["stop"] = True  # Ensure streaming thread exits
     with state_condition:
+        shared_state["control_flags"]["stop"] = True  # Ensure streaming thread exits
+        shared_state["closed"] = True
         state_condition.notify_all()  # Wake the streaming thread if waiting
+    with shared_state["preview_condition"]:
+        shared_state["preview_condition"].notify_all()
     stream_thread.join()
+    preview_thread.join()
+    if shared_state["datagram"] is not None:
+        shared_state["datagram"].close()
+    server_metrics.close_session(shared_state["stats"])
 
+    # Also ends connections the control thread gave up on, e.g. over a message it could not read
+    client_socket.close()
     print("Client connection closed.")
 
-def start_server():
+def start_server(host='0.0.0.0', port=5000):
     """Start the server, accept client connections, and handle them."""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 5000))
-    server_socket.listen(5)
-    print("Server listening on port 5000...")
+    server_socket.bind((host, port))
+    # Room for a burst of connections between two accepts
+    server_socket.listen(1024)
+    print(f"Server listening on port {port}...")
     
     while True:
         client_socket, addr = server_socket.accept()
         print(f"Connected to {addr}")
 
-        # Send metadata to the client
-        send_metadata(client_socket)
-
-        # Handle the client connection in a new thread
+        # Handle the client connection, catalog first, in a new thread, so the next one can be accepted at once
         client_handler = threading.Thread(target=handle_client, args=(client_socket,))
         client_handler.start()
 
@@ -224,5 +803,65 @@ def start_server():
     print(f"Connection with {addr} closed.")
 
 
+def main():
+    global QUALITY_LADDER, UDP_LOSS, UDP_LOSS_BURST
+    import workers  # Imports this module, so not at the top
+
+    parser = argparse.ArgumentParser(description="Video streaming server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default=SERVER_ENGINE,
+                        help="client handling engine (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=ENCODE_WORKERS,
+                        help="JPEG encode threads and blocking-work executor size for the asyncio engine "
+                             "(decoding runs on a thread per video)")
+    parser.add_argument("--ladder", type=parse_ladder, default=QUALITY_LADDER,
+                        help='adaptive quality ladder as "quality:scale,...", best level first')
+    parser.add_argument("--watch", action="store_true",
+                        help="keep rescanning the videos directory for new or changed videos")
+    parser.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL,
+                        help="seconds between rescans with --watch (default: %(default)s)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve Prometheus text-format metrics on this local port")
+    parser.add_argument("--udp-loss", type=float, default=UDP_LOSS,
+                        help="fraction of frame datagrams to drop on purpose, for trying UDP mode on loopback")
+    parser.add_argument("--udp-loss-burst", type=float, default=UDP_LOSS_BURST,
+                        help="average run of datagrams dropped in a row with --udp-loss (default: %(default)s)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every control signal (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="worker processes to spread clients over (0: one per CPU, default: %(default)s)")
+    parser.add_argument("--placement", choices=workers.PLACEMENTS, default=workers.PLACEMENTS[0],
+                        help="how clients are placed on worker processes (default: %(default)s)")
+    args = parser.parse_args()
+
+    QUALITY_LADDER = args.ladder
+    UDP_LOSS, UDP_LOSS_BURST = args.udp_loss, args.udp_loss_burst
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+
+    # Only new or changed videos are processed, so this is quick once the catalog exists
+    generate_metadata()
+    if args.watch:
+        watch_metadata(args.watch_interval)
+
+    if args.processes != 1:
+        # Each worker process serves its own metrics, on ports from --metrics-port up
+        workers.start_server(port=args.port, processes=args.processes, engine=args.engine,
+                             engine_workers=args.workers, placement=args.placement, log_level=args.log_level,
+                             metrics_port=args.metrics_port)
+        return
+
+    if args.metrics_port:
+        serve_metrics(server_metrics, port=args.metrics_port)
+        print(f"Metrics available at http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.engine == "asyncio":
+        import async_server
+        async_server.start_server(port=args.port, workers=args.workers)
+    else:
+        start_server(port=args.port)
+
+
 if __name__ == "__main__":
-    start_server()
+    # Run from the importable module so the other modules see the same settings
+    import server
+    server.main()
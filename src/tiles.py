@@ -0,0 +1,106 @@
+"""
+Tile-based delta encoding for low-motion video (screen recordings, fixed cameras).
+
+Frames are split into square tiles and compared with what the client already
+has. Only tiles that changed are sent, as JPEG patches covering runs of
+adjacent changed tiles; everything else stays as it is in the client's frame
+buffer. A full frame (a single patch covering the whole frame) is sent
+periodically, when a viewer joins, and whenever so much has changed that
+patches would cost more than a plain JPEG.
+"""
+import cv2
+import numpy as np
+
+# Side of a square tile, in pixels
+TILE_SIZE = 32
+# Largest per-pixel difference still treated as unchanged, to ride out sensor and JPEG noise
+CHANGE_THRESHOLD = 12
+# Frames between full frames, bounding how long drift or a lost patch can last
+KEYFRAME_INTERVAL = 150
+# Send a full frame instead when more than this fraction of tiles changed
+MAX_CHANGED_FRACTION = 0.5
+
+
+def changed_tiles(reference, frame, tile_size=TILE_SIZE, threshold=CHANGE_THRESHOLD):
+    """Boolean grid (tile rows x tile columns) of the tiles in which the frame differs from the reference."""
+    height, width = frame.shape[:2]
+    diff = cv2.absdiff(frame, reference).max(axis=2)
+
+    # Pad to whole tiles, then take the largest difference in each tile in one vectorized pass
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    pad_height, pad_width = rows * tile_size - height, columns * tile_size - width
+    if pad_height or pad_width:
+        diff = np.pad(diff, ((0, pad_height), (0, pad_width)))
+    return diff.reshape(rows, tile_size, columns, tile_size).max(axis=(1, 3)) > threshold
+
+
+def tile_runs(grid):
+    """(row, first column, last column) of each horizontal run of changed tiles."""
+    for row in np.flatnonzero(grid.any(axis=1)):
+        columns = np.flatnonzero(grid[row])
+        for run in np.split(columns, np.flatnonzero(np.diff(columns) > 1) + 1):
+            yield row, run[0], run[-1]
+
+
+def is_full_frame(patch, width, height):
+    x, y, patch_width, patch_height = patch[:4]
+    return (x, y, patch_width, patch_height) == (0, 0, width, height)
+
+
+def merge_patches(older, newer, width, height):
+    """
+    Patches that take a client from before older to after newer, for a client that missed older.
+    Patches are applied in order, so later ones simply paint over earlier ones.
+    """
+    if newer and is_full_frame(newer[0], width, height):
+        return newer
+    return older + newer
+
+
+class TileEncoder:
+    """Encodes each frame as JPEG patches of the tiles that changed since the frames already sent."""
+
+    def __init__(self, tile_size=TILE_SIZE, threshold=CHANGE_THRESHOLD, keyframe_interval=KEYFRAME_INTERVAL,
+                 max_changed_fraction=MAX_CHANGED_FRACTION):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.max_changed_fraction = max_changed_fraction
+        self.reference = None      # What clients' frame buffers hold, as of the last frame sent
+        self.since_keyframe = 0
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        """Make the next frame a full one, e.g. because a new viewer has no frame buffer yet."""
+        self.keyframe_requested = True
+
+    def encode(self, frame, quality):
+        """A list of (x, y, width, height, JPEG buffer) patches for the frame."""
+        height, width = frame.shape[:2]
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        grid = None
+        if (self.reference is not None and self.reference.shape == frame.shape
+                and not self.keyframe_requested and self.since_keyframe < self.keyframe_interval):
+            grid = changed_tiles(self.reference, frame, self.tile_size, self.threshold)
+            if grid.mean() > self.max_changed_fraction:
+                grid = None
+
+        if grid is None:
+            self.reference = frame.copy()
+            self.since_keyframe = 0
+            self.keyframe_requested = False
+            _, buffer = cv2.imencode('.jpg', frame, params)
+            return [(0, 0, width, height, buffer)]
+
+        self.since_keyframe += 1
+        patches = []
+        size = self.tile_size
+        for row, first, last in tile_runs(grid):
+            y, x = row * size, first * size
+            patch = frame[y:min(y + size, height), x:min((last + 1) * size, width)]
+            # Only tiles that are sent go into the reference, so slow drift elsewhere still adds up to a change
+            self.reference[y:y + patch.shape[0], x:x + patch.shape[1]] = patch
+            _, buffer = cv2.imencode('.jpg', patch, params)
+            patches.append((int(x), int(y), patch.shape[1], patch.shape[0], buffer))
+        return patches
@@ -0,0 +1,138 @@
+"""
+Warm starts: what a new stream needs before its first frame, kept ready.
+
+Opening a container and decoding up to the first frame is most of a stream's
+time to first frame. CapturePool keeps the captures of recently watched videos
+open, so switching back to a video, or starting another variant of it, skips
+the open. FirstFrames keeps the first seconds of the most requested videos
+already encoded: a hub starting one of them from the beginning publishes those
+frames straight away while its own pipeline seeks and decodes its way to where
+they end.
+
+Both are keyed by the source file's mtime and size, so a replaced video is
+never served from a stale capture or stale frames.
+"""
+import os
+import threading
+from collections import Counter, OrderedDict
+import cv2
+
+# Idle captures kept open, across all videos
+CAPTURE_POOL_SIZE = 8
+
+# Seconds from the start of a video kept encoded
+FIRST_FRAMES_SECONDS = 2.0
+
+# Variants (video, quality, scale, viewport) whose first frames are kept
+FIRST_FRAMES_VARIANTS = 16
+
+# Bytes of encoded first frames kept, across all variants
+FIRST_FRAMES_BYTES = 64 * 1024 * 1024
+
+
+def source_key(video_path):
+    """The video as it is on disk now: (path, mtime, size), or None if it is missing."""
+    try:
+        stat = os.stat(video_path)
+    except OSError:
+        return None
+    return video_path, stat.st_mtime_ns, stat.st_size
+
+
+class CapturePool:
+    """Open captures no hub is using, least recently used first, to be taken instead of opening a new one."""
+
+    def __init__(self, size=CAPTURE_POOL_SIZE):
+        self.size = size
+        self.idle = OrderedDict()  # (source, serial) -> capture
+        self.serial = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, source):
+        """An open capture of the source (at any position), or None if it cannot be opened."""
+        with self.lock:
+            for pooled in reversed(self.idle):
+                if pooled[0] == source:
+                    self.hits += 1
+                    return self.idle.pop(pooled)
+            self.misses += 1
+
+        cap = cv2.VideoCapture(source[0])
+        if not cap.isOpened():
+            cap.release()
+            return None
+        return cap
+
+    def release(self, source, cap):
+        """Give a capture back, closing the least recently used one if the pool is full."""
+        with self.lock:
+            self.serial += 1
+            self.idle[source, self.serial] = cap
+            evicted = [self.idle.popitem(last=False)[1] for _ in range(len(self.idle) - self.size)]
+        for cap in evicted:
+            cap.release()
+
+
+class FirstFrames:
+    """
+    The first frames of the most requested variants, as EncodedFrames. Hubs that play a
+    variant from the start record them, and the cache keeps those of the videos started
+    from the beginning most often, within a number of variants and a byte budget.
+    """
+
+    def __init__(self, seconds=FIRST_FRAMES_SECONDS, variants=FIRST_FRAMES_VARIANTS, budget=FIRST_FRAMES_BYTES):
+        self.seconds = seconds
+        self.variants = variants
+        self.budget = budget
+        self.frames = {}           # (source, quality, scale, viewport) -> tuple of EncodedFrames
+        self.sizes = {}            # (source, quality, scale, viewport) -> bytes of JPEG data
+        self.size = 0
+        self.requests = Counter()  # source -> times started from the beginning
+        self.lock = threading.Lock()
+
+    def request(self, source):
+        """Count a start from the beginning of a video."""
+        with self.lock:
+            self.requests[source] += 1
+
+    def get(self, variant):
+        with self.lock:
+            return self.frames.get(variant, ())
+
+    def wants(self, variant):
+        """Whether a hub playing this variant from the start should record its first frames."""
+        with self.lock:
+            return variant not in self.frames and self._room_for(variant[0])
+
+    def store(self, variant, frames):
+        """Keep a variant's first frames, evicting less requested ones to make room, if that is enough."""
+        frames = tuple(frames)
+        size = sum(memoryview(frame.data).nbytes for frame in frames)
+        with self.lock:
+            if variant in self.frames or size > self.budget:
+                return
+            evicted, count, total = [], len(self.frames), self.size
+            for other in sorted(self.frames, key=lambda other: self.requests[other[0]]):
+                if count < self.variants and total + size <= self.budget:
+                    break
+                if self.requests[other[0]] >= self.requests[variant[0]]:
+                    return  # Only more requested videos would make room
+                evicted.append(other)
+                count, total = count - 1, total - self.sizes[other]
+            for other in evicted:
+                del self.frames[other]
+                self.size -= self.sizes.pop(other)
+            self.frames[variant] = frames
+            self.sizes[variant] = size
+            self.size += size
+
+    def _room_for(self, source):
+        """Whether the cache has room, or holds a less requested video. Call with the lock held."""
+        if len(self.frames) < self.variants and self.size < self.budget:
+            return True
+        return bool(self.frames) and self.requests[source] > self.requests[self._least_requested()[0]]
+
+    def _least_requested(self):
+        return min(self.frames, key=lambda variant: self.requests[variant[0]])
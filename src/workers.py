@@ -0,0 +1,259 @@
+"""
+Multi-process server: one parent process accepts connections and hands each one, as an
+open socket, to one of several worker processes that each run a full server engine.
+Every worker has its own interpreter, hubs and metrics, so decoding, encoding and the
+per-frame Python work spread over all cores instead of queueing on one GIL. A supervisor
+thread per worker counts its open connections and restarts it if it dies.
+
+Placement decides which worker gets a connection:
+- least-connections: the worker with the fewest open connections
+- round-robin: each worker in turn
+- video: the parent answers thumbnail requests itself until the client starts a video,
+  then hands the connection to the worker that owns that video, so everyone watching
+  it shares one hub (one decode/encode pipeline) instead of one per worker. A client
+  that asks for live previews first, which the parent cannot serve, goes to the worker
+  with the fewest connections instead
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+import zlib
+from multiprocessing import reduction
+from metrics import serve_metrics
+from protocol import MAX_CLIENT_PAYLOAD, MSG_CONTROL, ProtocolError, decode_json, is_title, read_message
+import server
+
+PLACEMENTS = ("least-connections", "round-robin", "video")
+
+# Server settings copied into each worker, which starts as a fresh interpreter rather than a fork
+SETTINGS = ("VIDEO_DIR", "THUMBNAIL_DIR", "METADATA_FILE", "INDEX_FILE", "FRAME_STORE_DIR", "KEYFRAME_DIR",
+            "QUALITY_LADDER", "UDP_LOSS", "UDP_LOSS_BURST", "CATALOG_COMPRESSION")
+
+# Seconds before a dead worker is restarted, so one that crashes on start does not spin
+RESTART_DELAY = 1.0
+
+log = logging.getLogger(__name__)
+
+
+def send_socket(conn, sock, pid):
+    """Hand an open socket to another process over a multiprocessing connection."""
+    if hasattr(sock, "share"):  # Windows: sockets are not plain handles
+        conn.send(sock.share(pid))
+    else:
+        reduction.send_handle(conn, sock.fileno(), pid)
+
+
+def receive_socket(conn):
+    if hasattr(socket, "fromshare"):
+        return socket.fromshare(conn.recv())
+    return socket.socket(fileno=reduction.recv_handle(conn))
+
+
+def hold_until_start(client_socket):
+    """
+    Read a new client's control messages until it starts a video, answering thumbnail and catalog
+    requests on the way. Returns the messages for the worker to replay and the video, or (None, None)
+    if the client leaves first. Asking for previews needs a worker straight away: the video is then None.
+    """
+    pending = []
+    while True:
+        message = read_message(client_socket, MAX_CLIENT_PAYLOAD)
+        if message is None:
+            return None, None
+        msg_type, payload = message
+        message = (msg_type, bytes(payload))  # Sent on to the worker, so not a view of a receive buffer
+        if msg_type == MSG_CONTROL:
+            control_signal = decode_json(payload)
+            if control_signal.get("action") == "thumbnail":
+                reply = server.thumbnail_message(control_signal.get("video"))
+                if reply is not None:
+                    client_socket.sendall(reply)
+                continue
+            if control_signal.get("action") == "catalog":
+                reply = server.catalog_page_message(control_signal)
+                if reply is not None:
+                    client_socket.sendall(reply)
+                continue
+            if control_signal.get("action") == "start" and is_title(control_signal.get("video")):
+                pending.append(message)
+                return pending, control_signal["video"]
+            if control_signal.get("action") == "preview":
+                pending.append(message)
+                return pending, None
+        pending.append(message)
+
+
+def serve_connection(client_socket, pending, on_closed):
+    """Worker side of a handed-over connection, on a thread of its own."""
+    try:
+        server.handle_client(client_socket, pending)
+    except OSError as e:
+        log.warning("connection_error error=%r", e)
+    finally:
+        client_socket.close()
+        on_closed()
+
+
+def run_worker(number, conn, engine, engine_workers, settings, log_level, metrics_port):
+    """Worker process: serve the connections the parent hands over, telling it as each one closes."""
+    logging.basicConfig(level=log_level, format=server.LOG_FORMAT)
+    for name, value in settings.items():
+        setattr(server, name, value)
+    if metrics_port:
+        serve_metrics(server.server_metrics, port=metrics_port)
+    log.info("worker_started worker=%d engine=%s", number, engine)
+
+    send_lock = threading.Lock()
+
+    def on_closed():
+        with send_lock:
+            conn.send("closed")
+
+    def receive_connection():
+        client_socket = receive_socket(conn)
+        return client_socket, conn.recv()
+
+    try:
+        if engine == "asyncio":
+            import async_server
+            asyncio.run(async_server.serve_handed_off(receive_connection, engine_workers, on_closed))
+        else:
+            while True:
+                client_socket, pending = receive_connection()
+                # Daemon threads: a worker that is stopped drops its connections rather than waiting on them
+                threading.Thread(target=serve_connection, args=(client_socket, pending, on_closed),
+                                 daemon=True).start()
+    except (EOFError, OSError):
+        pass  # The parent has gone
+
+
+class Worker:
+    """The parent's handle on one worker process."""
+
+    def __init__(self, number, engine, engine_workers, log_level, metrics_port, stopping):
+        self.number = number
+        self.args = (engine, engine_workers, log_level, metrics_port)
+        self.lock = threading.Lock()  # Keeps a socket and its pending messages together on the pipe
+        self.conn = None
+        self.process = None
+        self.connections = 0
+        self.stopping = stopping  # Set when the server shuts down, which takes its workers with it
+
+    def start(self):
+        engine, engine_workers, log_level, metrics_port = self.args
+        settings = {name: getattr(server, name) for name in SETTINGS}
+        # Spawned, not forked: a fork would copy locks held by the parent's accept, supervisor and placement
+        # threads at that moment (the catalog's, say), and the worker would hang on its first use of them
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_worker, daemon=True,
+            args=(self.number, child_conn, engine, engine_workers, settings, log_level, metrics_port)
+        )
+        self.process.start()
+        child_conn.close()
+        self.connections = 0
+
+    def hand_off(self, client_socket, pending):
+        """Send the worker a connection, with the control messages already read from it (None if none)."""
+        with self.lock:
+            send_socket(self.conn, client_socket, self.process.pid)
+            self.conn.send(pending)
+            self.connections += 1
+
+    def supervise(self):
+        """Count the worker's closed connections, and restart it whenever it dies."""
+        while True:
+            try:
+                self.conn.recv()
+                with self.lock:
+                    self.connections -= 1
+            except (EOFError, OSError):
+                self.process.join()
+                if self.stopping.is_set():
+                    return
+                log.error("worker_died worker=%d exitcode=%s connections_lost=%d", self.number,
+                          self.process.exitcode, self.connections)
+                time.sleep(RESTART_DELAY)
+                with self.lock:
+                    self.conn.close()
+                    self.start()
+
+
+class WorkerPool:
+    """Worker processes plus the placement policy that picks one for each connection."""
+
+    def __init__(self, processes, engine="threaded", engine_workers=None, placement="least-connections",
+                 log_level="INFO", metrics_port=None):
+        self.stopping = threading.Event()
+        # Each worker serves its own metrics, on consecutive ports
+        self.workers = [Worker(number, engine, engine_workers, log_level, metrics_port and metrics_port + number,
+                               self.stopping)
+                        for number in range(processes)]
+        self.placement = placement
+        self.turns = itertools.cycle(self.workers)
+        self.lock = threading.Lock()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+            threading.Thread(target=worker.supervise, daemon=True).start()
+
+    def worker_for(self, video=None):
+        """The worker for a connection (starting the given video), passing over any being restarted."""
+        if video is not None:
+            # A stable hash, so a video keeps its worker across restarts of the server
+            worker = self.workers[zlib.crc32(video.encode()) % len(self.workers)]
+            if worker.process.is_alive():
+                return worker
+        elif self.placement == "round-robin":
+            with self.lock:
+                for _ in self.workers:
+                    worker = next(self.turns)
+                    if worker.process.is_alive():
+                        return worker
+        alive = [worker for worker in self.workers if worker.process.is_alive()] or self.workers
+        return min(alive, key=lambda worker: worker.connections)
+
+    def place(self, client_socket):
+        """Hand a new connection to a worker; with video placement, only once it has started a video."""
+        try:
+            pending = video = None
+            if self.placement == "video":
+                server.send_metadata(client_socket)
+                pending, video = hold_until_start(client_socket)
+                if pending is None:
+                    return
+            self.worker_for(video).hand_off(client_socket, pending)
+        except (OSError, ValueError, ProtocolError) as e:
+            log.warning("placement_failed error=%r", e)
+        finally:
+            client_socket.close()  # The worker has its own copy
+
+
+def start_server(host='0.0.0.0', port=5000, processes=None, engine="threaded", engine_workers=None,
+                 placement="least-connections", log_level="INFO", metrics_port=None):
+    """Start the worker processes, then accept connections and place each one with a worker."""
+    processes = processes or multiprocessing.cpu_count()
+    pool = WorkerPool(processes, engine, engine_workers, placement, log_level, metrics_port)
+    pool.start()
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind((host, port))
+    server_socket.listen(1024)
+    print(f"Server listening on port {port} ({processes} {engine} worker processes, {placement} placement)...")
+
+    try:
+        while True:
+            client_socket, addr = server_socket.accept()
+            if placement == "video":
+                # Held until the client picks a video, which can take a while
+                threading.Thread(target=pool.place, args=(client_socket,), daemon=True).start()
+            else:
+                pool.place(client_socket)
+    finally:
+        pool.stopping.set()